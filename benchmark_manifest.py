@@ -0,0 +1,113 @@
+# Memory benchmark of in-memory manifest representations.
+#
+# Copyright (c) 2023 Dark Energy Processor
+#
+# This software is provided 'as-is', without any express or implied
+# warranty. In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+
+import argparse
+import gc
+import hashlib
+import json
+import os
+import random
+import tempfile
+import tracemalloc
+
+from typing import Callable
+
+
+def write_json(file: str, data):
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    with open(file, "w", encoding="UTF-8", newline="") as f:
+        json.dump(data, f)
+
+
+def make_entry(name: str, rng: random.Random):
+    seed = rng.randbytes(16)
+    return {
+        "name": name,
+        "size": rng.randrange(1, 1 << 30),
+        "md5": hashlib.md5(seed).hexdigest(),
+        "sha256": hashlib.sha256(seed).hexdigest(),
+    }
+
+
+def generate_archive_root(root: str, packages: int, files: int, microdl: int):
+    rng = random.Random(1)
+    write_json(f"{root}/generation.json", {"major": 1, "minor": 1})
+    write_json(f"{root}/release_info.json", {})
+    write_json(f"{root}/iOS/package/info.json", ["59.0"])
+    package_path = f"{root}/iOS/package/59.0"
+    write_json(f"{package_path}/1/info.json", list(range(1, packages + 1)))
+    for pkgid in range(1, packages + 1):
+        write_json(f"{package_path}/1/{pkgid}/infov2.json", [make_entry(f"{i}.zip", rng) for i in range(1, files + 1)])
+    microdl_map = {}
+    for i in range(microdl):
+        entry = make_entry("", rng)
+        del entry["name"]
+        microdl_map[f"assets/image/unit/{i // 100}/{i}.texb"] = entry
+    write_json(f"{package_path}/microdl/info.json", microdl_map)
+
+
+def measure(load: Callable[[], object]):
+    gc.collect()
+    tracemalloc.start()
+    result = load()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare memory used by parsed JSON and compact manifests.")
+    parser.add_argument("--packages", help="Number of packages (default 2000).", type=int, default=2000)
+    parser.add_argument("--files", help="Archives per package (default 5).", type=int, default=5)
+    parser.add_argument("--microdl", help="Number of microdl files (default 100000).", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        generate_archive_root(root, args.packages, args.files, args.microdl)
+        # n4dlapi loads its config on import.
+        os.environ["N4DLAPI_ARCHIVE_ROOT"] = root
+        os.environ["N4DLAPI_CONFIG_FILE"] = os.path.join(root, "config.toml")
+        from n4dlapi import file
+        from n4dlapi import manifest
+
+        package_path = f"{root}/iOS/package/59.0"
+        infov2 = [f"{package_path}/1/{pkgid}/infov2.json" for pkgid in range(1, args.packages + 1)]
+        microdl = f"{package_path}/microdl/info.json"
+        entries = len(infov2) * args.files
+
+        print("Entries:", entries, "package archives,", args.microdl, "microdl files")
+        for name, count, load in [
+            ("infov2.json, parsed JSON", entries, lambda: [file.load_json(p) for p in infov2]),
+            ("infov2.json, Manifest", entries, lambda: [manifest.Manifest(file.load_json(p)) for p in infov2]),
+            ("microdl info.json, parsed JSON", args.microdl, lambda: file.load_json(microdl)),
+            (
+                "microdl info.json, MicrodlManifest",
+                args.microdl,
+                lambda: manifest.MicrodlManifest(file.load_json(microdl)),
+            ),
+        ]:
+            size = measure(load)
+            print(f"{name}: {size / count:.1f} bytes per entry ({size / 1048576:.1f} MiB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -21,22 +21,32 @@
 # DEALINGS IN THE SOFTWARE.
 
 import argparse
+import concurrent.futures
+import contextlib
 import dataclasses
+import email.utils
 import hashlib
 import http.client
 import itertools
 import json
 import os
 import pickle
+import random
 import shutil
+import sqlite3
+import threading
 import time
 import urllib.parse
 import zipfile
 
-from typing import Any
-
+from typing import IO, Any, Callable, TypeVar
 
 NEED_DLAPI_VERSION = (1, 1)
+MAX_RETRY = 25
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60.0
+
+_T = TypeVar("_T")
 
 
 @dataclasses.dataclass
@@ -80,6 +90,16 @@ class CloneDownloadError(RuntimeError):
     pass
 
 
+class HashMismatchError(CloneDownloadError):
+    pass
+
+
+class RetryableHTTPError(RuntimeError):
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
 def get_port_by_parseresult(parse: urllib.parse.ParseResult):
     if parse.scheme == "https":
         return parse.port or 443
@@ -102,24 +122,240 @@ def new_http_client(parse: urllib.parse.ParseResult):
     return cls(parse.hostname, get_port_by_parseresult(parse), timeout=30)
 
 
-_dl_http_client: http.client.HTTPSConnection | http.client.HTTPConnection | None = None
-_api_http_client: http.client.HTTPSConnection | http.client.HTTPConnection | None = None
+class ConnectionPool:
+    """
+    Thread-safe pool of keep-alive connections, keyed by scheme, host and port.
+    """
 
+    def __init__(self, max_idle_per_host: int = 4):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle: dict[tuple[str, str | None, int], list[http.client.HTTPConnection]] = {}
+        self.lock = threading.Lock()
 
-def update_http_client(
-    parse: urllib.parse.ParseResult, handle: http.client.HTTPSConnection | http.client.HTTPConnection | None
-):
-    if (
-        handle is None
-        or handle.host != parse.hostname
-        or handle.port != get_port_by_parseresult(parse)
-        or (isinstance(handle, http.client.HTTPSConnection) and parse.scheme == "http")
-        or (isinstance(handle, http.client.HTTPConnection) and parse.scheme == "https")
-    ):
-        if handle is not None:
-            handle.close()
+    @staticmethod
+    def get_key(parse: urllib.parse.ParseResult):
+        return parse.scheme, parse.hostname, get_port_by_parseresult(parse)
+
+    def acquire(self, parse: urllib.parse.ParseResult):
+        with self.lock:
+            connections = self.idle.get(self.get_key(parse))
+            if connections:
+                return connections.pop()
         return new_http_client(parse)
-    return handle
+
+    def release(self, parse: urllib.parse.ParseResult, connection: http.client.HTTPConnection):
+        with self.lock:
+            connections = self.idle.setdefault(self.get_key(parse), [])
+            if len(connections) < self.max_idle_per_host:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def set_max_idle_per_host(self, max_idle_per_host: int):
+        with self.lock:
+            self.max_idle_per_host = max_idle_per_host
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
+
+
+_connection_pool = ConnectionPool()
+
+
+class HostController:
+    """
+    Limits in-flight requests to one host using AIMD and trips a circuit breaker on repeated failures.
+
+    The limit grows by one per success until the first congestion signal, then by one per window. Errors halve it,
+    and time-to-first-byte well above the lowest seen shrinks it slightly, at most once per round trip each.
+    """
+
+    LATENCY_TOLERANCE = 2.0
+    FAILURE_THRESHOLD = 5
+    BREAKER_BASE = 5.0
+    BREAKER_MAX = 300.0
+
+    def __init__(self, name: str, max_limit: int):
+        self.name = name
+        self.max_limit = max_limit
+        self.limit = 1.0
+        self.threshold = float(max_limit)
+        self.inflight = 0
+        self.min_latency: float | None = None
+        self.last_decrease = 0.0
+        self.failures = 0
+        self.trips = 0
+        self.resume_at = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if now < self.resume_at:
+                    self.condition.wait(self.resume_at - now)
+                    continue
+                # Half-open breaker only lets a single probe request through.
+                limit = 1 if self.failures >= self.FAILURE_THRESHOLD else int(self.limit)
+                if self.inflight < limit:
+                    break
+                self.condition.wait()
+            self.inflight = self.inflight + 1
+
+    def release(self, success: bool, congested: bool = False, retry_after: float | None = None):
+        with self.condition:
+            self.inflight = self.inflight - 1
+            now = time.monotonic()
+            if success:
+                self.failures = 0
+                self.trips = 0
+                increment = 1.0 if self.limit < self.threshold else 1.0 / self.limit
+                self.limit = min(float(self.max_limit), self.limit + increment)
+            elif congested:
+                self.failures = self.failures + 1
+                self._decrease(now, 0.5)
+                if self.failures >= self.FAILURE_THRESHOLD:
+                    cooldown = min(self.BREAKER_MAX, self.BREAKER_BASE * pow(2, self.trips))
+                    self.trips = self.trips + 1
+                    self.resume_at = max(self.resume_at, now + cooldown)
+                    print(f"Too many failures from {self.name}, pausing for {cooldown:.0f}s")
+            if retry_after is not None:
+                self.resume_at = max(self.resume_at, now + retry_after)
+            self.condition.notify_all()
+
+    def record_latency(self, latency: float):
+        with self.condition:
+            if self.min_latency is None or latency < self.min_latency:
+                self.min_latency = latency
+            elif latency > self.min_latency * self.LATENCY_TOLERANCE:
+                self._decrease(time.monotonic(), 0.9)
+            # Let the baseline drift up so a mirror that got permanently slower isn't seen as congested forever.
+            self.min_latency = self.min_latency * 1.001
+
+    def set_max_limit(self, max_limit: int):
+        with self.condition:
+            self.max_limit = max_limit
+            self.threshold = min(self.threshold, float(max_limit))
+            self.limit = min(self.limit, float(max_limit))
+            self.condition.notify_all()
+
+    def _decrease(self, now: float, factor: float):
+        if now - self.last_decrease < max(1.0, self.min_latency or 0.0):
+            return
+        self.limit = max(1.0, self.limit * factor)
+        self.threshold = self.limit
+        self.last_decrease = now
+
+
+_host_controllers: dict[tuple[str, str | None, int], HostController] = {}
+_host_controllers_lock = threading.Lock()
+_max_concurrency = 4
+
+
+def set_max_concurrency(max_concurrency: int):
+    global _max_concurrency
+    with _host_controllers_lock:
+        _max_concurrency = max_concurrency
+        for controller in _host_controllers.values():
+            controller.set_max_limit(max_concurrency)
+
+
+def get_host_controller(parse: urllib.parse.ParseResult):
+    key = ConnectionPool.get_key(parse)
+    with _host_controllers_lock:
+        controller = _host_controllers.get(key)
+        if controller is None:
+            controller = HostController(parse.netloc, _max_concurrency)
+            _host_controllers[key] = controller
+        return controller
+
+
+def parse_retry_after(value: str | None):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def check_retryable_status(url: str, response: http.client.HTTPResponse):
+    code = response.getcode()
+    if code == 429 or code >= 500:
+        raise RetryableHTTPError(f"'{url}' returned {code}", parse_retry_after(response.getheader("Retry-After")))
+
+
+def get_backoff_delay(retry: int):
+    # Exponential backoff with full jitter.
+    return random.uniform(0.0, min(BACKOFF_MAX, BACKOFF_BASE * pow(2, retry - 1)))
+
+
+def call_with_retry(parse: urllib.parse.ParseResult, attempt: Callable[[], _T]) -> _T:
+    controller = get_host_controller(parse)
+    retry = 0
+    while True:
+        controller.acquire()
+        try:
+            result = attempt()
+        except CloneDownloadError:
+            controller.release(False)
+            raise
+        except RetryableHTTPError as e:
+            controller.release(False, True, e.retry_after)
+            error = e
+        except (OSError, http.client.HTTPException) as e:
+            controller.release(False, True)
+            error = e
+        except Exception as e:
+            controller.release(False)
+            error = e
+        else:
+            controller.release(True)
+            return result
+
+        retry = retry + 1
+        if retry >= MAX_RETRY:
+            raise error from None
+        time.sleep(get_backoff_delay(retry))
+
+
+@contextlib.contextmanager
+def pooled_response(
+    parse: urllib.parse.ParseResult, method: str, body: bytes | None = None, headers: dict[str, str] | None = None
+):
+    connection = _connection_pool.acquire(parse)
+    try:
+        started = time.monotonic()
+        connection.request(method, get_paths_from_parseresult(parse), body, headers or {})
+        response = connection.getresponse()
+        get_host_controller(parse).record_latency(time.monotonic() - started)
+        yield response
+        # Drain whatever the caller didn't read so the connection can be reused.
+        response.read()
+    except BaseException:
+        connection.close()
+        raise
+
+    if response.will_close:
+        connection.close()
+    else:
+        _connection_pool.release(parse, connection)
+
+
+def request_pooled(
+    parse: urllib.parse.ParseResult, method: str, body: bytes | None = None, headers: dict[str, str] | None = None
+):
+    with pooled_response(parse, method, body, headers) as response:
+        data = response.read()
+    return response, data
 
 
 def get_paths_from_parseresult(parse: urllib.parse.ParseResult):
@@ -137,93 +373,538 @@ def get_paths_from_parseresult(parse: urllib.parse.ParseResult):
     return "".join(s)
 
 
-def download_file_notry(url: str, /, *, redircount: int = 0) -> bytes:
-    global _dl_http_client
-    parse = urllib.parse.urlparse(url)
-
-    _dl_http_client = update_http_client(parse, _dl_http_client)
-    _dl_http_client.request("GET", get_paths_from_parseresult(parse))
-    response = _dl_http_client.getresponse()
-    code = response.getcode()
-
-    if code in (301, 302, 303, 307, 308):
-        # Redirect
-        if redircount > 5:
-            raise RuntimeError(f"'{url}' does not properly setup its redirect")
-        newloc = response.getheader("Location")
-        if newloc is None:
-            raise RuntimeError(f"'{url}' says redirect but no Location header")
-        newparse = urllib.parse.urlparse(newloc)
-        if not newparse.scheme:
-            newparse = newparse._replace(scheme=parse.scheme)
-        if not newparse.netloc:
-            newparse = newparse._replace(netloc=parse.netloc)
-        return download_file_notry(newparse.geturl(), redircount=redircount + 1)
-    if code != 200:
-        raise CloneDownloadError(f"'{url}' returned {code}")
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadHash:
+    def __init__(self):
+        self.md5 = hashlib.md5(usedforsecurity=False)
+        self.sha256 = hashlib.sha256(usedforsecurity=False)
+        self.size = 0
+
+    def update(self, data: bytes):
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.size = self.size + len(data)
+
+    def update_from_file(self, f: IO[bytes]):
+        while True:
+            data = f.read(DOWNLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            self.update(data)
+
+
+def get_redirect_url(url: str, parse: urllib.parse.ParseResult, response: http.client.HTTPResponse, redircount: int):
+    if redircount > 5:
+        raise RuntimeError(f"'{url}' does not properly setup its redirect")
+    newloc = response.getheader("Location")
+    if newloc is None:
+        raise RuntimeError(f"'{url}' says redirect but no Location header")
+    newparse = urllib.parse.urlparse(newloc)
+    if not newparse.scheme:
+        newparse = newparse._replace(scheme=parse.scheme)
+    if not newparse.netloc:
+        newparse = newparse._replace(netloc=parse.netloc)
+    return newparse.geturl()
+
+
+def get_content_range_start(response: http.client.HTTPResponse):
+    # "bytes <start>-<end>/<size>"
+    content_range = response.getheader("Content-Range", "")
+    unit, _, byte_range = content_range.partition(" ")
+    if unit != "bytes":
+        return None
+    try:
+        return int(byte_range.split("-", 1)[0])
+    except ValueError:
+        return None
 
-    return response.read()
 
+def download_file_notry(url: str, part_file: str, hasher: DownloadHash, /, *, redircount: int = 0) -> DownloadHash:
+    parse = urllib.parse.urlparse(url)
+    headers: dict[str, str] = {}
+    if hasher.size > 0:
+        headers["Range"] = f"bytes={hasher.size}-"
+
+    with pooled_response(parse, "GET", None, headers) as response:
+        code = response.getcode()
+
+        if code in (301, 302, 303, 307, 308):
+            newurl = get_redirect_url(url, parse, response, redircount)
+            return download_file_notry(newurl, part_file, hasher, redircount=redircount + 1)
+        if code == 416 and hasher.size > 0:
+            # Partial file is already complete (or bogus, which the hash check will catch).
+            return hasher
+        if code == 200 and hasher.size > 0:
+            # Server ignores ranges. Start over.
+            hasher = DownloadHash()
+        elif code == 206:
+            if get_content_range_start(response) != hasher.size:
+                raise RuntimeError(f"'{url}' returned unexpected range {response.getheader('Content-Range')}")
+        elif code != 200:
+            check_retryable_status(url, response)
+            raise CloneDownloadError(f"'{url}' returned {code}")
+
+        with open(part_file, "r+b" if hasher.size > 0 else "wb") as f:
+            f.seek(hasher.size)
+            f.truncate()
+            while True:
+                data = response.read(DOWNLOAD_CHUNK_SIZE)
+                if not data:
+                    break
+                f.write(data)
+                hasher.update(data)
+            if response.length:
+                # http.client ends the body silently when the connection drops. Keep the partial file to resume.
+                raise http.client.IncompleteRead(b"", response.length)
+
+    return hasher
+
+
+def download_file(url: str, dest: str, checksums: DownloadChecksum, /):
+    """
+    Stream `url` into `dest`, resuming from `dest + ".part"` if it exists. `dest` only appears once the hashes match.
+    """
+    part_file = dest + ".part"
+
+    def attempt():
+        hasher = DownloadHash()
+        if os.path.isfile(part_file):
+            with open(part_file, "rb") as f:
+                hasher.update_from_file(f)
+        resumed = hasher.size > 0
 
-def download_file(url: str, /):
-    retry = 0
-    while True:
         try:
-            return download_file_notry(url)
-        except Exception as e:
-            retry = retry + 1
-            if isinstance(e, CloneDownloadError) or retry >= 25:
-                raise e from None
+            hasher = download_file_notry(url, part_file, hasher)
+            verify_hash(hasher, checksums)
+        except HashMismatchError as e:
+            os.remove(part_file)
+            if resumed:
+                # Stale partial file. Retry from zero.
+                raise RuntimeError(str(e)) from None
+            raise
+        os.replace(part_file, dest)
+        return dest
+
+    return call_with_retry(urllib.parse.urlparse(url), attempt)
 
 
 def call_api_notry(
     api_urlpath: str, shared_key: str, endpoint: str, request_data: dict[str, Any] | list[Any] | None = None, /
 ):
-    global _api_http_client
     parse_api = urllib.parse.urlparse(api_urlpath)
     parse = parse_api._replace(
         path=(parse_api.path if parse_api.path[-1] == "/" else parse_api.path[:-1])
         + (endpoint[1:] if endpoint[0] == "/" else endpoint)
     )
 
-    _api_http_client = update_http_client(parse, _api_http_client)
     header = {}
     if shared_key:
         header["DLAPI-Shared-Key"] = urllib.parse.quote(shared_key)
     if request_data is not None:
         header["Content-Type"] = "application/json"
-    _api_http_client.request(
-        "GET" if request_data is None else "POST", parse.path, json.dumps(request_data).encode("UTF-8"), header
+    response, data = request_pooled(
+        parse._replace(params="", query=""),
+        "GET" if request_data is None else "POST",
+        json.dumps(request_data).encode("UTF-8"),
+        header,
     )
-
-    response = _api_http_client.getresponse()
     code = response.getcode()
     if code != 200:
+        check_retryable_status(parse.geturl(), response)
         raise CloneDownloadError(f"'{parse.geturl()}' returned {code}")
 
-    return json.loads(response.read())
+    return json.loads(data)
 
 
 def call_api(
     api_urlpath: str, shared_key: str, endpoint: str, request_data: dict[str, Any] | list[Any] | None = None, /
 ):
-    retry = 0
-    while True:
-        try:
-            return call_api_notry(api_urlpath, shared_key, endpoint, request_data)
-        except Exception as e:
-            retry = retry + 1
-            if isinstance(e, CloneDownloadError) or retry >= 25:
-                raise e from None
+    return call_with_retry(
+        urllib.parse.urlparse(api_urlpath), lambda: call_api_notry(api_urlpath, shared_key, endpoint, request_data)
+    )
 
 
-def verify_hash(data: bytes, checksums: DownloadChecksum):
-    md5 = hashlib.md5(data, usedforsecurity=False).hexdigest()
-    sha256 = hashlib.sha256(data, usedforsecurity=False).hexdigest()
+def verify_hash(hasher: DownloadHash, checksums: DownloadChecksum):
+    md5 = hasher.md5.hexdigest()
+    sha256 = hasher.sha256.hexdigest()
     if md5 != checksums.md5:
-        raise RuntimeError(f"MD5 does not match. Expected {checksums.md5} got {md5}")
+        raise HashMismatchError(f"MD5 does not match. Expected {checksums.md5} got {md5}")
     if sha256 != checksums.sha256:
-        raise RuntimeError(f"SHA256 does not match. Expected {checksums.sha256} got {sha256}")
+        raise HashMismatchError(f"SHA256 does not match. Expected {checksums.sha256} got {sha256}")
+
+
+@dataclasses.dataclass
+class JournalBatch:
+    id: int
+    version: str
+    expire: int
+
+
+@dataclasses.dataclass
+class JournalItem:
+    id: int
+    group: str
+    seq: int
+    count: int
+    dest: str
+    url: str
+    size: int
+    checksums: DownloadChecksum
+
+
+class DownloadJournal:
+    """
+    SQLite journal of planned downloads.
+
+    A batch is the download plan of one update or package type and an item is one archive in it. Items go from pending
+    to claimed to done, so resuming only has to look up the pending items of the active batches.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS batch (
+        id INTEGER PRIMARY KEY,
+        path TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        package_type INTEGER,
+        version TEXT NOT NULL,
+        expire INTEGER NOT NULL,
+        state INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS batch_path ON batch (path, kind, package_type, state);
+    CREATE TABLE IF NOT EXISTS item (
+        id INTEGER PRIMARY KEY,
+        batch_id INTEGER NOT NULL REFERENCES batch (id),
+        grp TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        dest TEXT NOT NULL,
+        url TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        md5 TEXT NOT NULL,
+        sha256 TEXT NOT NULL,
+        state INTEGER NOT NULL DEFAULT 0,
+        claimed_by TEXT,
+        updated REAL
+    );
+    CREATE INDEX IF NOT EXISTS item_state ON item (batch_id, state);
+    CREATE TABLE IF NOT EXISTS local_file (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        sha256 TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS local_file_sha256 ON local_file (sha256);
+    CREATE TABLE IF NOT EXISTS microdl_archive (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        files TEXT NOT NULL
+    );
+    """
+
+    BATCH_ACTIVE = 0
+    BATCH_FINISHED = 1
+    BATCH_DISCARDED = 2
+
+    ITEM_PENDING = 0
+    ITEM_CLAIMED = 1
+    ITEM_DONE = 2
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(self.SCHEMA)
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def recover(self):
+        # Only one clone instance downloads at a time (see add_lock), so claimed items are from an interrupted run.
+        with self.transaction() as c:
+            c.execute(
+                "UPDATE item SET state = ?, claimed_by = NULL WHERE state = ?", (self.ITEM_PENDING, self.ITEM_CLAIMED)
+            )
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def add_batch(
+        self,
+        path: str,
+        kind: str,
+        package_type: int | None,
+        version: str,
+        expire: int,
+        items: list[tuple[str, int, str, DownloadInfo]],
+    ):
+        with self.transaction() as c:
+            c.execute(
+                "UPDATE batch SET state = ? WHERE path = ? AND kind = ? AND package_type IS ? AND state = ?",
+                (self.BATCH_DISCARDED, path, kind, package_type, self.BATCH_ACTIVE),
+            )
+            batch_id = c.execute(
+                "INSERT INTO batch (path, kind, package_type, version, expire) VALUES (?, ?, ?, ?, ?)",
+                (path, kind, package_type, version, expire),
+            ).lastrowid
+            c.executemany(
+                "INSERT INTO item (batch_id, grp, seq, dest, url, size, md5, sha256, state, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        batch_id,
+                        group,
+                        seq,
+                        dest,
+                        info.url,
+                        info.size,
+                        info.checksums.md5,
+                        info.checksums.sha256,
+                        self.ITEM_DONE if os.path.isfile(dest) else self.ITEM_PENDING,
+                        time.time(),
+                    )
+                    for group, seq, dest, info in items
+                ],
+            )
+        return batch_id
+
+    def get_batch(self, path: str, kind: str, package_type: int | None):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT id, version, expire FROM batch WHERE path = ? AND kind = ? AND package_type IS ? AND state = ?",
+                (path, kind, package_type, self.BATCH_ACTIVE),
+            ).fetchone()
+        if row is None:
+            return None
+        return JournalBatch(*row)
+
+    def set_batch_state(self, batch_id: int, state: int):
+        with self.transaction() as c:
+            c.execute("UPDATE batch SET state = ? WHERE id = ?", (state, batch_id))
+
+    def claim(self, batch_id: int, worker: str):
+        with self.transaction() as c:
+            row = c.execute(
+                "UPDATE item SET state = ?, claimed_by = ?, updated = ? "
+                "WHERE id = (SELECT id FROM item WHERE batch_id = ? AND state = ? ORDER BY id LIMIT 1) "
+                "RETURNING id, grp, seq, "
+                "(SELECT COUNT(*) FROM item AS i WHERE i.batch_id = item.batch_id AND i.grp = item.grp), "
+                "dest, url, size, md5, sha256",
+                (self.ITEM_CLAIMED, worker, time.time(), batch_id, self.ITEM_PENDING),
+            ).fetchone()
+        if row is None:
+            return None
+        return JournalItem(*row[:7], checksums=DownloadChecksum(md5=row[7], sha256=row[8]))
+
+    def set_item_state(self, item_id: int, state: int):
+        with self.transaction() as c:
+            c.execute(
+                "UPDATE item SET state = ?, claimed_by = NULL, updated = ? WHERE id = ?", (state, time.time(), item_id)
+            )
+
+    def get_groups(self, batch_id: int):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT grp, seq, size FROM item WHERE batch_id = ? ORDER BY id", (batch_id,)
+            ).fetchall()
+        groups: dict[str, dict[str, int]] = {}
+        for group, seq, size in rows:
+            groups.setdefault(group, {})[f"{seq}.zip"] = size
+        return groups
+
+    def get_local_files(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT path, size, mtime_ns FROM local_file").fetchall()
+        return {path: (size, mtime_ns) for path, size, mtime_ns in rows}
+
+    def find_local_files(self, sha256: str, size: int) -> list[tuple[str, int]]:
+        with self.lock:
+            return self.connection.execute(
+                "SELECT path, mtime_ns FROM local_file WHERE sha256 = ? AND size = ?", (sha256, size)
+            ).fetchall()
+
+    def record_local_files(self, files: list[tuple[str, int, int, str]]):
+        with self.transaction() as c:
+            c.executemany("INSERT OR REPLACE INTO local_file (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)", files)
+
+    def forget_local_files(self, paths: list[str]):
+        with self.transaction() as c:
+            c.executemany("DELETE FROM local_file WHERE path = ?", [(path,) for path in paths])
+
+    def get_microdl_archives(self, prefix: str):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path, size, mtime_ns, files FROM microdl_archive WHERE substr(path, 1, ?) = ?",
+                (len(prefix), prefix),
+            ).fetchall()
+        return {path: (size, mtime_ns, files) for path, size, mtime_ns, files in rows}
+
+    def record_microdl_archives(self, archives: list[tuple[str, int, int, str]]):
+        with self.transaction() as c:
+            c.executemany(
+                "INSERT OR REPLACE INTO microdl_archive (path, size, mtime_ns, files) VALUES (?, ?, ?, ?)", archives
+            )
+
+    def forget_microdl_archives(self, paths: list[str]):
+        with self.transaction() as c:
+            c.executemany("DELETE FROM microdl_archive WHERE path = ?", [(path,) for path in paths])
+
+    def get_status(self) -> list[tuple[str, str, int | None, str, int, int, int, int]]:
+        with self.lock:
+            return self.connection.execute(
+                "SELECT batch.path, batch.kind, batch.package_type, batch.version, COUNT(item.id), "
+                "COALESCE(SUM(item.state = ?), 0), "
+                "COALESCE(SUM(CASE WHEN item.state = ? THEN item.size END), 0), "
+                "COALESCE(SUM(CASE WHEN item.state != ? THEN item.size END), 0) "
+                "FROM batch LEFT JOIN item ON item.batch_id = batch.id WHERE batch.state = ? "
+                "GROUP BY batch.id ORDER BY batch.id",
+                (self.ITEM_DONE, self.ITEM_DONE, self.ITEM_DONE, self.BATCH_ACTIVE),
+            ).fetchall()
+
+
+class DownloadEngine:
+    """
+    Runs archive downloads on a pool of worker threads sharing the keep-alive connection pool.
+    """
+
+    def __init__(self, jobs: int, dedup: str = "link"):
+        self.jobs = jobs
+        self.dedup = dedup
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="download")
+        _connection_pool.set_max_idle_per_host(jobs)
+        set_max_concurrency(jobs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(exc_type is not None)
+
+    def close(self, cancel: bool = False):
+        self.executor.shutdown(wait=True, cancel_futures=cancel)
+        _connection_pool.close()
+
+    def run_batch(self, journal: DownloadJournal, batch_id: int, message: Callable[[JournalItem], str]):
+        stop = threading.Event()
+
+        def work(worker: str):
+            while not stop.is_set():
+                item = journal.claim(batch_id, worker)
+                if item is None:
+                    return
+                try:
+                    if not copy_local_duplicate(journal, item, self.dedup):
+                        print(message(item), item.dest)
+                        download_file(item.url, item.dest, item.checksums)
+                    stat = os.stat(item.dest)
+                    journal.record_local_files([(item.dest, stat.st_size, stat.st_mtime_ns, item.checksums.sha256)])
+                except BaseException:
+                    stop.set()
+                    journal.set_item_state(item.id, DownloadJournal.ITEM_PENDING)
+                    raise
+                journal.set_item_state(item.id, DownloadJournal.ITEM_DONE)
+
+        futures = [self.executor.submit(work, f"{os.getpid()}/{i}") for i in range(self.jobs)]
+        for future in futures:
+            future.result()
+
+
+def hash_file_sha256(path: str):
+    sha256 = hashlib.sha256(usedforsecurity=False)
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(DOWNLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+def index_local_files(journal: DownloadJournal, root: str):
+    """
+    Bring the journal's index of local archives up to date with what's on disk.
+
+    Hashes are taken from `infov2.json` written by `update_v1.1.py` where available. Other archives are hashed once,
+    later runs only stat them.
+    """
+    known = journal.get_local_files()
+    found: set[str] = set()
+    new_files: list[tuple[str, int, int, str]] = []
+
+    print("Indexing local archives.")
+    for dirpath, _, filenames in os.walk(root):
+        dirpath = dirpath.replace("\\", "/")
+        infov2: dict[str, dict[str, Any]] | None = None
+        for name in filenames:
+            if not name.endswith(".zip"):
+                continue
+            path = f"{dirpath}/{name}"
+            stat = os.stat(path)
+            found.add(path)
+            if known.get(path) == (stat.st_size, stat.st_mtime_ns):
+                continue
+
+            if infov2 is None:
+                try:
+                    infov2 = {info["name"]: info for info in read_json_file(dirpath + "/infov2.json")}
+                except (IOError, ValueError, KeyError, TypeError):
+                    infov2 = {}
+            info = infov2.get(name)
+            if info is not None and info.get("size") == stat.st_size and "sha256" in info:
+                sha256: str = info["sha256"]
+            else:
+                print("Hashing", path)
+                sha256 = hash_file_sha256(path)
+            new_files.append((path, stat.st_size, stat.st_mtime_ns, sha256))
+
+    journal.record_local_files(new_files)
+    journal.forget_local_files([path for path in known if path not in found])
+
+
+def copy_local_duplicate(journal: DownloadJournal, item: JournalItem, mode: str):
+    if mode == "off":
+        return False
+
+    for source, mtime_ns in journal.find_local_files(item.checksums.sha256, item.size):
+        try:
+            stat = os.stat(source)
+        except OSError:
+            continue
+        if source == item.dest or stat.st_size != item.size or stat.st_mtime_ns != mtime_ns:
+            continue
+
+        if mode == "link":
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(item.dest)
+            try:
+                os.link(source, item.dest)
+                print("Linked", source, "to", item.dest)
+                return True
+            except OSError:
+                # Different filesystem or no hardlink support. Copy instead.
+                pass
+        part_file = item.dest + ".part"
+        shutil.copyfile(source, part_file)
+        os.replace(part_file, item.dest)
+        print("Copied", source, "to", item.dest)
+        return True
+
+    return False
 
 
 def read_json_file(path: str):
@@ -232,8 +913,11 @@ def read_json_file(path: str):
 
 
 def write_json_file(path: str, data):
-    with open(path, "w", encoding="UTF-8") as f:
+    # Write to temporary file first so readers never see a partially written file.
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="UTF-8") as f:
         json.dump(data, f)
+    os.replace(temp_path, path)
 
 
 def to_sifversion(ver: str):
@@ -241,48 +925,42 @@ def to_sifversion(ver: str):
     return int(s[0]), int(s[1])
 
 
-def continue_update(path: str):
+def load_legacy_pickle(pickle_file: str):
+    # Resume state written before the download journal existed.
+    if not os.path.exists(pickle_file):
+        return None
+    with open(pickle_file, "rb") as f:
+        info: UpdateInfo | PackageInfo = pickle.load(f)
+    return info
+
+
+def get_active_batch(journal: DownloadJournal, path: str, kind: str, package_type: int | None):
+    batch = journal.get_batch(path, kind, package_type)
+    if batch is not None and int(time.time()) >= batch.expire:
+        # Archives that are already done stay on disk and are skipped when the links are requested again.
+        print("Links expired, discarding download plan:", kind, path, "" if package_type is None else package_type)
+        journal.set_batch_state(batch.id, DownloadJournal.BATCH_DISCARDED)
+        return None
+    return batch
+
+
+def continue_update(path: str, engine: DownloadEngine, journal: DownloadJournal):
     update_pickle = path + "/update.pickle"
-    if not os.path.exists(update_pickle):
+    legacy_info = load_legacy_pickle(update_pickle)
+    if isinstance(legacy_info, UpdateInfo):
+        plan_update(journal, path, legacy_info)
+        os.remove(update_pickle)
+
+    batch = get_active_batch(journal, path, "update", None)
+    if batch is None:
         return
-    with open(update_pickle, "rb") as f:
-        update_info: UpdateInfo = pickle.load(f)
-        if int(time.time()) >= update_info.expire:
-            raise RuntimeError(f"Links expired. Please delete {update_pickle} and try again!")
 
     print("Starting download update:", path)
-    # Separate download links by versions
-    by_versions: dict[str, list[DownloadUpdateInfo]] = {}
-    for info in update_info.update:
-        by_versions.setdefault(info.version, []).append(info)
+    engine.run_batch(journal, batch.id, lambda item: f"Downloading update file {item.seq}/{item.count}")
 
-    # Iterate versions
-    for version, updates in by_versions.items():
-        version_path = f"{path}/update/{version}"
-        info_file = version_path + "/info.json"
-        os.makedirs(version_path, exist_ok=True)
-
-        if not os.path.exists(info_file):
-            # We assume SIF server provide the files in-order.
-            i = 1
-            update_count = len(updates)
-            infotuple: list[tuple[str, int]] = []
-            archives: list[str] = []
-
-            for update in updates:
-                archive_dest = f"{version_path}/{i}.zip"
-
-                if not os.path.exists(archive_dest):
-                    print(f"Downloading update file {i}/{update_count}", archive_dest)
-                    archive = download_file(update.url)
-                    verify_hash(archive, update.checksums)
-                    with open(archive_dest, "wb") as f:
-                        f.write(archive)
-                    archives.append(archive_dest)
-
-                infotuple.append((f"{i}.zip", update.size))
-                i = i + 1
-            write_json_file(info_file, dict(infotuple))
+    # Every archive in the batch is done, write info.json of each version in order.
+    for version, info_data in journal.get_groups(batch.id).items():
+        write_json_file(f"{path}/update/{version}/info.json", info_data)
 
     # Add new version list
     versionlist_path = f"{path}/update/info.json"
@@ -290,15 +968,31 @@ def continue_update(path: str):
         versionlist: list[str] = read_json_file(versionlist_path)
     else:
         versionlist = []
-    if update_info.version not in versionlist:
-        versionlist.append(update_info.version)
+    if batch.version not in versionlist:
+        versionlist.append(batch.version)
         write_json_file(versionlist_path, versionlist)
 
-    # Remove temporary update file
-    os.remove(update_pickle)
+    journal.set_batch_state(batch.id, DownloadJournal.BATCH_FINISHED)
 
 
-def prepare_update(path: str, target_client: str, data: list[dict], expire: int):
+def plan_update(journal: DownloadJournal, path: str, update_info: UpdateInfo):
+    # Separate download links by versions
+    by_versions: dict[str, list[DownloadUpdateInfo]] = {}
+    for info in update_info.update:
+        by_versions.setdefault(info.version, []).append(info)
+
+    items: list[tuple[str, int, str, DownloadInfo]] = []
+    for version, updates in by_versions.items():
+        version_path = f"{path}/update/{version}"
+        if not os.path.exists(version_path + "/info.json"):
+            os.makedirs(version_path, exist_ok=True)
+            # We assume SIF server provide the files in-order.
+            items.extend((version, i, f"{version_path}/{i}.zip", update) for i, update in enumerate(updates, 1))
+
+    journal.add_batch(path, "update", None, update_info.version, update_info.expire, items)
+
+
+def prepare_update(journal: DownloadJournal, path: str, target_client: str, data: list[dict], expire: int):
     update_info = UpdateInfo(
         version=target_client,
         update=[
@@ -312,9 +1006,7 @@ def prepare_update(path: str, target_client: str, data: list[dict], expire: int)
         ],
         expire=expire,
     )
-    update_pickle = path + "/update.pickle"
-    with open(update_pickle, "wb") as f:
-        pickle.dump(update_info, f)
+    plan_update(journal, path, update_info)
 
 
 def move_all_batches(files: list[tuple[str, int]], dest: str):
@@ -336,60 +1028,75 @@ def move_all_batches(files: list[tuple[str, int]], dest: str):
         os.remove(file)
 
 
-def continue_batch_download(path: str, package_type: int):
+def continue_batch_download(path: str, package_type: int, engine: DownloadEngine, journal: DownloadJournal):
     update_pickle = f"{path}/package_{package_type}.pickle"
-    if not os.path.exists(update_pickle):
+    legacy_info = load_legacy_pickle(update_pickle)
+    if isinstance(legacy_info, PackageInfo):
+        plan_batch_download(journal, path, package_type, legacy_info)
+        os.remove(update_pickle)
+
+    batch = get_active_batch(journal, path, "package", package_type)
+    if batch is None:
         return
-    with open(update_pickle, "rb") as f:
-        package_info: PackageInfo = pickle.load(f)
-        if int(time.time()) >= package_info.expire:
-            raise RuntimeError(f"Links expired. Please delete {update_pickle} and try again!")
 
-    current_package_path = f"{path}/{package_info.version}/{package_type}"
-    os.makedirs(current_package_path, exist_ok=True)
     print("Starting batch download:", package_type, path)
+    engine.run_batch(
+        journal, batch.id, lambda item: f"Downloading package {package_type}/{item.group} file {item.seq}/{item.count}"
+    )
 
+    current_package_path = f"{path}/{batch.version}/{package_type}"
+    for package_id, info_data in journal.get_groups(batch.id).items():
+        write_json_file(f"{current_package_path}/{package_id}/info.json", info_data)
+
+    # Write info.json
+    print("Building info.json for package type", package_type)
+    # Packages completed by earlier runs are listed as well.
+    package_ids = [
+        int(d.name)
+        for d in os.scandir(current_package_path)
+        if d.name.isdigit() and os.path.isfile(d.path + "/info.json")
+    ]
+    write_json_file(f"{current_package_path}/info.json", sorted(package_ids))
+    journal.set_batch_state(batch.id, DownloadJournal.BATCH_FINISHED)
+
+
+def plan_batch_download(
+    journal: DownloadJournal, path: str, package_type: int, package_info: PackageInfo, replace: bool = False
+):
+    current_package_path = f"{path}/{package_info.version}/{package_type}"
     by_package_id: dict[int, list[DownloadPackageInfo]] = {}
     for info in package_info.update:
         by_package_id.setdefault(info.package_id, []).append(info)
 
-    # Download files
+    items: list[tuple[str, int, str, DownloadInfo]] = []
     for package_id, updates in by_package_id.items():
         target_path = f"{current_package_path}/{package_id}"
-        info_file = target_path + "/info.json"
-        os.makedirs(target_path, exist_ok=True)
-
-        if not os.path.exists(info_file):
+        if replace and os.path.exists(target_path + "/info.json"):
+            # Changed on the server. Incomplete until it's downloaded again, and archives that differ must not be
+            # taken as already downloaded.
+            os.remove(target_path + "/info.json")
+            for i, update in enumerate(updates, 1):
+                dest = f"{target_path}/{i}.zip"
+                if os.path.isfile(dest) and hash_file_sha256(dest) != update.checksums.sha256:
+                    os.remove(dest)
+        if not os.path.exists(target_path + "/info.json"):
+            os.makedirs(target_path, exist_ok=True)
             # Actually download file instead of skipping them
-            i = 1
-            update_count = len(updates)
-            infotuple: list[tuple[str, int]] = []
-            archives: list[str] = []
-
-            for update in updates:
-                archive_dest = f"{target_path}/{i}.zip"
-
-                if not os.path.exists(archive_dest):
-                    print(f"Downloading package {package_type}/{package_id} file {i}/{update_count}", archive_dest)
-                    archive = download_file(update.url)
-                    verify_hash(archive, update.checksums)
-                    with open(archive_dest, "wb") as f:
-                        f.write(archive)
-                    archives.append(archive_dest)
-
-                infotuple.append((f"{i}.zip", update.size))
-                i = i + 1
-            write_json_file(info_file, dict(infotuple))
+            items.extend((str(package_id), i, f"{target_path}/{i}.zip", update) for i, update in enumerate(updates, 1))
 
-    # Write info.json
-    print("Building info.json for package type", package_type)
-    write_json_file(f"{current_package_path}/info.json", sorted(by_package_id.keys()))
-    # Remove temporary update file
-    os.remove(update_pickle)
+    journal.add_batch(path, "package", package_type, package_info.version, package_info.expire, items)
 
 
-def prepare_batch_download(path: str, target_client: str, package_type: int, data: list[dict], expire: int):
-    update_info = PackageInfo(
+def prepare_batch_download(
+    journal: DownloadJournal,
+    path: str,
+    target_client: str,
+    package_type: int,
+    data: list[dict],
+    expire: int,
+    replace: bool = False,
+):
+    package_info = PackageInfo(
         update=[
             DownloadPackageInfo(
                 url=d["url"],
@@ -402,36 +1109,88 @@ def prepare_batch_download(path: str, target_client: str, package_type: int, dat
         version=target_client,
         expire=expire,
     )
-    update_pickle = f"{path}/package_{package_type}.pickle"
-    with open(update_pickle, "wb") as f:
-        pickle.dump(update_info, f)
+    plan_batch_download(journal, path, package_type, package_info, replace)
 
 
-def continue_download(root: str, oses: list[str]):
+def continue_download(root: str, oses: list[str], engine: DownloadEngine, journal: DownloadJournal):
     print("Resuming incomplete downloads.")
     for sif_os in oses:
-        continue_update(f"{root}/{sif_os}")
+        continue_update(f"{root}/{sif_os}", engine, journal)
     for sif_os, pkg_type in itertools.product(oses, range(0, 7)):
-        continue_batch_download(f"{root}/{sif_os}/package", pkg_type)
+        continue_batch_download(f"{root}/{sif_os}/package", pkg_type, engine, journal)
 
 
-def make_microdl_map(package_dir: str):
-    info_json: list[int] = read_json_file(f"{package_dir}/4/info.json")
-    file_map: dict[str, str] = {}
+def format_size(size: float):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size = size / 1024
+    return f"{size:.1f} TiB"
+
+
+def print_status(root: str):
+    journal_path = get_journal_path(root)
+    if not os.path.isfile(journal_path):
+        print("No download journal in", root)
+        return
+
+    total_done = 0
+    total_remaining = 0
+    with DownloadJournal(journal_path) as journal:
+        for path, kind, package_type, version, count, done, done_bytes, remaining_bytes in journal.get_status():
+            name = kind if package_type is None else f"{kind} {package_type}"
+            print(
+                f"{path} {name} ({version}): {done}/{count} files, "
+                f"{format_size(done_bytes)} done, {format_size(remaining_bytes)} remaining"
+            )
+            total_done = total_done + done_bytes
+            total_remaining = total_remaining + remaining_bytes
+    print(f"Total: {format_size(total_done)} done, {format_size(total_remaining)} remaining")
 
-    # Iterate
+
+def list_zip_files(archive_name: str):
+    with zipfile.ZipFile(archive_name) as z:
+        return [info.filename for info in z.infolist()]
+
+
+def make_microdl_map(package_dir: str, engine: DownloadEngine, journal: DownloadJournal):
+    info_json: list[int] = read_json_file(f"{package_dir}/4/info.json")
+    archives: list[str] = []
     for id in info_json:
         archive_list: dict[str, int] = read_json_file(f"{package_dir}/4/{id}/info.json")
-        for i in range(1, len(archive_list) + 1):
-            archive_name = f"{package_dir}/4/{id}/{i}.zip"
-            print("Scanning", archive_name)
-            with zipfile.ZipFile(archive_name) as z:
-                for info in z.infolist():
-                    file_map[info.filename] = archive_name
+        archives.extend(f"{package_dir}/4/{id}/{i}.zip" for i in range(1, len(archive_list) + 1))
+
+    # Only read central directories of archives that are new or changed since the last run.
+    previous = journal.get_microdl_archives(f"{package_dir}/4/")
+    current: dict[str, tuple[int, int]] = {}
+    for archive_name in archives:
+        stat = os.stat(archive_name)
+        current[archive_name] = (stat.st_size, stat.st_mtime_ns)
+    changed = [
+        archive_name for archive_name in archives if previous.get(archive_name, (0, 0, ""))[:2] != current[archive_name]
+    ]
+    map_path = f"{package_dir}/microdl_map.json"
+    if not changed and previous.keys() == current.keys() and os.path.isfile(map_path):
+        print("microdl_map.json is up-to-date")
+        return
+
+    print(f"Scanning {len(changed)} of {len(archives)} archives for microdl_map.json")
+    scanned = dict(zip(changed, engine.executor.map(list_zip_files, changed)))
+    journal.record_microdl_archives(
+        [(archive_name, *current[archive_name], json.dumps(files)) for archive_name, files in scanned.items()]
+    )
+    journal.forget_microdl_archives([archive_name for archive_name in previous if archive_name not in current])
+
+    # Later archives take precedence, same as scanning them in order.
+    file_map: dict[str, str] = {}
+    for archive_name in archives:
+        files: list[str] = scanned[archive_name] if archive_name in scanned else json.loads(previous[archive_name][2])
+        for filename in files:
+            file_map[filename] = archive_name
 
     # Write microdl_map.json
     print("Writing microdl_map.json")
-    write_json_file(f"{package_dir}/microdl_map.json", file_map)
+    write_json_file(map_path, file_map)
 
 
 def get_expiry_time_string(dt: int):
@@ -487,10 +1246,68 @@ def get_latest_version(root: str):
     return None
 
 
-def archive_main(root: str, apiurl: str, shared_key: str, oses: list[str], base_version: tuple[int, int]):
+def archive_main(
+    root: str,
+    apiurl: str,
+    shared_key: str,
+    oses: list[str],
+    base_version: tuple[int, int],
+    jobs: int = 4,
+    dedup: str = "link",
+):
+    os.makedirs(root, exist_ok=True)
+    with DownloadJournal(get_journal_path(root)) as journal, DownloadEngine(jobs, dedup) as engine:
+        archive_main_with_engine(root, apiurl, shared_key, oses, base_version, engine, journal)
+
+
+def get_journal_path(root: str):
+    return f"{root}/clone_journal.db"
+
+
+def get_delta_token_path(root: str):
+    return f"{root}/clone_delta.json"
+
+
+def read_delta_tokens(root: str, apiurl: str):
+    """
+    Delta tokens of each OS whose last sync from this mirror completed.
+    """
+    token_path = get_delta_token_path(root)
+    if os.path.isfile(token_path):
+        state: dict[str, Any] = read_json_file(token_path)
+        # Tokens are only meaningful to the mirror that gave them.
+        if state.get("mirror") == apiurl:
+            tokens: dict[str, str] = state.get("tokens", {})
+            return tokens
+    return {}
+
+
+def get_package_delta(apiurl: str, shared_key: str, token: str | None):
+    """
+    Ask the mirror for packages changed since the sync that got `token`. Returns None if the mirror doesn't support it.
+    """
+    try:
+        delta: dict[str, Any] = call_api(apiurl, shared_key, "api/app/delta", {"token": token})
+    except CloneDownloadError:
+        return None
+    return delta
+
+
+def archive_main_with_engine(
+    root: str,
+    apiurl: str,
+    shared_key: str,
+    oses: list[str],
+    base_version: tuple[int, int],
+    engine: DownloadEngine,
+    journal: DownloadJournal,
+):
     for sif_os in oses:
         os.makedirs(f"{root}/{sif_os}/package", exist_ok=True)
-    continue_download(root, oses)
+    journal.recover()
+    if engine.dedup != "off":
+        index_local_files(journal, root)
+    continue_download(root, oses, engine, journal)
 
     # Call public info API
     print("Calling public info API...")
@@ -526,30 +1343,56 @@ def archive_main(root: str, apiurl: str, shared_key: str, oses: list[str], base_
                 "api/v1/update",
                 {"version": "%d.%d" % max(latest_version, base_version), "platform": remap_os(sif_os)},
             )
-            prepare_update(f"{root}/{sif_os}", target_client_str, update_links, get_expiry_time(serve_time_limit))
+            prepare_update(
+                journal, f"{root}/{sif_os}", target_client_str, update_links, get_expiry_time(serve_time_limit)
+            )
         for sif_os in oses:
-            continue_update(f"{root}/{sif_os}")
+            continue_update(f"{root}/{sif_os}", engine, journal)
+
+    # Get package. Only OSes whose last sync from this mirror completed can use delta, the rest compare every
+    # package.
+    old_tokens = read_delta_tokens(root, apiurl)
+    new_tokens: dict[str, str] = {}
+    deltas: dict[str, dict[str, Any]] = {}
+    for token in set(old_tokens.get(sif_os) for sif_os in oses):
+        delta = get_package_delta(apiurl, shared_key, token)
+        if delta is None:
+            break
+        for sif_os in filter(lambda x: old_tokens.get(x) == token, oses):
+            new_tokens[sif_os] = delta["token"]
+            if delta["complete"] and delta["gameVersion"] == target_client_str:
+                deltas[sif_os] = delta
 
-    # Get package
     for sif_os, pkg_type in os_package_combination:
         path = f"{root}/{sif_os}/package"
-        info_path = f"{path}/{target_client}/{pkg_type}/info.json"
-        if os.path.exists(info_path):
-            exclude: list[int] = read_json_file(info_path)
+        if sif_os in deltas:
+            batch_links: list[dict] = [
+                d for d in deltas[sif_os]["items"] if d["platform"] == remap_os(sif_os) and d["packageType"] == pkg_type
+            ]
+            if len(batch_links) > 0:
+                prepare_batch_download(
+                    journal, path, target_client_str, pkg_type, batch_links, get_expiry_time(serve_time_limit), True
+                )
         else:
-            exclude = []
-        batch_links: list[dict] = call_api(
-            apiurl,
-            shared_key,
-            "api/v1/batch",
-            {"package_type": pkg_type, "platform": remap_os(sif_os), "exclude": exclude},
-        )
-        if len(batch_links) > 0:
-            prepare_batch_download(path, target_client_str, pkg_type, batch_links, get_expiry_time(serve_time_limit))
+            info_path = f"{path}/{target_client_str}/{pkg_type}/info.json"
+            if os.path.exists(info_path):
+                exclude: list[int] = read_json_file(info_path)
+            else:
+                exclude = []
+            batch_links = call_api(
+                apiurl,
+                shared_key,
+                "api/v1/batch",
+                {"package_type": pkg_type, "platform": remap_os(sif_os), "exclude": exclude},
+            )
+            if len(batch_links) > 0:
+                prepare_batch_download(
+                    journal, path, target_client_str, pkg_type, batch_links, get_expiry_time(serve_time_limit)
+                )
     for sif_os, pkg_type in os_package_combination:
-        continue_batch_download(f"{root}/{sif_os}/package", pkg_type)
+        continue_batch_download(f"{root}/{sif_os}/package", pkg_type, engine, journal)
     for sif_os in oses:
-        make_microdl_map(f"{root}/{sif_os}/package/{target_client_str}")
+        make_microdl_map(f"{root}/{sif_os}/package/{target_client_str}", engine, journal)
 
     for sif_os in oses:
         versionlist_path = f"{root}/{sif_os}/package/info.json"
@@ -566,12 +1409,17 @@ def archive_main(root: str, apiurl: str, shared_key: str, oses: list[str], base_
     release_keys: dict[str, str] = call_api(apiurl, shared_key, "api/v1/release_info")
     write_json_file(f"{root}/release_info.json", release_keys)
 
+    if new_tokens:
+        # Only now that everything up to these generations is downloaded. Tokens of OSes not synced this time stay.
+        write_json_file(get_delta_token_path(root), {"mirror": apiurl, "tokens": old_tokens | new_tokens})
+
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("destination", help="Where to store the mirrored files.")
     parser.add_argument(
         "mirror",
+        nargs="?",
         help=f"URL to a site (with path) that talks with NPPS4 DLAPI v{NEED_DLAPI_VERSION[0]}.{NEED_DLAPI_VERSION[1]} protocol.",
     )
     parser.add_argument("--no-ios", help="Don't download iOS files.", action="store_true")
@@ -583,7 +1431,27 @@ def main():
         default=(59, 0),
         type=to_sifversion,
     )
+    parser.add_argument(
+        "-j", "--jobs", help="Number of archives to download in parallel (default 4).", default=4, type=int
+    )
+    parser.add_argument(
+        "--dedup",
+        help="Reuse local archives with matching SHA256 instead of downloading them (default link).",
+        choices=["link", "copy", "off"],
+        default="link",
+    )
+    parser.add_argument(
+        "--status", help="Show progress of incomplete downloads in destination and exit.", action="store_true"
+    )
     args = parser.parse_args()
+    root: str = args.destination.replace("\\", "/")
+    root = root[:-1] if root[-1] == "/" else root
+    if args.status:
+        return print_status(root)
+    if args.mirror is None:
+        parser.error("the following arguments are required: mirror")
+    if args.jobs < 1:
+        raise RuntimeError("At least 1 job is required.")
 
     oses: list[str] = []
     if not args.no_ios:
@@ -593,11 +1461,17 @@ def main():
     if not oses:
         raise RuntimeError("Nothing downloaded.")
 
-    root: str = args.destination.replace("\\", "/")
     mirror: str = (args.mirror + "/") if args.mirror[-1] != "/" else args.mirror
     if not mirror.startswith("http://") and (not mirror.startswith("https://")):
         mirror = "https://" + mirror
-    return archive_main(root[:-1] if root[-1] == "/" else root, mirror, args.shared_key, oses, args.base_version)
+
+    if not add_lock():
+        print("An instance already running")
+        return
+    try:
+        return archive_main(root, mirror, args.shared_key, oses, args.base_version, args.jobs, args.dedup)
+    finally:
+        remove_lock()
 
 
 def add_lock():
@@ -615,10 +1489,4 @@ def remove_lock():
 
 
 if __name__ == "__main__":
-    if add_lock():
-        try:
-            main()
-        finally:
-            remove_lock()
-    else:
-        print("An instance already running")
+    main()
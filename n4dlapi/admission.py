@@ -0,0 +1,138 @@
+# Copyright (c) 2023 Dark Energy Processor
+#
+# This software is provided 'as-is', without any express or implied
+# warranty. In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+
+import json
+
+import anyio
+import starlette.types
+
+from . import config
+
+from typing import Any
+
+
+class Limiter:
+    """
+    Admits up to `max_concurrent` requests at a time, with up to `max_queue` more waiting at most `queue_timeout`
+    seconds for a slot. Anything beyond that is rejected right away.
+
+    Must be released by the same task that acquired it.
+    """
+
+    def __init__(self, limits: dict[str, Any]):
+        self.max_concurrent: int = limits["max_concurrent"]
+        self.max_queue: int = limits["max_queue"]
+        self.queue_timeout: float = limits["queue_timeout"]
+        self.retry_after: int = limits["retry_after"]
+        # Unlike a semaphore behind asyncio.wait_for, a slot handed over just as the wait times out is given back.
+        self.limiter = anyio.CapacityLimiter(self.max_concurrent)
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    async def acquire(self):
+        if self.limiter.available_tokens == 0:
+            if self.waiting >= self.max_queue:
+                self.rejected = self.rejected + 1
+                return False
+            self.waiting = self.waiting + 1
+            try:
+                with anyio.fail_after(self.queue_timeout):
+                    await self.limiter.acquire()
+            except TimeoutError:
+                self.rejected = self.rejected + 1
+                return False
+            finally:
+                self.waiting = self.waiting - 1
+        else:
+            await self.limiter.acquire()
+        self.active = self.active + 1
+        self.admitted = self.admitted + 1
+        return True
+
+    def release(self):
+        self.active = self.active - 1
+        self.limiter.release()
+
+    def get_stats(self):
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "maxConcurrent": self.max_concurrent,
+            "maxQueue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+
+_limiters: dict[str, Limiter] = {}
+
+
+def get_limiter(path: str):
+    limits = config.get_endpoint_limits(path)
+    if limits is None:
+        return None
+    limiter = _limiters.get(limits[0])
+    if limiter is None:
+        # Only touched from the event loop thread, so no lock needed.
+        limiter = Limiter(limits[1])
+        _limiters[limits[0]] = limiter
+    return limiter
+
+
+def get_stats():
+    return {endpoint: limiter.get_stats() for endpoint, limiter in sorted(_limiters.items())}
+
+
+class AdmissionControl:
+    """
+    ASGI middleware applying the per-endpoint concurrency limits from config, so slow endpoints can't take all the
+    workers from the cheap ones. Rejected requests get 503 with Retry-After.
+    """
+
+    def __init__(self, app: starlette.types.ASGIApp):
+        self.app = app
+
+    async def __call__(
+        self, scope: starlette.types.Scope, receive: starlette.types.Receive, send: starlette.types.Send
+    ):
+        limiter = get_limiter(scope["path"]) if scope["type"] == "http" else None
+        if limiter is None:
+            return await self.app(scope, receive, send)
+
+        if not await limiter.acquire():
+            body = json.dumps({"detail": "Server is busy"}).encode("UTF-8")
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 503,
+                    "headers": [
+                        (b"content-type", b"application/json"),
+                        (b"content-length", str(len(body)).encode("latin-1")),
+                        (b"retry-after", str(limiter.retry_after).encode("latin-1")),
+                    ],
+                }
+            )
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
@@ -0,0 +1,127 @@
+# Copyright (c) 2023 Dark Energy Processor
+#
+# This software is provided 'as-is', without any express or implied
+# warranty. In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+
+import hashlib
+import json
+import os
+import threading
+
+from . import config
+from . import file
+from . import memo
+
+
+class ChangeLog:
+    """
+    Packages added or changed by each archive-root generation, so mirrors can fetch only what changed since their last
+    sync.
+
+    Holds a digest of the manifest of every package of the last seen generation to compare the next one against, and
+    the changed package paths of up to `max_generations` generations. Kept in `log_file`, if any, so tokens stay valid across restarts.
+
+    Generations are recorded by the archive-root watcher before they are activated. An archive-root updated in place
+    without the watcher running is recorded by the first delta request that sees it.
+    """
+
+    def __init__(self, log_file: str | None, max_generations: int):
+        self.log_file = log_file
+        self.max_generations = max_generations
+        self.token: str | None = None
+        self.snapshot: dict[str, bytes] = {}
+        # Generation token and paths changed since the previous one, oldest first.
+        self.entries: list[tuple[str, list[str]]] = []
+        self.lock = threading.Lock()
+        # Held while comparing, so concurrent callers wait for a single scan.
+        self.record_lock = threading.Lock()
+        if log_file is not None and os.path.isfile(log_file):
+            with open(log_file, "r", encoding="UTF-8", newline="") as f:
+                data: dict = json.load(f)
+            self.token = data["token"]
+            self.snapshot = {path: bytes.fromhex(sha256) for path, sha256 in data["snapshot"].items()}
+            self.entries = [(token, paths) for token, paths in data["entries"]]
+
+    def save(self):
+        if self.log_file is None:
+            return
+        data = {
+            "token": self.token,
+            "snapshot": {path: sha256.hex() for path, sha256 in self.snapshot.items()},
+            "entries": self.entries,
+        }
+        temp_file = self.log_file + ".tmp"
+        with open(temp_file, "w", encoding="UTF-8", newline="") as f:
+            json.dump(data, f)
+        os.replace(temp_file, self.log_file)
+
+    def record(self):
+        """
+        Compare packages of the archive-root generation in use by the caller against the last recorded one, unless it's
+        recorded already.
+        """
+        with self.record_lock:
+            with memo.up_to_date():
+                generation = file.get_archive_generation()
+                if self.has_generation(generation):
+                    return
+                snapshot = {
+                    path: hashlib.sha256("/".join(m.names).encode("UTF-8") + m.sha256, usedforsecurity=False).digest()
+                    for path, m in file.iter_packages()
+                }
+
+            changed = [path for path, sha256 in snapshot.items() if self.snapshot.get(path) != sha256]
+            with self.lock:
+                # Everything is new to a mirror with no token anyway, so the first generation records nothing.
+                self.entries.append((generation, changed if self.token is not None else []))
+                del self.entries[: -self.max_generations]
+                self.token = generation
+                self.snapshot = snapshot
+                self.save()
+
+    def has_generation(self, generation: str):
+        with self.lock:
+            return any(token == generation for token, _ in self.entries)
+
+    def get_delta(self, since: str | None, until: str):
+        """
+        Returns paths of packages changed after generation `since` up to generation `until`, or None if either of them
+        is unknown or `since` is too old.
+        """
+        with self.lock:
+            tokens = [token for token, _ in self.entries]
+            if since not in tokens or until not in tokens:
+                return None
+            start, end = tokens.index(since), tokens.index(until)
+            if start > end:
+                return None
+            changed: set[str] = set()
+            for _, paths in self.entries[start + 1 : end + 1]:
+                changed.update(paths)
+            return sorted(changed)
+
+
+_changelog: ChangeLog | None = None
+_changelog_lock = threading.Lock()
+
+
+def get_changelog():
+    global _changelog
+
+    with _changelog_lock:
+        if _changelog is None:
+            _changelog = ChangeLog(config.get_changelog_file(), config.get_changelog_max_generations())
+        return _changelog
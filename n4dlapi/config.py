@@ -16,6 +16,7 @@
 #    misrepresented as being the original software.
 # 3. This notice may not be removed or altered from any source distribution.
 
+import contextvars
 import json
 import os
 
@@ -30,7 +31,43 @@ from typing import Any
 main_public = True
 shared_key = None
 archive_root = "archive-root"
+archive_root_link = "archive-root"
+archive_root_check_interval = 5
+# Archive-root used by the current request, so it sees a single generation even if a new one is activated meanwhile.
+archive_root_pin: contextvars.ContextVar[str] = contextvars.ContextVar("archive_root_pin")
 api_publicness: dict[str, Any] = {}
+database_lazy = False
+database_cache_size = 64 * 1024 * 1024
+database_spill_dir: str | None = None
+http_cache_max_age = 0
+compression_encodings: list[str] = []
+compression_min_size = 1024
+compression_levels: dict[str, int] = {}
+compression_cache_size = 32 * 1024 * 1024
+signing_time_limit = 0
+signing_secret: bytes | None = None
+download_origins: list[str] = []
+download_shard = "path"
+download_health_path = "generation.json"
+download_health_interval = 30
+archive_root_shaping: dict[str, Any] = {}
+endpoint_limits: dict[str, dict[str, Any]] = {}
+manifest_cache_size = 256 * 1024 * 1024
+manifest_cache_pin: list[str] = []
+small_file_cache_size = 64 * 1024 * 1024
+small_file_max_size = 256 * 1024
+pagecache_warm_budget = 0
+pagecache_readahead = 8 * 1024 * 1024
+pagecache_stats_file: str | None = None
+changelog_file: str | None = None
+changelog_max_generations = 100
+DEFAULT_MANIFEST_PIN = [
+    "release_info.json",
+    "*/update/infov2.json",
+    "*/package/info.json",
+    "*/package/*/*/info.json",
+    "*/package/*/microdl/info.json",
+]
 
 EMPTY: dict[str, Any] = {}
 REQUIRE_GENERATION = (1, 1)
@@ -42,7 +79,7 @@ def verify_dir(dir: str):
 
 
 def init():
-    global archive_root
+    global archive_root, archive_root_link
 
     config_file = os.getenv("N4DLAPI_CONFIG_FILE", "config.toml")
     if os.path.isfile(config_file):
@@ -53,10 +90,23 @@ def init():
         load_defaults()
     # Verify and normalize paths
     verify_dir(archive_root)
-    archive_root = os.path.normpath(archive_root)
-    # Verify archive-root generation
+    archive_root_link = os.path.normpath(archive_root)
+    archive_root = resolve_archive_root()
+    verify_generation(archive_root)
+
+
+# If archive-root is a symlink, this is the generation directory it points to.
+def resolve_archive_root():
+    global archive_root_link
+
+    if os.path.islink(archive_root_link):
+        return os.path.realpath(archive_root_link)
+    return archive_root_link
+
+
+def verify_generation(root: str):
     try:
-        with open(f"{archive_root}/generation.json", "r", encoding="UTF-8", newline="") as f:
+        with open(f"{root}/generation.json", "r", encoding="UTF-8", newline="") as f:
             argen_data = json.load(f)
             argen: tuple[int, int] = (argen_data["major"], argen_data["minor"])
     except Exception:
@@ -70,23 +120,151 @@ def init():
 
 
 def load_toml(toml: dict[str, Any]):
-    global main_public, shared_key, archive_root, api_publicness
+    global main_public, shared_key, archive_root, api_publicness, archive_root_check_interval
 
     main_public = bool(toml["main"]["public"])
+    archive_root_check_interval = max(int(toml["main"].get("archive_root_check_interval", 5)), 0)
     shared_key = str(toml["main"]["shared_key"])
     if len(shared_key) == 0:
         shared_key = None
     archive_root = os.getenv("N4DLAPI_ARCHIVE_ROOT", str(toml["main"].get("archive_root", "archive-root")))
     api_publicness = toml.get("api", {})
+    load_endpoint_limits(toml)
+    load_database_toml(toml.get("database", EMPTY))
+    load_http_toml(toml.get("http", EMPTY))
+    load_compression_toml(toml.get("compression", EMPTY))
+    load_signing_toml(toml.get("signing", EMPTY))
+    load_download_toml(toml.get("download", EMPTY))
+    load_archive_root_toml(toml.get("archive-root", EMPTY))
+    load_cache_toml(toml.get("cache", EMPTY))
+    load_pagecache_toml(toml.get("pagecache", EMPTY))
+    load_changelog_toml(toml.get("changelog", EMPTY))
 
 
 def load_defaults():
-    global main_public, shared_key, archive_root, api_publicness
+    global main_public, shared_key, archive_root, api_publicness, archive_root_check_interval
 
     main_public = True
+    archive_root_check_interval = 5
     shared_key = None
     archive_root = os.getenv("N4DLAPI_ARCHIVE_ROOT", "archive-root")
     api_publicness = {}
+    load_endpoint_limits(EMPTY)
+    load_database_toml(EMPTY)
+    load_http_toml(EMPTY)
+    load_compression_toml(EMPTY)
+    load_signing_toml(EMPTY)
+    load_download_toml(EMPTY)
+    load_archive_root_toml(EMPTY)
+    load_cache_toml(EMPTY)
+    load_pagecache_toml(EMPTY)
+    load_changelog_toml(EMPTY)
+
+
+def load_endpoint_limits(toml: dict[str, Any]):
+    global endpoint_limits
+
+    endpoint_limits = {}
+    tables: list[tuple[str, dict[str, Any]]] = [("/api", toml.get("api", EMPTY))]
+    tables.append(("/archive-root", toml.get("archive-root", EMPTY)))
+    while tables:
+        endpoint, table = tables.pop()
+        if "max_concurrent" in table:
+            endpoint_limits[endpoint] = {
+                "max_concurrent": max(int(table["max_concurrent"]), 1),
+                "max_queue": max(int(table.get("max_queue", 0)), 0),
+                "queue_timeout": max(float(table.get("queue_timeout", 5)), 0),
+                "retry_after": max(int(table.get("retry_after", 1)), 0),
+            }
+        if endpoint.startswith("/api"):
+            tables.extend((f"{endpoint}/{k}", v) for k, v in table.items() if isinstance(v, dict))
+
+
+def load_database_toml(toml: dict[str, Any]):
+    global database_lazy, database_cache_size, database_spill_dir
+
+    database_lazy = bool(toml.get("lazy_decrypt", False))
+    database_cache_size = int(toml.get("cache_size", 64 * 1024 * 1024))
+    database_spill_dir = str(toml.get("spill_dir", "")) or None
+
+
+def load_http_toml(toml: dict[str, Any]):
+    global http_cache_max_age
+
+    http_cache_max_age = max(int(toml.get("cache_max_age", 0)), 0)
+
+
+def load_compression_toml(toml: dict[str, Any]):
+    global compression_encodings, compression_min_size, compression_levels, compression_cache_size
+
+    compression_encodings = [str(e) for e in toml.get("encodings", ["gzip"])]
+    compression_min_size = int(toml.get("min_size", 1024))
+    compression_levels = {
+        "gzip": int(toml.get("gzip_level", 6)),
+        "br": int(toml.get("brotli_quality", 5)),
+        "zstd": int(toml.get("zstd_level", 3)),
+    }
+    compression_cache_size = int(toml.get("cache_size", 32 * 1024 * 1024))
+
+
+def load_signing_toml(toml: dict[str, Any]):
+    global signing_time_limit, signing_secret, shared_key
+
+    signing_time_limit = max(int(toml.get("time_limit", 0)), 0)
+    secret = str(toml.get("secret", "")) or shared_key
+    signing_secret = None if secret is None else secret.encode("UTF-8")
+    if signing_time_limit > 0 and signing_secret is None:
+        raise RuntimeError("Signed download URLs need either signing secret or shared key")
+
+
+def load_download_toml(toml: dict[str, Any]):
+    global download_origins, download_shard, download_health_path, download_health_interval
+
+    download_origins = [str(origin).rstrip("/") for origin in toml.get("origins", [])]
+    download_shard = str(toml.get("shard", "path"))
+    if download_shard not in ("path", "platform", "none"):
+        raise RuntimeError(f'Invalid download origin sharding "{download_shard}"')
+    download_health_path = str(toml.get("health_check_path", "generation.json")).lstrip("/")
+    download_health_interval = max(int(toml.get("health_check_interval", 30)), 0)
+
+
+def load_archive_root_toml(toml: dict[str, Any]):
+    global archive_root_shaping
+
+    rate = max(int(toml.get("rate", 0)), 0)
+    archive_root_shaping = {
+        "rate": rate,
+        "burst": max(int(toml.get("burst", rate)), 0),
+        "max_transfers": max(int(toml.get("max_transfers", 0)), 0),
+        "bulk_rate": max(int(toml.get("bulk_rate", 0)), 0),
+        "small_file_size": max(int(toml.get("small_file_size", 1024 * 1024)), 0),
+        "client_header": str(toml.get("client_header", "")) or None,
+        "trusted_proxies": max(int(toml.get("trusted_proxies", 1)), 1),
+    }
+
+
+def load_cache_toml(toml: dict[str, Any]):
+    global manifest_cache_size, manifest_cache_pin, small_file_cache_size, small_file_max_size
+
+    manifest_cache_size = int(toml.get("manifest_size", 256 * 1024 * 1024))
+    manifest_cache_pin = [str(pattern) for pattern in toml.get("pin", DEFAULT_MANIFEST_PIN)]
+    small_file_cache_size = max(int(toml.get("small_file_size", 64 * 1024 * 1024)), 0)
+    small_file_max_size = max(int(toml.get("small_file_max_size", 256 * 1024)), 0)
+
+
+def load_pagecache_toml(toml: dict[str, Any]):
+    global pagecache_warm_budget, pagecache_readahead, pagecache_stats_file
+
+    pagecache_warm_budget = max(int(toml.get("warm_budget", 0)), 0)
+    pagecache_readahead = max(int(toml.get("readahead", 8 * 1024 * 1024)), 0)
+    pagecache_stats_file = str(toml.get("stats_file", "")) or None
+
+
+def load_changelog_toml(toml: dict[str, Any]):
+    global changelog_file, changelog_max_generations
+
+    changelog_file = str(toml.get("file", "")) or None
+    changelog_max_generations = max(int(toml.get("max_generations", 100)), 1)
 
 
 def is_endpoint_accessible(endpoint: str):
@@ -101,6 +279,18 @@ def is_endpoint_accessible(endpoint: str):
     return bool(current.get("public", main_public))
 
 
+# Returns the endpoint whose limits apply and the limits, or None if it's unlimited.
+def get_endpoint_limits(endpoint: str):
+    global endpoint_limits
+
+    split_endpoint = endpoint.rstrip("/").split("/")
+    for i in range(len(split_endpoint), 1, -1):
+        prefix = "/".join(split_endpoint[:i])
+        if prefix in endpoint_limits:
+            return prefix, endpoint_limits[prefix]
+    return None
+
+
 # Endpoint is "/api/..."
 def is_accessible(endpoint: str, sk: str | None):
     global shared_key
@@ -112,6 +302,19 @@ def is_accessible(endpoint: str, sk: str | None):
     return shared_key == sk
 
 
+def is_shared_key(sk: str | None):
+    global shared_key
+
+    return shared_key is not None and shared_key == sk
+
+
+# Can the endpoint response be stored by shared caches?
+def is_endpoint_public(endpoint: str):
+    global shared_key
+
+    return shared_key is None or is_endpoint_accessible(endpoint)
+
+
 def is_public_accessible():
     global main_public
     return main_public
@@ -119,7 +322,167 @@ def is_public_accessible():
 
 def get_archive_root_dir():
     global archive_root
-    return archive_root
+    return archive_root_pin.get(archive_root)
+
+
+def set_archive_root_dir(root: str):
+    global archive_root
+    archive_root = root
+
+
+def get_archive_root_check_interval():
+    global archive_root_check_interval
+    return archive_root_check_interval
+
+
+def is_database_lazy():
+    global database_lazy
+    return database_lazy
+
+
+def get_database_cache_size():
+    global database_cache_size
+    return database_cache_size
+
+
+def get_database_spill_dir():
+    global database_spill_dir
+    return database_spill_dir
+
+
+def get_http_cache_max_age():
+    global http_cache_max_age
+    return http_cache_max_age
+
+
+def get_compression_encodings():
+    global compression_encodings
+    return compression_encodings
+
+
+def get_compression_min_size():
+    global compression_min_size
+    return compression_min_size
+
+
+def get_compression_level(encoding: str):
+    global compression_levels
+    return compression_levels[encoding]
+
+
+def get_compression_cache_size():
+    global compression_cache_size
+    return compression_cache_size
+
+
+def get_serve_time_limit():
+    global signing_time_limit
+    return signing_time_limit
+
+
+def get_signing_secret():
+    global signing_secret
+    return signing_secret
+
+
+def get_download_origins():
+    global download_origins
+    return download_origins
+
+
+def get_download_shard():
+    global download_shard
+    return download_shard
+
+
+def get_download_health_check():
+    global download_health_path, download_health_interval
+    return download_health_path, download_health_interval
+
+
+def get_archive_root_shaping():
+    global archive_root_shaping
+    return archive_root_shaping
+
+
+def get_manifest_cache_size():
+    global manifest_cache_size
+    return manifest_cache_size
+
+
+def get_manifest_cache_pin():
+    global manifest_cache_pin
+    return manifest_cache_pin
+
+
+def get_small_file_cache_size():
+    global small_file_cache_size
+    return small_file_cache_size
+
+
+def get_small_file_max_size():
+    global small_file_max_size
+    return small_file_max_size
+
+
+def get_pagecache_warm_budget():
+    global pagecache_warm_budget
+    return pagecache_warm_budget
+
+
+def get_pagecache_readahead():
+    global pagecache_readahead
+    return pagecache_readahead
+
+
+def get_pagecache_stats_file():
+    global pagecache_stats_file
+    return pagecache_stats_file
+
+
+def get_changelog_file():
+    global changelog_file
+    return changelog_file
+
+
+def get_changelog_max_generations():
+    global changelog_max_generations
+    return changelog_max_generations
 
 
-__all__ = ["init", "is_accessible", "is_public_accessible", "get_archive_root_dir"]
+__all__ = [
+    "init",
+    "is_accessible",
+    "is_shared_key",
+    "is_endpoint_public",
+    "is_public_accessible",
+    "get_archive_root_dir",
+    "set_archive_root_dir",
+    "resolve_archive_root",
+    "verify_generation",
+    "get_archive_root_check_interval",
+    "is_database_lazy",
+    "get_database_cache_size",
+    "get_database_spill_dir",
+    "get_http_cache_max_age",
+    "get_compression_encodings",
+    "get_compression_min_size",
+    "get_compression_level",
+    "get_compression_cache_size",
+    "get_serve_time_limit",
+    "get_signing_secret",
+    "get_download_origins",
+    "get_download_shard",
+    "get_download_health_check",
+    "get_archive_root_shaping",
+    "get_endpoint_limits",
+    "get_manifest_cache_size",
+    "get_manifest_cache_pin",
+    "get_small_file_cache_size",
+    "get_small_file_max_size",
+    "get_pagecache_warm_budget",
+    "get_pagecache_readahead",
+    "get_pagecache_stats_file",
+    "get_changelog_file",
+    "get_changelog_max_generations",
+]
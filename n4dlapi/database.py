@@ -0,0 +1,95 @@
+# Copyright (c) 2023 Dark Energy Processor
+#
+# This software is provided 'as-is', without any express or implied
+# warranty. In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+
+import os
+import threading
+import zipfile
+
+from . import config
+from . import lru
+
+from typing import Callable
+
+
+class DatabaseCache(lru.ByteLRU):
+    """
+    Byte-bounded LRU of decrypted databases.
+
+    Entries evicted from memory are written to `spill_dir` (if any) so the next request only costs a disk read instead
+    of another decryption.
+    """
+
+    def __init__(self, max_size: int, spill_dir: str | None = None):
+        super().__init__(max_size)
+        self.spill_dir = spill_dir
+
+    def load(self, key: str, loader: Callable[[], bytes | None]):
+        result = self._read_spill(key)
+        if result is None:
+            result = loader()
+        return result
+
+    def evicted(self, key: str, data: bytes):
+        self._write_spill(key, data)
+
+    def _spill_path(self, key: str):
+        return f"{self.spill_dir}/{key}.db"
+
+    def _read_spill(self, key: str):
+        if self.spill_dir is None:
+            return None
+        try:
+            with open(self._spill_path(key), "rb") as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _write_spill(self, key: str, data: bytes):
+        if self.spill_dir is None:
+            return
+        path = self._spill_path(key)
+        if os.path.isfile(path):
+            return
+        os.makedirs(self.spill_dir, exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+
+def decrypt_from_archive(archive: str, member: str):
+    # Import lazily, so the server still starts if there's no decrypter backend and lazy decryption is disabled.
+    from . import crypt
+
+    with zipfile.ZipFile(archive, "r") as z:
+        with z.open(member, "r") as f:
+            data = f.read()
+    return crypt.decrypt(member, data)
+
+
+_cache: DatabaseCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = DatabaseCache(config.get_database_cache_size(), config.get_database_spill_dir())
+        return _cache
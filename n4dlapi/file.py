@@ -16,41 +16,48 @@
 #    misrepresented as being the original software.
 # 3. This notice may not be removed or altered from any source distribution.
 
+import bisect
+import functools
+import hashlib
+import itertools
 import json
 import os
+import zipfile
 
 import natsort
 
 from . import config
+from . import database
+from . import manifest
+from . import memo
 from . import model
 
-from typing import Any, Callable, TypeVar, Generic
+_PLATFORM_MAP = ["iOS", "Android"]
 
-_T = TypeVar("_T")
 
-_PLATFORM_MAP = ["iOS", "Android"]
+def load_json(file: str):
+    with open(file, "r", encoding="UTF-8", newline="") as f:
+        return json.load(f)
 
 
-class MemoizeByModTime(Generic[_T]):
-    def __init__(self, f: Callable[[str], _T]):
-        self.f = f
-        self.map: dict[str, tuple[int, _T]] = {}
+read_json = memo.MemoizeByModTime(load_json)
 
-    def __call__(self, path: str):
-        stat = os.stat(path)
-        if path in self.map:
-            mtime, result = self.map[path]
-            if stat.st_mtime_ns <= mtime:
-                return result
-        result = self.f(path)
-        self.map[path] = (stat.st_mtime_ns, result)
-        return result
 
+# Parsed JSON of these is not cached, only the compact form.
+@memo.MemoizeByModTime
+def read_manifest(file: str):
+    return manifest.Manifest(load_json(file))
+
+
+@memo.MemoizeByModTime
+def read_microdl_manifest(file: str):
+    return manifest.MicrodlManifest(load_json(file))
 
-@MemoizeByModTime
-def read_json(file: str):
-    with open(file, "r", encoding="UTF-8", newline="") as f:
-        return json.load(f)
+
+@memo.MemoizeByModTime
+def read_package_ids(file: str):
+    package_ids: list[int] = sorted(set(read_json(file)))
+    return package_ids
 
 
 def parse_sifversion(ver: str):
@@ -62,7 +69,7 @@ def version_string(ver: tuple[int, int]):
     return "%d.%d" % ver
 
 
-@MemoizeByModTime
+@memo.MemoizeByModTime
 def get_versions(file: str):
     versions: list[str] = read_json(file)
     new_ver: list[tuple[int, int]] = []
@@ -97,6 +104,124 @@ def get_latest_version():
     return parse_sifversion(update_info[-1])
 
 
+def get_archive_generation():
+    """
+    Token that changes whenever manifests read by the API may have changed.
+
+    Only stats the top-level manifests of the latest version. `update_v1.1.py` rewrites `generation.json` last and
+    `clone.py` rewrites the package type `info.json` when adding packages, so deeper changes are still caught.
+    """
+    root_dir = config.get_archive_root_dir()
+    latest = version_string(get_latest_version())
+    paths = [f"{root_dir}/generation.json", f"{root_dir}/release_info.json"]
+    for platform in _PLATFORM_MAP:
+        paths.append(f"{root_dir}/{platform}/update/infov2.json")
+        paths.append(f"{root_dir}/{platform}/package/info.json")
+        paths.append(f"{root_dir}/{platform}/package/{latest}/microdl/info.json")
+        paths.extend(f"{root_dir}/{platform}/package/{latest}/{pkgtype}/info.json" for pkgtype in range(7))
+
+    stamps: list[str] = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stamps.append(f"{stat.st_mtime_ns}:{stat.st_size}")
+        except OSError:
+            stamps.append("-")
+    return hashlib.sha1(";".join(stamps).encode("UTF-8"), usedforsecurity=False).hexdigest()
+
+
+def warm_up():
+    """
+    Load manifests of the latest version in advance, failing if any of them is missing.
+    """
+    root_dir = config.get_archive_root_dir()
+    latest = version_string(get_latest_version())
+    for platform in _PLATFORM_MAP:
+        update_path = f"{root_dir}/{platform}/update"
+        if os.path.isfile(update_path + "/infov2.json"):
+            for ver in get_versions(update_path + "/infov2.json"):
+                read_manifest(f"{update_path}/{version_string(ver)}/infov2.json")
+
+        package_path = f"{root_dir}/{platform}/package/{latest}"
+        for pkgtype in range(7):
+            if os.path.isfile(f"{package_path}/{pkgtype}/info.json"):
+                for pkgid in read_json(f"{package_path}/{pkgtype}/info.json"):
+                    read_manifest(f"{package_path}/{pkgtype}/{pkgid}/infov2.json")
+        if os.path.isfile(package_path + "/microdl/info.json"):
+            read_microdl_manifest(package_path + "/microdl/info.json")
+    read_json(root_dir + "/release_info.json")
+
+
+def forget_archive_root(root_dir: str):
+    """
+    Drop cached manifests of an archive-root that is no longer in use.
+    """
+    read_json.forget(root_dir + "/")
+    read_manifest.forget(root_dir + "/")
+    read_microdl_manifest.forget(root_dir + "/")
+    read_package_ids.forget(root_dir + "/")
+    read_database_members.forget(root_dir + "/")
+    get_versions.forget(root_dir + "/")
+
+
+def get_manifest_entry(path: str):
+    """
+    Manifest entry of an archive-root relative file path, or None if no manifest lists it.
+    """
+    root_dir = config.get_archive_root_dir()
+    parts = path.split("/")
+    if parts[0] not in _PLATFORM_MAP:
+        return None
+    elif len(parts) > 4 and parts[1] == "package" and parts[3] == "microdl":
+        manifest_path = f"{root_dir}/{'/'.join(parts[:4])}/info.json"
+        if os.path.isfile(manifest_path):
+            return read_microdl_manifest(manifest_path).get("/".join(parts[4:]))
+    elif (len(parts) == 4 and parts[1] == "update") or (len(parts) == 6 and parts[1] == "package"):
+        manifest_path = f"{root_dir}/{'/'.join(parts[:-1])}/infov2.json"
+        if os.path.isfile(manifest_path):
+            return read_manifest(manifest_path).get(parts[-1])
+    return None
+
+
+def iter_packages():
+    """
+    Yield archive-root relative path and manifest of every package of the latest version.
+    """
+    root_dir = config.get_archive_root_dir()
+    latest = version_string(get_latest_version())
+    for platform in _PLATFORM_MAP:
+        for pkgtype in range(7):
+            path = f"{platform}/package/{latest}/{pkgtype}"
+            if os.path.isfile(f"{root_dir}/{path}/info.json"):
+                for pkgid in read_package_ids(f"{root_dir}/{path}/info.json"):
+                    yield f"{path}/{pkgid}", read_manifest(f"{root_dir}/{path}/{pkgid}/infov2.json")
+
+
+def get_package_archives(paths: list[str]):
+    """
+    Download info of all archives of packages at archive-root relative `paths`. Packages that no longer exist are left
+    out.
+    """
+    root_dir = config.get_archive_root_dir()
+    result: list[model.DeltaDownloadInfoModel] = []
+    for path in paths:
+        if not os.path.isfile(f"{root_dir}/{path}/infov2.json"):
+            continue
+        platform, _, _, pkgtype, pkgid = path.split("/")
+        for entry in read_manifest(f"{root_dir}/{path}/infov2.json"):
+            result.append(
+                model.DeltaDownloadInfoModel(
+                    url=f"/{path}/{entry.name}",
+                    size=entry.size,
+                    checksums=model.ChecksumModel(md5=entry.md5, sha256=entry.sha256),
+                    packageId=int(pkgid),
+                    packageType=int(pkgtype),
+                    platform=_PLATFORM_MAP.index(platform) + 1,
+                )
+            )
+    return result
+
+
 def get_release_info():
     release_info: dict[str, str] = read_json(config.get_archive_root_dir() + "/release_info.json")
     return release_info
@@ -116,14 +241,13 @@ def get_update_file(old_client_version: str, platform: int) -> list[model.Downlo
     for ver in filter(lambda x: x > current_version, updates):
         verstr = version_string(ver)
         update_ver_path = f"{path}/{verstr}"
-        file_datas: list[dict[str, Any]] = read_json(update_ver_path + "/infov2.json")
-        for filedata in file_datas:
-            fullpath = f"{update_ver_path}/{filedata['name']}"
+        for entry in read_manifest(update_ver_path + "/infov2.json"):
+            fullpath = f"{update_ver_path}/{entry.name}"
             download_data.append(
                 model.DownloadUpdateModel(
                     url=fullpath[archive_root_len:],
-                    size=filedata["size"],
-                    checksums=model.ChecksumModel(md5=filedata["md5"], sha256=filedata["sha256"]),
+                    size=entry.size,
+                    checksums=model.ChecksumModel(md5=entry.md5, sha256=entry.sha256),
                     version=verstr,
                 )
             )
@@ -131,31 +255,68 @@ def get_update_file(old_client_version: str, platform: int) -> list[model.Downlo
     return download_data
 
 
-def get_batch_list(pkgtype: int, platform: int, exclude: list[int]):
+def get_batch_path(pkgtype: int, platform: int):
     latest = get_latest_version()
     path = f"{config.get_archive_root_dir()}/{_PLATFORM_MAP[platform - 1]}/package/{version_string(latest)}/{pkgtype}"
     if not os.path.isdir(path):
         # Not found
         return None
-
+    return path
+
+
+class ExcludeSet:
+    """
+    Package IDs to leave out of a batch, given as a list, inclusive ranges and/or a little-endian bitmap.
+    """
+
+    def __init__(self, ids: list[int], ranges: list[tuple[int, int]], bitmap: bytes):
+        self.ids = frozenset(ids)
+        self.bitmap = bitmap
+        # Merged so the range a package ID may fall in is found with a single bisect.
+        self.starts: list[int] = []
+        self.ends: list[int] = []
+        for first, last in sorted(r for r in ranges if r[0] <= r[1]):
+            if self.ends and first <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], last)
+            else:
+                self.starts.append(first)
+                self.ends.append(last)
+
+    def __contains__(self, pkgid: int):
+        index = pkgid >> 3
+        if index < len(self.bitmap) and self.bitmap[index] & (1 << (pkgid & 7)):
+            return True
+        i = bisect.bisect_right(self.starts, pkgid) - 1
+        return (i >= 0 and pkgid <= self.ends[i]) or pkgid in self.ids
+
+
+def iter_batch_list(path: str, exclude: ExcludeSet, after: int | None = None):
+    """
+    Yield download info of each package in `path` in package ID order, reading each package manifest only when it's
+    reached. If `after` is specified, packages up to and including that ID are skipped.
+    """
     archive_root_len = len(config.get_archive_root_dir())
-    result: list[model.BatchDownloadInfoModel] = []
-    packages: list[int] = read_json(path + "/info.json")
-
-    for pkgid in sorted(set(packages).difference(exclude)):
-        file_datas: list[dict[str, Any]] = read_json(f"{path}/{pkgid}/infov2.json")
-        for filedata in file_datas:
-            fullpath = f"{path}/{pkgid}/{filedata['name']}"
-            result.append(
-                model.BatchDownloadInfoModel(
-                    url=fullpath[archive_root_len:],
-                    size=filedata["size"],
-                    checksums=model.ChecksumModel(md5=filedata["md5"], sha256=filedata["sha256"]),
-                    packageId=pkgid,
-                )
+    package_ids = read_package_ids(path + "/info.json")
+    start = 0 if after is None else bisect.bisect_right(package_ids, after)
+
+    for pkgid in itertools.islice(package_ids, start, None):
+        if pkgid in exclude:
+            continue
+        for entry in read_manifest(f"{path}/{pkgid}/infov2.json"):
+            fullpath = f"{path}/{pkgid}/{entry.name}"
+            yield model.BatchDownloadInfoModel(
+                url=fullpath[archive_root_len:],
+                size=entry.size,
+                checksums=model.ChecksumModel(md5=entry.md5, sha256=entry.sha256),
+                packageId=pkgid,
             )
 
-    return result
+
+def get_batch_list(pkgtype: int, platform: int, exclude: ExcludeSet):
+    path = get_batch_path(pkgtype, platform)
+    if path is None:
+        return None
+    return list(iter_batch_list(path, exclude))
 
 
 def get_single_package(pkgtype: int, pkgid: int, platform: int):
@@ -167,20 +328,71 @@ def get_single_package(pkgtype: int, pkgid: int, platform: int):
     archive_root_len = len(config.get_archive_root_dir())
 
     result: list[model.DownloadInfoModel] = []
-    file_datas: list[dict[str, Any]] = read_json(f"{path}/infov2.json")
-    for filedata in file_datas:
-        fullpath = f"{path}/{filedata['name']}"
+    for entry in read_manifest(f"{path}/infov2.json"):
+        fullpath = f"{path}/{entry.name}"
         result.append(
             model.DownloadInfoModel(
                 url=fullpath[archive_root_len:],
-                size=filedata["size"],
-                checksums=model.ChecksumModel(md5=filedata["md5"], sha256=filedata["sha256"]),
+                size=entry.size,
+                checksums=model.ChecksumModel(md5=entry.md5, sha256=entry.sha256),
             )
         )
 
     return result
 
 
+@memo.MemoizeByModTime
+def read_database_members(archive: str):
+    with zipfile.ZipFile(archive, "r") as z:
+        return [
+            info.filename for info in z.infolist() if info.filename.startswith("db/") and info.filename.endswith(".db_")
+        ]
+
+
+def get_database_archive_index(root_dir: str, platform: int, version: tuple[int, int]):
+    """
+    Map database basename to (archive path, zip member, archive sha256) holding its newest copy.
+
+    Follows `update_v1.1.py` precedence: updates up to `version` in ascending order, then bootstrap package. Only the
+    database members of each archive are cached, so archives rewritten in place are picked up like manifests are.
+    """
+    index: dict[str, tuple[str, str, str]] = {}
+    archives: list[tuple[str, str]] = []
+
+    update_path = f"{root_dir}/{_PLATFORM_MAP[platform]}/update"
+    for ver in filter(lambda x: x <= version, get_versions(update_path + "/infov2.json")):
+        update_ver_path = f"{update_path}/{version_string(ver)}"
+        archives.extend(
+            (f"{update_ver_path}/{entry.name}", entry.sha256)
+            for entry in read_manifest(update_ver_path + "/infov2.json")
+        )
+
+    bootstrap_path = f"{root_dir}/{_PLATFORM_MAP[platform]}/package/{version_string(version)}/0"
+    if os.path.isfile(bootstrap_path + "/info.json"):
+        for pkgid in read_json(bootstrap_path + "/info.json"):
+            archives.extend(
+                (f"{bootstrap_path}/{pkgid}/{entry.name}", entry.sha256)
+                for entry in read_manifest(f"{bootstrap_path}/{pkgid}/infov2.json")
+            )
+
+    for archive, sha256 in archives:
+        for member in read_database_members(archive):
+            index[os.path.basename(member)] = (archive, member, sha256)
+
+    return index
+
+
+def decrypt_database_file(platform: int, version: tuple[int, int], dbfile: str):
+    index = get_database_archive_index(config.get_archive_root_dir(), platform, version)
+    if dbfile not in index:
+        return None
+
+    archive, member, sha256 = index[dbfile]
+    return database.get_cache().get(
+        f"{sha256}_{dbfile[:-4]}", functools.partial(database.decrypt_from_archive, archive, member)
+    )
+
+
 def get_database_file(name: str):
     global _update_preference
     latest = get_latest_version()
@@ -190,6 +402,8 @@ def get_database_file(name: str):
         with open(path, "rb") as f:
             return f.read()
     except IOError:
+        if config.is_database_lazy():
+            return decrypt_database_file(_update_preference, latest, f"{dbname}.db_")
         return None
 
 
@@ -198,7 +412,7 @@ def get_microdl_file(file: str, platform: int):
     # Normalize path
     commonpath = f"{_PLATFORM_MAP[platform - 1]}/package/{version_string(latest)}/microdl"
     basepath = f"{config.get_archive_root_dir()}/{commonpath}"
-    microdl_map: dict[str, dict[str, Any]] = read_json(basepath + "/info.json")
+    microdl_map = read_microdl_manifest(basepath + "/info.json")
     sanitized_file = os.path.normpath(file.replace("..", "")).replace("\\", "/")
     if sanitized_file[0] == "/":
         sanitized_file = sanitized_file[1:]
@@ -213,10 +427,41 @@ def get_microdl_file(file: str, platform: int):
             sha256="e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855",
         ),
     )
-    if sanitized_file in microdl_map:
-        info = microdl_map[sanitized_file]
-        result.size = info["size"]
-        result.checksums.md5 = info["md5"]
-        result.checksums.sha256 = info["sha256"]
+    entry = microdl_map.get(sanitized_file)
+    if entry is not None:
+        result.size = entry.size
+        result.checksums.md5 = entry.md5
+        result.checksums.sha256 = entry.sha256
+
+    return result
+
+
+def find_microdl_files(prefixes: list[str], patterns: list[str], platform: int):
+    """
+    Microdl files under any of the directories in `prefixes` or matching any of the glob `patterns`, sorted by name.
+    """
+    latest = get_latest_version()
+    commonpath = f"{_PLATFORM_MAP[platform - 1]}/package/{version_string(latest)}/microdl"
+    microdl_map = read_microdl_manifest(f"{config.get_archive_root_dir()}/{commonpath}/info.json")
+
+    indices: set[int] = set()
+    for prefix in prefixes:
+        prefix = prefix.replace("\\", "/").lstrip("/")
+        if prefix and prefix[-1] != "/":
+            prefix = prefix + "/"
+        indices.update(microdl_map.find_prefix(prefix))
+    for pattern in patterns:
+        indices.update(microdl_map.glob(pattern.replace("\\", "/").lstrip("/")))
+
+    result: list[model.DownloadInfoModel] = []
+    for index in sorted(indices):
+        entry = microdl_map[index]
+        result.append(
+            model.DownloadInfoModel(
+                url=f"{commonpath}/{entry.name}",
+                size=entry.size,
+                checksums=model.ChecksumModel(md5=entry.md5, sha256=entry.sha256),
+            )
+        )
 
     return result
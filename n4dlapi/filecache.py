@@ -0,0 +1,171 @@
+# Copyright (c) 2023 Dark Energy Processor
+#
+# This software is provided 'as-is', without any express or implied
+# warranty. In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+
+import collections
+import hashlib
+import threading
+
+from . import config
+from . import file
+
+
+class FrequencySketch:
+    """
+    Count-min sketch of recent access frequency, with 4 rows of counters saturating at 15. All counters are halved
+    once `10 * width` accesses have been recorded, so keys that were popular long ago are eventually forgotten.
+
+    Keys are sha256 hex digests, so each row uses a different part of the key as its hash.
+    """
+
+    ROWS = 4
+    _HALVE = bytes(i >> 1 for i in range(256))
+
+    def __init__(self, width: int):
+        # Power of two so indexing is a mask.
+        self.width = 1 << max(width - 1, 1).bit_length()
+        self.mask = self.width - 1
+        self.table = bytearray(self.ROWS * self.width)
+        self.additions = 0
+        self.sample_size = 10 * self.width
+
+    def _indices(self, key: str):
+        for row in range(self.ROWS):
+            yield row * self.width + (int(key[row * 16 : row * 16 + 16], 16) & self.mask)
+
+    def increment(self, key: str):
+        for index in self._indices(key):
+            if self.table[index] < 15:
+                self.table[index] = self.table[index] + 1
+        self.additions = self.additions + 1
+        if self.additions >= self.sample_size:
+            self.table = bytearray(self.table.translate(self._HALVE))
+            self.additions = self.additions // 2
+
+    def estimate(self, key: str):
+        return min(self.table[index] for index in self._indices(key))
+
+
+class SmallFileCache:
+    """
+    Byte-bounded LRU of small archive-root files, keyed by their sha256 in the manifest.
+
+    A file only gets in if it was accessed more often recently than the files it would evict (TinyLFU), so a mirror
+    walking the whole archive-root once doesn't flush files game clients keep requesting.
+    """
+
+    def __init__(self, max_size: int, max_file_size: int):
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.size = 0
+        self.entries: collections.OrderedDict[str, bytes] = collections.OrderedDict()
+        # Enough counters for as many 1 KiB files as fit, microdl files are usually around that size.
+        self.sketch = FrequencySketch(min(max(max_size // 1024, 16), 1 << 20))
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejected = 0
+
+    def get(self, sha256: str):
+        with self.lock:
+            self.sketch.increment(sha256)
+            data = self.entries.get(sha256)
+            if data is None:
+                self.misses = self.misses + 1
+            else:
+                self.entries.move_to_end(sha256)
+                self.hits = self.hits + 1
+            return data
+
+    def put(self, sha256: str, data: bytes):
+        if len(data) > self.max_file_size or len(data) > self.max_size:
+            return
+        with self.lock:
+            if sha256 in self.entries:
+                return
+
+            # Least recently used files that have to go to make room.
+            victims: list[str] = []
+            freed = 0
+            for key, old_data in self.entries.items():
+                if self.size - freed + len(data) <= self.max_size:
+                    break
+                victims.append(key)
+                freed = freed + len(old_data)
+
+            frequency = self.sketch.estimate(sha256)
+            if any(self.sketch.estimate(key) >= frequency for key in victims):
+                self.rejected = self.rejected + 1
+                return
+
+            for key in victims:
+                del self.entries[key]
+            self.size = self.size - freed + len(data)
+            self.evictions = self.evictions + len(victims)
+            self.entries[sha256] = data
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "size": self.size,
+                "maxSize": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "rejected": self.rejected,
+            }
+
+
+_cache: SmallFileCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = SmallFileCache(config.get_small_file_cache_size(), config.get_small_file_max_size())
+        return _cache
+
+
+def read_small_file(path: str):
+    """
+    Returns (sha256, contents) of an archive-root relative file path if a manifest lists it as small enough to be kept
+    in memory, or None otherwise.
+    """
+    cache = get_cache()
+    if cache.max_size == 0:
+        return None
+    entry = file.get_manifest_entry(path)
+    if entry is None or entry.size > cache.max_file_size:
+        return None
+
+    data = cache.get(entry.sha256)
+    if data is None:
+        try:
+            with open(f"{config.get_archive_root_dir()}/{path}", "rb") as f:
+                data = f.read(cache.max_file_size + 1)
+        except OSError:
+            return None
+        if hashlib.sha256(data).hexdigest() != entry.sha256:
+            # File and manifest disagree, leave it to StaticFiles.
+            return None
+        cache.put(entry.sha256, data)
+    return entry.sha256, data
@@ -0,0 +1,167 @@
+# Copyright (c) 2023 Dark Energy Processor
+#
+# This software is provided 'as-is', without any express or implied
+# warranty. In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+
+import mimetypes
+import os
+import threading
+import time
+import traceback
+
+import anyio
+import starlette.datastructures
+import starlette.responses
+import starlette.staticfiles
+import starlette.types
+
+from . import changelog
+from . import config
+from . import file
+from . import filecache
+from . import httpcache
+from . import pagecache
+from . import urlsign
+
+
+class PinArchiveRoot:
+    """
+    ASGI middleware making the whole request, including streamed responses, use the archive-root generation that was
+    active when it started.
+    """
+
+    def __init__(self, app: starlette.types.ASGIApp):
+        self.app = app
+
+    async def __call__(
+        self, scope: starlette.types.Scope, receive: starlette.types.Receive, send: starlette.types.Send
+    ):
+        token = config.archive_root_pin.set(config.get_archive_root_dir())
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            config.archive_root_pin.reset(token)
+
+
+class ArchiveRootFiles(urlsign.SignedStaticFiles):
+    """
+    Serves files of the archive-root generation pinned to the request. Small files listed in manifests are served from
+    memory, with their sha256 as entity tag.
+    """
+
+    async def get_verified_response(self, path: str, scope: starlette.types.Scope):
+        if scope["method"] in ("GET", "HEAD"):
+            small_file = await anyio.to_thread.run_sync(filecache.read_small_file, path.replace(os.sep, "/"))
+            if small_file is not None:
+                return self.small_file_response(path, scope, *small_file)
+        return await super().get_verified_response(path, scope)
+
+    def small_file_response(self, path: str, scope: starlette.types.Scope, sha256: str, data: bytes):
+        headers = {"ETag": f'"{sha256}"'}
+        if_none_match = starlette.datastructures.Headers(scope=scope).get("If-None-Match")
+        if httpcache.etag_matches(if_none_match, headers["ETag"]) is not None:
+            return starlette.responses.Response(status_code=304, headers=headers)
+
+        media_type = mimetypes.guess_type(path)[0] or "text/plain"
+        if scope["method"] == "HEAD":
+            headers["Content-Length"] = str(len(data))
+            return starlette.responses.Response(media_type=media_type, headers=headers)
+        return starlette.responses.Response(data, media_type=media_type, headers=headers)
+
+    def file_response(
+        self,
+        full_path: str,
+        stat_result: os.stat_result,
+        scope: starlette.types.Scope,
+        status_code: int = 200,
+    ):
+        response = pagecache.SequentialFileResponse(
+            full_path, status_code=status_code, stat_result=stat_result, method=scope["method"]
+        )
+        if self.is_not_modified(response.headers, starlette.datastructures.Headers(scope=scope)):
+            return starlette.staticfiles.NotModifiedResponse(response.headers)
+        return response
+
+    def lookup_path(self, path: str):
+        directory = os.path.realpath(config.get_archive_root_dir())
+        full_path = os.path.realpath(os.path.join(directory, path))
+        if os.path.commonpath([full_path, directory]) != directory:
+            # Don't allow misbehaving clients to break out of archive-root.
+            return "", None
+        try:
+            stat_result = os.stat(full_path)
+        except (FileNotFoundError, NotADirectoryError):
+            return "", None
+        pagecache.record_access(path.replace(os.sep, "/"))
+        return full_path, stat_result
+
+
+def activate(root_dir: str):
+    """
+    Verify and load manifests of `root_dir`, then make it the archive-root of new requests.
+    """
+    config.verify_generation(root_dir)
+    token = config.archive_root_pin.set(root_dir)
+    try:
+        file.warm_up()
+        pagecache.warm_up()
+        # So the delta of the new generation is there once requests start using it.
+        changelog.get_changelog().record()
+    finally:
+        config.archive_root_pin.reset(token)
+
+    old_root_dir = config.get_archive_root_dir()
+    config.set_archive_root_dir(root_dir)
+    # Requests still using the old generation simply load it again.
+    file.forget_archive_root(old_root_dir)
+
+
+def record_changes():
+    try:
+        changelog.get_changelog().record()
+    except Exception:
+        traceback.print_exc()
+
+
+def watch(interval: int):
+    record_changes()
+    failed: str | None = None
+    while interval > 0:
+        time.sleep(interval)
+        root_dir = config.resolve_archive_root()
+        if root_dir == config.get_archive_root_dir() or root_dir == failed:
+            # The archive-root may also be updated in place.
+            record_changes()
+            continue
+
+        print("New archive-root generation:", root_dir)
+        try:
+            activate(root_dir)
+            failed = None
+            print("Switched to archive-root generation:", root_dir)
+        except Exception:
+            # Keep serving the current one. The broken generation is retried once the link changes again.
+            traceback.print_exc()
+            failed = root_dir
+
+
+def start_watcher():
+    """
+    Watch for the archive-root symlink being pointed to another generation directory, and for changes to record in the
+    changelog.
+    """
+    interval = config.get_archive_root_check_interval()
+    threading.Thread(target=watch, args=(interval,), name="archive-root-watcher", daemon=True).start()
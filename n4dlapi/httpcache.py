@@ -0,0 +1,211 @@
+# Copyright (c) 2023 Dark Energy Processor
+#
+# This software is provided 'as-is', without any express or implied
+# warranty. In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+
+import gzip
+import hashlib
+import json
+import threading
+
+import fastapi
+import fastapi.encoders
+
+from . import config
+from . import lru
+from . import memo
+from . import origin
+from . import urlsign
+
+from typing import Any, Callable
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def _compress_gzip(data: bytes, level: int):
+    # mtime=0 so the same body always compresses to the same bytes.
+    return gzip.compress(data, level, mtime=0)
+
+
+def _compress_brotli(data: bytes, level: int):
+    return brotli.compress(data, quality=level)
+
+
+def _compress_zstd(data: bytes, level: int):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+COMPRESSORS: dict[str, Callable[[bytes, int], bytes]] = {"gzip": _compress_gzip}
+if brotli is not None:
+    COMPRESSORS["br"] = _compress_brotli
+if zstandard is not None:
+    COMPRESSORS["zstd"] = _compress_zstd
+
+
+def make_etag(generation: str, request: fastapi.Request, params: Any = None):
+    # Download URLs depend on the host the request was made to, origin health and expiry time, so they're part of the
+    # tag too.
+    data = json.dumps(
+        [
+            generation,
+            request.method,
+            request.url.path,
+            str(request.base_url),
+            params,
+            origin.get_origins().get_state(),
+            urlsign.get_expiry(),
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return '"' + hashlib.sha256(data.encode("UTF-8"), usedforsecurity=False).hexdigest()[:32] + '"'
+
+
+def variant_etag(etag: str, encoding: str | None):
+    if encoding is None:
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str):
+    """
+    Returns the entity tag in `if_none_match` that matches `etag` or any of its encoded variants, or None.
+    """
+    if if_none_match is None:
+        return None
+    for tag in if_none_match.split(","):
+        tag = tag.strip().removeprefix("W/")
+        if tag == "*":
+            return etag
+        elif tag == etag or tag.startswith(etag[:-1] + "-"):
+            return tag
+    return None
+
+
+def negotiate_encoding(accept_encoding: str | None):
+    """
+    Pick the encoding from `Accept-Encoding` with the highest q-value. Ties go to the order in config.
+    """
+    if not accept_encoding:
+        return None
+
+    qvalues: dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        coding, *params = [p.strip() for p in part.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        qvalues[coding.lower()] = q
+
+    best: str | None = None
+    best_q = 0.0
+    for encoding in config.get_compression_encodings():
+        q = qvalues.get(encoding, qvalues.get("*", 0.0))
+        if encoding in COMPRESSORS and q > best_q:
+            best = encoding
+            best_q = q
+    return best
+
+
+def get_cache_headers(request: fastapi.Request, etag: str):
+    max_age = config.get_http_cache_max_age()
+    visibility = "public" if config.is_endpoint_public(request.url.path) else "private"
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"{visibility}, max-age={max_age}" if max_age > 0 else f"{visibility}, no-cache",
+    }
+    if config.get_compression_encodings():
+        headers["Vary"] = "Accept-Encoding"
+    return headers
+
+
+_body_cache: lru.ByteLRU | None = None
+_body_cache_lock = threading.Lock()
+
+
+def get_body_cache():
+    """
+    Byte-bounded LRU of compressed response bodies, keyed by entity tag and encoding.
+    """
+    global _body_cache
+
+    with _body_cache_lock:
+        if _body_cache is None:
+            _body_cache = lru.ByteLRU(config.get_compression_cache_size())
+        return _body_cache
+
+
+def make_encoded_response(request: fastapi.Request, etag: str, encoding: str, body: bytes):
+    headers = get_cache_headers(request, variant_etag(etag, encoding))
+    headers["Content-Encoding"] = encoding
+    return fastapi.responses.Response(body, media_type="application/json", headers=headers)
+
+
+def get_cached_response(request: fastapi.Request, etag: str):
+    """
+    Return a 304 response if the client already has the current representation, or the cached compressed body if
+    there's one for the negotiated encoding. Otherwise returns None and the caller builds it with `make_response`.
+    """
+    request.state.revalidation = memo.get_revalidation_state()
+    matched = etag_matches(request.headers.get("If-None-Match"), etag)
+    if matched is not None:
+        return fastapi.responses.Response(status_code=304, headers=get_cache_headers(request, matched))
+
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+    if encoding is not None:
+        body = get_body_cache().peek(f"{etag}:{encoding}")
+        if body is not None:
+            return make_encoded_response(request, etag, encoding, body)
+    return None
+
+
+def make_response(request: fastapi.Request, etag: str, content: Any):
+    """
+    Serialize `content` to JSON, compressing it with the negotiated encoding if it's large enough. Must be preceded by
+    `get_cached_response` on the same request.
+    """
+    # Same separators as fastapi.responses.JSONResponse.
+    body = json.dumps(
+        fastapi.encoders.jsonable_encoder(content), ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode("UTF-8")
+
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+    revalidation = memo.get_revalidation_state()
+    if revalidation[0] > 0 or revalidation != request.state.revalidation:
+        # Possibly built from manifests older than what the entity tag says, so it must not be stored anywhere.
+        headers = {"Cache-Control": "no-store"}
+        if encoding is not None and len(body) >= config.get_compression_min_size():
+            headers["Content-Encoding"] = encoding
+            body = COMPRESSORS[encoding](body, config.get_compression_level(encoding))
+        return fastapi.responses.Response(body, media_type="application/json", headers=headers)
+    elif encoding is None or len(body) < config.get_compression_min_size():
+        return fastapi.responses.Response(body, media_type="application/json", headers=get_cache_headers(request, etag))
+
+    level = config.get_compression_level(encoding)
+    compressed = get_body_cache().get(f"{etag}:{encoding}", lambda: COMPRESSORS[encoding](body, level))
+    return make_encoded_response(request, etag, encoding, compressed)
@@ -0,0 +1,115 @@
+# Copyright (c) 2023 Dark Energy Processor
+#
+# This software is provided 'as-is', without any express or implied
+# warranty. In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+
+import collections
+import concurrent.futures
+import threading
+
+from typing import Callable
+
+
+class ByteLRU:
+    """
+    LRU of byte strings bounded by their total length.
+
+    Concurrent requests for the same key wait for a single load. Subclasses can hook `load` and `evicted` to keep
+    entries somewhere else once they no longer fit in memory.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.entries: collections.OrderedDict[str, bytes] = collections.OrderedDict()
+        self.pending: dict[str, concurrent.futures.Future[bytes | None]] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str, loader: Callable[[], bytes | None]):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits = self.hits + 1
+                return self.entries[key]
+            self.misses = self.misses + 1
+            future = self.pending.get(key)
+            owner = future is None
+            if future is None:
+                future = concurrent.futures.Future()
+                self.pending[key] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            result = self.load(key, loader)
+            if result is not None:
+                self.insert(key, result)
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.pending[key]
+
+        return result
+
+    def peek(self, key: str):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits = self.hits + 1
+                return self.entries[key]
+        return None
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "size": self.size,
+                "maxSize": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def insert(self, key: str, data: bytes):
+        evicted: list[tuple[str, bytes]] = []
+        with self.lock:
+            if len(data) > self.max_size:
+                # Too large to be kept in memory at all.
+                evicted.append((key, data))
+            else:
+                self.entries[key] = data
+                self.size = self.size + len(data)
+                while self.size > self.max_size:
+                    old_key, old_data = self.entries.popitem(last=False)
+                    self.size = self.size - len(old_data)
+                    self.evictions = self.evictions + 1
+                    evicted.append((old_key, old_data))
+
+        for old_key, old_data in evicted:
+            self.evicted(old_key, old_data)
+
+    def load(self, key: str, loader: Callable[[], bytes | None]):
+        return loader()
+
+    def evicted(self, key: str, data: bytes):
+        pass
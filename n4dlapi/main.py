@@ -16,14 +16,28 @@
 #    misrepresented as being the original software.
 # 3. This notice may not be removed or altered from any source distribution.
 
+import itertools
 import subprocess
+import urllib.parse
 
 import fastapi
-import fastapi.staticfiles
 
+from . import admission
+from . import changelog
 from . import config
+from . import database
 from . import file
+from . import filecache
+from . import generation
+from . import httpcache
+from . import memo
 from . import model
+from . import origin
+from . import pagecache
+from . import shaping
+from . import urlsign
+
+from typing import Iterable
 
 DLAPI_MAJOR_VERSION = 1
 DLAPI_MINOR_VERSION = 1
@@ -36,9 +50,17 @@ except:
     NPPS4_DLAPI_GIT_COMMIT = "unknown"
 
 config.init()
+generation.start_watcher()
 
 app = fastapi.FastAPI(title="NPPS4-DLAPI", version="%d.%02d.%02d" % NPPS4_DLAPI_PROGRAM_VERSION)
-app.mount("/archive-root", fastapi.staticfiles.StaticFiles(directory=config.get_archive_root_dir()), "archive-root")
+app.add_event_handler("startup", pagecache.start)
+app.add_middleware(generation.PinArchiveRoot)
+app.add_middleware(admission.AdmissionControl)
+app.mount(
+    "/archive-root",
+    shaping.wrap(generation.ArchiveRootFiles(directory=config.get_archive_root_dir())),
+    "archive-root",
+)
 
 
 def verify_api_access(request: fastapi.Request):
@@ -47,22 +69,54 @@ def verify_api_access(request: fastapi.Request):
     return True
 
 
+def get_exclude(param: model.BatchDownloadRequestModel):
+    return file.ExcludeSet(param.exclude, param.exclude_ranges, param.exclude_bitmap)
+
+
+def resolve_urls(request: fastapi.Request, downloads: Iterable[model.DownloadInfoModel]):
+    """
+    Turn archive-root relative paths in `downloads` into full URLs.
+
+    Links point to one of the configured download origins, or to the local archive-root mount if there's none
+    available. Only links to the local mount are signed if download links have time limit, nothing would check the
+    signature on the origins.
+    """
+    local_url = str(request.url_for("archive-root", path="")).rstrip("/")
+    origins = origin.get_origins()
+    signer = urlsign.make_signer()
+    for download in downloads:
+        # Microdl paths don't start with slash.
+        path = download.url if download.url[0] == "/" else "/" + download.url
+        base_url = origins.pick(path)
+        if base_url is not None:
+            download.url = base_url + urllib.parse.quote(path)
+        elif signer is not None:
+            download.url = local_url + urllib.parse.quote(path) + "?" + signer.sign(path)
+        else:
+            download.url = local_url + urllib.parse.quote(path)
+
+
 @app.get("/api/publicinfo", dependencies=[fastapi.Depends(verify_api_access)], tags=["info"])
-def public_info_api() -> model.PublicInfoModel:
+def public_info_api(request: fastapi.Request) -> model.PublicInfoModel:
     """
     Retrieve information about the DLAPI server.
     """
-    return model.PublicInfoModel(
+    etag = httpcache.make_etag(file.get_archive_generation(), request)
+    cached = httpcache.get_cached_response(request, etag)
+    if cached is not None:
+        return cached
+
+    info = model.PublicInfoModel(
         publicApi=config.is_public_accessible(),
         dlapiVersion=model.VersionModel(major=DLAPI_MAJOR_VERSION, minor=DLAPI_MINOR_VERSION),
-        # This reference implementation doesn't impose any time limit restriction.
-        serveTimeLimit=0,
+        serveTimeLimit=config.get_serve_time_limit(),
         gameVersion="%s.%s" % file.get_latest_version(),
         application={
             "NPPS4DLAPICommit": NPPS4_DLAPI_GIT_COMMIT,
             "NPPS4DLAPIVersion": "%d.%02d.%02d" % NPPS4_DLAPI_PROGRAM_VERSION,
         },
     )
+    return httpcache.make_response(request, etag, info)
 
 
 @app.post("/api/v1/update", dependencies=[fastapi.Depends(verify_api_access)], tags=["v1"])
@@ -70,10 +124,14 @@ def update_api(request: fastapi.Request, param: model.UpdateRequestModel) -> lis
     """
     Get download links for update package to the latest version available.
     """
+    etag = httpcache.make_etag(file.get_archive_generation(), request, param.dict())
+    cached = httpcache.get_cached_response(request, etag)
+    if cached is not None:
+        return cached
+
     downloads = file.get_update_file(param.version, int(param.platform))
-    for download in downloads:
-        download.url = str(request.url_for("archive-root", path=download.url))
-    return downloads
+    resolve_urls(request, downloads)
+    return httpcache.make_response(request, etag, downloads)
 
 
 @app.post(
@@ -87,13 +145,118 @@ def batch_api(request: fastapi.Request, param: model.BatchDownloadRequestModel):
     """
     Get all download links of package IDs for specific package type.
     """
-    downloads = file.get_batch_list(int(param.package_type), int(param.platform), param.exclude)
+    etag = httpcache.make_etag(file.get_archive_generation(), request, param.dict())
+    cached = httpcache.get_cached_response(request, etag)
+    if cached is not None:
+        return cached
+
+    downloads = file.get_batch_list(int(param.package_type), int(param.platform), get_exclude(param))
     if downloads is None:
         return fastapi.responses.JSONResponse(model.ErrorResponseModel(detail="Package type not found").dict(), 404)
 
-    for download in downloads:
-        download.url = str(request.url_for("archive-root", path=download.url))
-    return downloads
+    resolve_urls(request, downloads)
+    return httpcache.make_response(request, etag, downloads)
+
+
+@app.post(
+    "/api/app/batch/stream",
+    dependencies=[fastapi.Depends(verify_api_access)],
+    response_class=fastapi.responses.StreamingResponse,
+    responses={200: {"content": {"application/x-ndjson": {}}}, 404: {"model": model.ErrorResponseModel}},
+    tags=["app"],
+)
+def batch_stream_api(request: fastapi.Request, param: model.BatchDownloadRequestModel):
+    """
+    Same as `/api/v1/batch`, but sent as newline-delimited JSON, one download per line, while the rest of the package
+    list is still being read.
+    """
+    path = file.get_batch_path(int(param.package_type), int(param.platform))
+    if path is None:
+        return fastapi.responses.JSONResponse(model.ErrorResponseModel(detail="Package type not found").dict(), 404)
+
+    def generate():
+        # One chunk per package.
+        for _, group in itertools.groupby(file.iter_batch_list(path, get_exclude(param)), lambda d: d.packageId):
+            downloads = list(group)
+            resolve_urls(request, downloads)
+            yield "".join(download.json() + "\n" for download in downloads)
+
+    return fastapi.responses.StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+@app.post(
+    "/api/app/batch/page",
+    dependencies=[fastapi.Depends(verify_api_access)],
+    response_model=model.BatchPageResponseModel,
+    responses={
+        400: {"model": model.ErrorResponseModel},
+        404: {"model": model.ErrorResponseModel},
+        409: {"model": model.ErrorResponseModel},
+    },
+    tags=["app"],
+)
+def batch_page_api(request: fastapi.Request, param: model.BatchPageRequestModel):
+    """
+    Same as `/api/v1/batch`, but returns at most `limit` packages at a time. Pass `nextCursor` of the response as
+    `cursor` to get the next page. A package is never split across pages.
+
+    Cursors are only valid until archive-root changes, after that 409 is returned and listing has to start over.
+    """
+    generation = file.get_archive_generation()
+    etag = httpcache.make_etag(generation, request, param.dict())
+    cached = httpcache.get_cached_response(request, etag)
+    if cached is not None:
+        return cached
+
+    after: int | None = None
+    if param.cursor is not None:
+        cursor_generation, _, last_id = param.cursor.rpartition("-")
+        if not last_id.isdigit():
+            return fastapi.responses.JSONResponse(model.ErrorResponseModel(detail="Invalid cursor").dict(), 400)
+        elif cursor_generation != generation[:16]:
+            return fastapi.responses.JSONResponse(model.ErrorResponseModel(detail="Cursor expired").dict(), 409)
+        after = int(last_id)
+
+    path = file.get_batch_path(int(param.package_type), int(param.platform))
+    if path is None:
+        return fastapi.responses.JSONResponse(model.ErrorResponseModel(detail="Package type not found").dict(), 404)
+
+    items: list[model.BatchDownloadInfoModel] = []
+    next_cursor: str | None = None
+    packages = itertools.groupby(file.iter_batch_list(path, get_exclude(param), after), lambda d: d.packageId)
+    for i, (package_id, downloads) in enumerate(packages):
+        if i == param.limit:
+            # There's more after this page.
+            next_cursor = f"{generation[:16]}-{items[-1].packageId}"
+            break
+        items.extend(downloads)
+
+    resolve_urls(request, items)
+    return httpcache.make_response(request, etag, model.BatchPageResponseModel(items=items, nextCursor=next_cursor))
+
+
+@app.post("/api/app/delta", dependencies=[fastapi.Depends(verify_api_access)], tags=["app"])
+def delta_api(request: fastapi.Request, param: model.DeltaRequestModel) -> model.DeltaResponseModel:
+    """
+    Get all archives of packages of the latest version added or changed since the archive-root generation identified
+    by `token`, along with the token of the current generation to pass next time.
+
+    If `token` is not specified or too old, `complete` is false and no archives are returned. The caller has to compare
+    all packages through `/api/v1/batch` instead.
+    """
+    # Changes must not be hidden behind manifests still being reloaded.
+    with memo.up_to_date():
+        token = file.get_archive_generation()
+        log = changelog.get_changelog()
+        if not log.has_generation(token):
+            # Updated in place since the archive-root watcher last looked, or it's not running at all.
+            log.record()
+        paths = log.get_delta(param.token, token)
+        items = file.get_package_archives(paths or [])
+    resolve_urls(request, items)
+    return model.DeltaResponseModel(
+        token=token, complete=paths is not None, gameVersion="%d.%d" % file.get_latest_version(), items=items
+    )
 
 
 @app.post(
@@ -111,8 +274,7 @@ def download_api(request: fastapi.Request, param: model.DownlodaRequestModel):
     if downloads is None:
         return fastapi.responses.JSONResponse(model.ErrorResponseModel(detail="Package not found").dict(), 404)
 
-    for download in downloads:
-        download.url = str(request.url_for("archive-root", path=download.url))
+    resolve_urls(request, downloads)
     return downloads
 
 
@@ -147,14 +309,55 @@ def getfile_api(request: fastapi.Request, param: model.MicroDownloadRequestModel
     Get single file from package type 4 a.k.a. micro download.
     """
     downloads = [file.get_microdl_file(p, int(param.platform)) for p in param.files]
-    for download in downloads:
-        download.url = str(request.url_for("archive-root", path=download.url))
+    resolve_urls(request, downloads)
     return downloads
 
 
+@app.post(
+    "/api/app/getfile",
+    dependencies=[fastapi.Depends(verify_api_access)],
+    response_model=list[model.DownloadInfoModel],
+    tags=["app"],
+)
+def getfile_query_api(request: fastapi.Request, param: model.MicroDownloadQueryModel):
+    """
+    Same as `/api/v1/getfile`, but returns every microdl file under the directories in `prefixes` or matching any of
+    the glob `patterns` (where `*` matches `/` too), instead of listing each file.
+
+    Empty prefixes and patterns starting with a wildcard are rejected, as they would list the whole manifest.
+    """
+    etag = httpcache.make_etag(file.get_archive_generation(), request, param.dict())
+    cached = httpcache.get_cached_response(request, etag)
+    if cached is not None:
+        return cached
+
+    downloads = file.find_microdl_files(param.prefixes, param.patterns, int(param.platform))
+    resolve_urls(request, downloads)
+    return httpcache.make_response(request, etag, downloads)
+
+
 @app.get("/api/v1/release_info", dependencies=[fastapi.Depends(verify_api_access)], tags=["v1"])
-def release_info_api() -> dict[str, str]:
+def release_info_api(request: fastapi.Request) -> dict[str, str]:
     """
     Get available `release_info` keys.
     """
-    return file.get_release_info()
+    etag = httpcache.make_etag(file.get_archive_generation(), request)
+    cached = httpcache.get_cached_response(request, etag)
+    if cached is not None:
+        return cached
+
+    return httpcache.make_response(request, etag, file.get_release_info())
+
+
+@app.get("/api/app/stats", dependencies=[fastapi.Depends(verify_api_access)], tags=["app"])
+def stats_api() -> model.StatsModel:
+    """
+    Get memory usage and hit counts of the server caches, and load of endpoints with concurrency limits.
+    """
+    return model.StatsModel(
+        manifest=model.CacheStatsModel(**memo.get_cache().get_stats()),
+        database=model.CacheStatsModel(**database.get_cache().get_stats()),
+        compressedBody=model.CacheStatsModel(**httpcache.get_body_cache().get_stats()),
+        smallFile=model.CacheStatsModel(**filecache.get_cache().get_stats()),
+        admission={k: model.AdmissionStatsModel(**v) for k, v in admission.get_stats().items()},
+    )
@@ -0,0 +1,112 @@
+# Copyright (c) 2023 Dark Energy Processor
+#
+# This software is provided 'as-is', without any express or implied
+# warranty. In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+
+import array
+import bisect
+import fnmatch
+import re
+import sys
+
+from typing import Any, NamedTuple
+
+
+class ManifestEntry(NamedTuple):
+    name: str
+    size: int
+    md5: str
+    sha256: str
+
+
+class Manifest:
+    """
+    Columnar form of `infov2.json`.
+
+    Sizes are kept in an array and digests as raw bytes, and hex strings are only made for entries that end up in a
+    response. See `benchmark_manifest.py` for how much memory this saves over the parsed JSON.
+    """
+
+    __slots__ = ("names", "sizes", "md5", "sha256")
+
+    def __init__(self, data: list[dict[str, Any]]):
+        # Archive names like "1.zip" repeat in every package.
+        self.names = [sys.intern(d["name"]) for d in data]
+        self.sizes = array.array("q", [d["size"] for d in data])
+        self.md5 = b"".join(bytes.fromhex(d["md5"]) for d in data)
+        self.sha256 = b"".join(bytes.fromhex(d["sha256"]) for d in data)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __sizeof__(self):
+        # Names are mostly interned, so this overestimates a bit.
+        size = object.__sizeof__(self) + sys.getsizeof(self.names) + sum(sys.getsizeof(n) for n in self.names)
+        return size + sys.getsizeof(self.sizes) + sys.getsizeof(self.md5) + sys.getsizeof(self.sha256)
+
+    def __getitem__(self, index: int):
+        return ManifestEntry(
+            self.names[index],
+            self.sizes[index],
+            self.md5[index * 16 : index * 16 + 16].hex(),
+            self.sha256[index * 32 : index * 32 + 32].hex(),
+        )
+
+    def __iter__(self):
+        for i in range(len(self.names)):
+            yield self[i]
+
+    def get(self, name: str):
+        try:
+            return self[self.names.index(name)]
+        except ValueError:
+            return None
+
+
+class MicrodlManifest(Manifest):
+    """
+    Columnar form of microdl `info.json`, which maps file name to its size and digests.
+
+    Entries are sorted by name and looked up by binary search, which is much smaller than a dict over tens of
+    thousands of names.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, data: dict[str, dict[str, Any]]):
+        super().__init__([dict(data[k], name=k) for k in sorted(data)])
+
+    def get(self, name: str):
+        index = bisect.bisect_left(self.names, name)
+        if index < len(self.names) and self.names[index] == name:
+            return self[index]
+        return None
+
+    def find_prefix(self, prefix: str):
+        """
+        Indices of names starting with `prefix`.
+        """
+        start = bisect.bisect_left(self.names, prefix)
+        return range(start, bisect.bisect_left(self.names, prefix + "\U0010ffff", start))
+
+    def glob(self, pattern: str):
+        """
+        Indices of names matching shell-style `pattern`. Only names starting with the part before the first wildcard
+        are tested.
+        """
+        literal = re.split(r"[*?[]", pattern, maxsplit=1)[0]
+        regex = re.compile(fnmatch.translate(pattern))
+        return [i for i in self.find_prefix(literal) if regex.match(self.names[i])]
@@ -0,0 +1,254 @@
+# Copyright (c) 2023 Dark Energy Processor
+#
+# This software is provided 'as-is', without any express or implied
+# warranty. In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+
+import collections
+import concurrent.futures
+import contextlib
+import dataclasses
+import fnmatch
+import itertools
+import os
+import sys
+import threading
+
+from . import config
+
+from typing import Any, Callable, Generic, TypeVar
+
+_T = TypeVar("_T")
+
+
+def estimate_size(obj: Any) -> int:
+    """
+    Approximate memory used by parsed JSON. Other objects are expected to account for their contents in `__sizeof__`.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size = size + estimate_size(k) + estimate_size(v)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            size = size + estimate_size(v)
+    return size
+
+
+@dataclasses.dataclass
+class MemoEntry:
+    mtime: int
+    value: Any
+    size: int
+    pinned: bool
+
+
+class MemoCache:
+    """
+    LRU shared by all memoized functions, bounded by estimated size of the results. Pinned entries are never evicted,
+    and are kept apart so eviction only walks the LRU order.
+    """
+
+    def __init__(self, max_size: int, pin: list[str]):
+        self.max_size = max_size
+        self.pin = pin
+        self.entries: collections.OrderedDict[tuple[str, str], MemoEntry] = collections.OrderedDict()
+        self.pinned: dict[tuple[str, str], MemoEntry] = {}
+        self.size = 0
+        self.pinned_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def is_pinned(self, path: str):
+        root_dir = config.get_archive_root_dir() + "/"
+        if not path.startswith(root_dir):
+            return False
+        relpath = path[len(root_dir) :]
+        return any(fnmatch.fnmatchcase(relpath, pattern) for pattern in self.pin)
+
+    def get(self, key: tuple[str, str]):
+        with self.lock:
+            entry = self.pinned.get(key)
+            if entry is None:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: tuple[str, str], mtime: int, value: Any):
+        entry = MemoEntry(mtime, value, estimate_size(value), self.is_pinned(key[1]))
+        with self.lock:
+            self.remove(key)
+            self.size = self.size + entry.size
+            if entry.pinned:
+                self.pinned[key] = entry
+                self.pinned_size = self.pinned_size + entry.size
+            else:
+                self.entries[key] = entry
+            # The entry just added is kept even if it doesn't fit by itself.
+            while self.size > self.max_size and len(self.entries) > (0 if entry.pinned else 1):
+                _, old_entry = self.entries.popitem(last=False)
+                self.size = self.size - old_entry.size
+                self.evictions = self.evictions + 1
+
+    def remove(self, key: tuple[str, str]):
+        with self.lock:
+            entry = self.entries.pop(key, None) or self.pinned.pop(key, None)
+            if entry is not None:
+                self.size = self.size - entry.size
+                if entry.pinned:
+                    self.pinned_size = self.pinned_size - entry.size
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries) + len(self.pinned),
+                "size": self.size,
+                "maxSize": self.max_size,
+                "pinnedSize": self.pinned_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def forget(self, name: str, prefix: str):
+        with self.lock:
+            for key in [
+                k for k in itertools.chain(self.entries, self.pinned) if k[0] == name and k[1].startswith(prefix)
+            ]:
+                self.remove(key)
+
+
+_cache: MemoCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = MemoCache(config.get_manifest_cache_size(), config.get_manifest_cache_pin())
+        return _cache
+
+
+_revalidate_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="revalidate")
+_revalidate_lock = threading.Lock()
+# Number of background reloads in progress and finished so far. See get_revalidation_state.
+_revalidating = 0
+_revalidated = 0
+_loading = threading.local()
+
+
+class MemoizeByModTime(Generic[_T]):
+    """
+    Cache results of `f(path)` until the file modification time changes.
+
+    Concurrent misses on the same path wait for a single load. Once a path is loaded, a changed file is reloaded in
+    the background and callers keep getting the old result until it finishes. Results are kept in the shared
+    `MemoCache`, so they may be evicted and loaded again later.
+    """
+
+    def __init__(self, f: Callable[[str], _T]):
+        self.f = f
+        self.name = f.__qualname__
+        self.pending: dict[str, concurrent.futures.Future[_T]] = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, path: str) -> _T:
+        global _revalidating
+
+        stat = os.stat(path)
+        cache = get_cache()
+        with self.lock:
+            entry = cache.get((self.name, path))
+            if entry is not None and stat.st_mtime_ns <= entry.mtime:
+                cache.hits = cache.hits + 1
+                return entry.value
+
+            future = self.pending.get(path)
+            owner = future is None
+            if future is None:
+                future = concurrent.futures.Future()
+                self.pending[path] = future
+
+            # Results of nested calls must be up-to-date, otherwise the outer result is stored with new modification
+            # time and stale content.
+            if entry is not None and not getattr(_loading, "active", False):
+                if owner:
+                    with _revalidate_lock:
+                        _revalidating = _revalidating + 1
+                    _revalidate_executor.submit(self._revalidate, path, future)
+                cache.hits = cache.hits + 1
+                return entry.value
+
+            cache.misses = cache.misses + 1
+
+        if not owner:
+            return future.result()
+
+        self._load(path, future)
+        return future.result()
+
+    def forget(self, prefix: str):
+        get_cache().forget(self.name, prefix)
+
+    def _load(self, path: str, future: concurrent.futures.Future[_T]):
+        nested = getattr(_loading, "active", False)
+        _loading.active = True
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            result = self.f(path)
+            get_cache().put((self.name, path), mtime, result)
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            _loading.active = nested
+            with self.lock:
+                del self.pending[path]
+
+    def _revalidate(self, path: str, future: concurrent.futures.Future[_T]):
+        global _revalidating, _revalidated
+
+        # On failure, e.g. file is still being written, the old result is kept and the next call tries again.
+        self._load(path, future)
+        with _revalidate_lock:
+            _revalidating = _revalidating - 1
+            _revalidated = _revalidated + 1
+
+
+@contextlib.contextmanager
+def up_to_date():
+    """
+    Memoized functions called in this block wait for changed files to be reloaded instead of returning old results.
+    """
+    nested = getattr(_loading, "active", False)
+    _loading.active = True
+    try:
+        yield
+    finally:
+        _loading.active = nested
+
+
+def get_revalidation_state():
+    """
+    Responses built while this changes, or while it reports a reload in progress, may mix old and new manifests and
+    shouldn't be cached.
+    """
+    with _revalidate_lock:
+        return _revalidating, _revalidated
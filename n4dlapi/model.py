@@ -16,10 +16,15 @@
 #    misrepresented as being the original software.
 # 3. This notice may not be removed or altered from any source distribution.
 
+import base64
+import binascii
 import enum
+import re
 
 import pydantic
 
+from typing import Any
+
 
 class PlatformType(enum.IntEnum):
     """
@@ -121,6 +126,26 @@ class BatchDownloadInfoModel(DownloadInfoModel):
         }
 
 
+class DeltaDownloadInfoModel(BatchDownloadInfoModel):
+    packageType: PackageType
+    platform: PlatformType
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "url": "http://localhost/download/4_1874_59.4.zip",
+                "size": 12345,
+                "packageId": 1874,
+                "packageType": 4,
+                "platform": 1,
+                "checksums": {
+                    "md5": "d41d8cd98f00b204e9800998ecf8427e",
+                    "sha256": "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855",
+                },
+            }
+        }
+
+
 class UpdateRequestModel(pydantic.BaseModel):
     version: str
     platform: PlatformType
@@ -133,9 +158,64 @@ class BatchDownloadRequestModel(pydantic.BaseModel):
     package_type: PackageType
     platform: PlatformType
     exclude: list[int] = []
+    # Extensions of this implementation. Inclusive [first, last] package ID ranges, and base64 of a bitmap where bit
+    # `id % 8` of byte `id // 8` is set for excluded package IDs.
+    exclude_ranges: list[tuple[pydantic.NonNegativeInt, pydantic.NonNegativeInt]] = []
+    exclude_bitmap: bytes = b""
+
+    @pydantic.validator("exclude_bitmap", pre=True)
+    def decode_exclude_bitmap(cls, value: Any):
+        if not isinstance(value, str):
+            raise ValueError("must be base64 string")
+        try:
+            return base64.b64decode(value, validate=True)
+        except binascii.Error:
+            raise ValueError("invalid base64")
 
     class Config:
-        schema_extra = {"example": {"package_type": 4, "platform": 1, "exclude": [1874]}}
+        schema_extra = {
+            "example": {
+                "package_type": 4,
+                "platform": 1,
+                "exclude": [1874],
+                "exclude_ranges": [[1, 1800]],
+                "exclude_bitmap": "",
+            }
+        }
+
+
+class BatchPageRequestModel(BatchDownloadRequestModel):
+    cursor: str | None = None
+    limit: int = pydantic.Field(100, ge=1, le=1000)
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "package_type": 1,
+                "platform": 1,
+                "exclude": [],
+                "exclude_ranges": [],
+                "exclude_bitmap": "",
+                "cursor": None,
+                "limit": 100,
+            }
+        }
+
+
+class BatchPageResponseModel(pydantic.BaseModel):
+    items: list[BatchDownloadInfoModel]
+    nextCursor: str | None
+
+
+class DeltaRequestModel(pydantic.BaseModel):
+    token: str | None = None
+
+
+class DeltaResponseModel(pydantic.BaseModel):
+    token: str
+    complete: bool
+    gameVersion: str
+    items: list[DeltaDownloadInfoModel]
 
 
 class DownlodaRequestModel(pydantic.BaseModel):
@@ -152,5 +232,110 @@ class MicroDownloadRequestModel(pydantic.BaseModel):
     platform: PlatformType
 
 
+class MicroDownloadQueryModel(pydantic.BaseModel):
+    prefixes: list[str] = []
+    patterns: list[str] = []
+    platform: PlatformType
+
+    # Queries must be limited to some directory, listing the whole microdl manifest is what /api/v1/batch is for.
+    @pydantic.validator("prefixes", each_item=True)
+    def validate_prefix(cls, value: str):
+        if not value.replace("\\", "/").strip("/"):
+            raise ValueError("prefix must not be empty")
+        return value
+
+    @pydantic.validator("patterns", each_item=True)
+    def validate_pattern(cls, value: str):
+        if not re.split(r"[*?[]", value.replace("\\", "/").lstrip("/"), maxsplit=1)[0]:
+            raise ValueError("pattern must not start with a wildcard")
+        return value
+
+    class Config:
+        schema_extra = {
+            "example": {"prefixes": ["assets/image/unit"], "patterns": ["assets/sound/voice/*.mp3"], "platform": 1}
+        }
+
+
+class CacheStatsModel(pydantic.BaseModel):
+    entries: int
+    size: int
+    maxSize: int
+    pinnedSize: int = 0
+    hits: int
+    misses: int
+    evictions: int
+    rejected: int = 0
+
+
+class AdmissionStatsModel(pydantic.BaseModel):
+    active: int
+    waiting: int
+    maxConcurrent: int
+    maxQueue: int
+    admitted: int
+    rejected: int
+
+
+class StatsModel(pydantic.BaseModel):
+    manifest: CacheStatsModel
+    database: CacheStatsModel
+    compressedBody: CacheStatsModel
+    smallFile: CacheStatsModel
+    admission: dict[str, AdmissionStatsModel] = {}
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "manifest": {
+                    "entries": 1520,
+                    "size": 4718592,
+                    "maxSize": 268435456,
+                    "pinnedSize": 2097152,
+                    "hits": 81234,
+                    "misses": 1620,
+                    "evictions": 0,
+                },
+                "database": {
+                    "entries": 3,
+                    "size": 20971520,
+                    "maxSize": 67108864,
+                    "pinnedSize": 0,
+                    "hits": 12,
+                    "misses": 3,
+                    "evictions": 0,
+                },
+                "compressedBody": {
+                    "entries": 8,
+                    "size": 65536,
+                    "maxSize": 33554432,
+                    "pinnedSize": 0,
+                    "hits": 310,
+                    "misses": 8,
+                    "evictions": 0,
+                },
+                "smallFile": {
+                    "entries": 4096,
+                    "size": 8388608,
+                    "maxSize": 67108864,
+                    "pinnedSize": 0,
+                    "hits": 250000,
+                    "misses": 9000,
+                    "evictions": 0,
+                    "rejected": 120,
+                },
+                "admission": {
+                    "/api/v1/batch": {
+                        "active": 4,
+                        "waiting": 1,
+                        "maxConcurrent": 4,
+                        "maxQueue": 8,
+                        "admitted": 1200,
+                        "rejected": 3,
+                    }
+                },
+            }
+        }
+
+
 class ErrorResponseModel(pydantic.BaseModel):
     detail: str
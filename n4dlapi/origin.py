@@ -0,0 +1,111 @@
+# Copyright (c) 2023 Dark Energy Processor
+#
+# This software is provided 'as-is', without any express or implied
+# warranty. In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+
+import threading
+import time
+import urllib.request
+import zlib
+
+from . import config
+
+PLATFORMS = ["iOS", "Android"]
+
+
+class OriginSet:
+    """
+    Download origins serving a copy of archive-root, e.g. nginx or object storage mirror.
+
+    Each origin is periodically probed by requesting the health check path. Links are only handed out for origins that
+    passed their last probe. If none did, `pick` returns None and the caller falls back to the local mount.
+    """
+
+    def __init__(self, origins: list[str], shard: str, health_path: str, health_interval: int):
+        self.origins = origins
+        self.shard = shard
+        self.health_path = health_path
+        self.health_interval = health_interval
+        # Assume healthy until proven otherwise, so a restart doesn't send everything to the local mount.
+        self.healthy = [True] * len(origins)
+        self.thread: threading.Thread | None = None
+        if origins and health_interval > 0:
+            self.thread = threading.Thread(target=self._health_loop, name="origin-health", daemon=True)
+            self.thread.start()
+
+    def check(self, origin: str):
+        request = urllib.request.Request(f"{origin}/{self.health_path}", method="HEAD")
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return 200 <= response.status < 300
+        except Exception:
+            return False
+
+    def _health_loop(self):
+        while True:
+            time.sleep(self.health_interval)
+            healthy = [self.check(origin) for origin in self.origins]
+            for origin, old, new in zip(self.origins, self.healthy, healthy):
+                if old != new:
+                    print("Download origin", origin, "is now", "healthy" if new else "unhealthy")
+            self.healthy = healthy
+
+    def get_state(self):
+        """
+        Which origins are in use. Changes whenever generated links would change.
+        """
+        return "".join("1" if h else "0" for h in self.healthy)
+
+    def pick(self, path: str):
+        """
+        Origin to serve archive-root relative `path` from, or None to use the local mount.
+        """
+        if not self.origins:
+            return None
+
+        if self.shard == "path":
+            start = zlib.crc32(path.encode("UTF-8"))
+        elif self.shard == "platform":
+            # Paths start with "/<OS>/".
+            platform = path.split("/", 2)[1]
+            start = PLATFORMS.index(platform) if platform in PLATFORMS else 0
+        else:
+            start = 0
+
+        # Walk to the next healthy origin, so only links of the failed origin move.
+        healthy = self.healthy
+        count = len(self.origins)
+        for i in range(count):
+            index = (start + i) % count
+            if healthy[index]:
+                return self.origins[index]
+        return None
+
+
+_origins: OriginSet | None = None
+_origins_lock = threading.Lock()
+
+
+def get_origins():
+    global _origins
+
+    with _origins_lock:
+        if _origins is None:
+            health_path, health_interval = config.get_download_health_check()
+            _origins = OriginSet(
+                config.get_download_origins(), config.get_download_shard(), health_path, health_interval
+            )
+        return _origins
@@ -0,0 +1,206 @@
+# Copyright (c) 2023 Dark Energy Processor
+#
+# This software is provided 'as-is', without any express or implied
+# warranty. In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+
+import collections
+import json
+import os
+import threading
+import time
+import traceback
+
+import anyio
+import starlette.responses
+import starlette.types
+
+from . import config
+from . import file
+
+# Access counts of archive-root files, relative to archive-root.
+_access: collections.Counter[str] = collections.Counter()
+_access_lock = threading.Lock()
+STATS_SAVE_INTERVAL = 300
+STATS_MAX_ENTRIES = 1000
+
+
+def advise(path: str, length: int, advice: int):
+    """
+    Hint the kernel about upcoming reads of the first `length` bytes (0 is whole file) of `path`. Does nothing where
+    posix_fadvise isn't available.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, length, advice)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def advise_download(fd: int):
+    """
+    Hint that an opened file is about to be read sequentially from the start, and start reading its beginning so the
+    transfer doesn't wait for the disk.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        length = config.get_pagecache_readahead()
+        if length > 0:
+            os.posix_fadvise(fd, 0, length, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+
+
+class SequentialFileResponse(starlette.responses.FileResponse):
+    """
+    FileResponse giving the kernel access hints on the file handle it serves from.
+    """
+
+    async def __call__(
+        self, scope: starlette.types.Scope, receive: starlette.types.Receive, send: starlette.types.Send
+    ):
+        if self.send_header_only or self.stat_result is None:
+            return await super().__call__(scope, receive, send)
+
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        async with await anyio.open_file(self.path, mode="rb") as f:
+            await anyio.to_thread.run_sync(advise_download, f.wrapped.fileno())
+            more_body = True
+            while more_body:
+                chunk = await f.read(self.chunk_size)
+                more_body = len(chunk) == self.chunk_size
+                await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+        if self.background is not None:
+            await self.background()
+
+
+def record_access(relpath: str):
+    if config.get_pagecache_stats_file() is not None:
+        with _access_lock:
+            _access[relpath] = _access[relpath] + 1
+
+
+def load_access_stats():
+    stats_file = config.get_pagecache_stats_file()
+    if stats_file is None:
+        return []
+    try:
+        with open(stats_file, "r", encoding="UTF-8", newline="") as f:
+            counts: dict[str, int] = json.load(f)
+    except (OSError, ValueError):
+        return []
+    with _access_lock:
+        for relpath, count in counts.items():
+            _access[relpath] = max(_access[relpath], count)
+    return sorted(counts, key=lambda k: counts[k], reverse=True)
+
+
+def save_access_stats():
+    stats_file = config.get_pagecache_stats_file()
+    if stats_file is None:
+        return
+    with _access_lock:
+        counts = dict(_access.most_common(STATS_MAX_ENTRIES))
+    temp_file = stats_file + ".tmp"
+    with open(temp_file, "w", encoding="UTF-8", newline="") as f:
+        json.dump(counts, f)
+    os.replace(temp_file, stats_file)
+
+
+def get_hot_set():
+    """
+    Archive-root relative paths worth having in page cache, most important first: most downloaded files if access
+    statistics are recorded, then archives of the newest update, bootstrap package and decrypted databases.
+    """
+    root_dir = config.get_archive_root_dir()
+    paths = load_access_stats()
+    latest = file.version_string(file.get_latest_version())
+    for platform in file._PLATFORM_MAP:
+        update_path = f"{platform}/update"
+        if os.path.isfile(f"{root_dir}/{update_path}/infov2.json"):
+            versions = file.get_versions(f"{root_dir}/{update_path}/infov2.json")
+            if versions:
+                newest_path = f"{update_path}/{file.version_string(versions[-1])}"
+                paths.extend(
+                    f"{newest_path}/{e.name}" for e in file.read_manifest(f"{root_dir}/{newest_path}/infov2.json")
+                )
+
+        bootstrap_path = f"{platform}/package/{latest}/0"
+        if os.path.isfile(f"{root_dir}/{bootstrap_path}/info.json"):
+            for pkgid in file.read_json(f"{root_dir}/{bootstrap_path}/info.json"):
+                paths.extend(
+                    f"{bootstrap_path}/{pkgid}/{e.name}"
+                    for e in file.read_manifest(f"{root_dir}/{bootstrap_path}/{pkgid}/infov2.json")
+                )
+
+        db_path = f"{platform}/package/{latest}/db"
+        if os.path.isdir(f"{root_dir}/{db_path}"):
+            paths.extend(f"{db_path}/{d.name}" for d in os.scandir(f"{root_dir}/{db_path}") if d.name.endswith(".db_"))
+
+    return list(dict.fromkeys(paths))
+
+
+def warm_up():
+    """
+    Ask the kernel to load the hot set of the current archive-root into page cache, up to the configured budget.
+    """
+    budget = config.get_pagecache_warm_budget()
+    if budget == 0 or not hasattr(os, "posix_fadvise"):
+        return
+
+    root_dir = config.get_archive_root_dir()
+    warmed = 0
+    count = 0
+    for relpath in get_hot_set():
+        try:
+            size = os.stat(f"{root_dir}/{relpath}").st_size
+        except OSError:
+            continue
+        if warmed + size > budget:
+            break
+        advise(f"{root_dir}/{relpath}", 0, os.POSIX_FADV_WILLNEED)
+        warmed = warmed + size
+        count = count + 1
+    print("Page cache warm-up:", count, "files,", warmed, "bytes")
+
+
+def _background():
+    try:
+        warm_up()
+    except Exception:
+        traceback.print_exc()
+    while config.get_pagecache_stats_file() is not None:
+        time.sleep(STATS_SAVE_INTERVAL)
+        try:
+            save_access_stats()
+        except OSError:
+            traceback.print_exc()
+
+
+def start():
+    """
+    Warm up page cache and save access statistics in background. Called on application startup.
+    """
+    if config.get_pagecache_warm_budget() > 0 or config.get_pagecache_stats_file() is not None:
+        threading.Thread(target=_background, name="pagecache", daemon=True).start()
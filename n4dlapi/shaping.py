@@ -0,0 +1,179 @@
+# Copyright (c) 2023 Dark Energy Processor
+#
+# This software is provided 'as-is', without any express or implied
+# warranty. In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+
+import asyncio
+import time
+
+import starlette.types
+
+from . import config
+
+from typing import Any
+
+
+class TokenBucket:
+    """
+    Asynchronous token bucket. Consumers may go into debt and sleep it off, so a transfer only waits for its own
+    chunk and concurrent transfers of the same client share the rate.
+    """
+
+    def __init__(self, rate: int, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.last) * self.rate, self.burst)
+        self.last = now
+
+    async def consume(self, amount: int):
+        self.refill()
+        self.tokens = self.tokens - amount
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+    def is_full(self):
+        self.refill()
+        return self.tokens >= self.burst
+
+
+class ClientState:
+    def __init__(self, rate: int, burst: int):
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.transfers = 0
+
+
+class _TooManyTransfers(Exception):
+    pass
+
+
+class TrafficShaper:
+    """
+    ASGI wrapper limiting bandwidth and concurrent transfers of each client.
+
+    Responses up to `small_file_size` bytes, like the few files a game client fetches, are never limited. Larger
+    ones count as bulk transfers: each client gets `rate` bytes per second and `max_transfers` concurrent transfers,
+    and all bulk transfers together get `bulk_rate` bytes per second, so mirrors can't take the whole uplink.
+    Clients over their transfer limit get 429 before any file is read. Throttled transfers only sleep in the event
+    loop, they hold no threads.
+    """
+
+    MAX_IDLE_CLIENTS = 4096
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, app: starlette.types.ASGIApp, settings: dict[str, Any]):
+        self.app = app
+        self.rate: int = settings["rate"]
+        self.burst: int = settings["burst"]
+        self.max_transfers: int = settings["max_transfers"]
+        self.small_file_size: int = settings["small_file_size"]
+        self.client_header: bytes | None = (
+            None if settings["client_header"] is None else settings["client_header"].lower().encode("latin-1")
+        )
+        self.trusted_proxies: int = settings["trusted_proxies"]
+        bulk_rate: int = settings["bulk_rate"]
+        self.bulk_bucket = TokenBucket(bulk_rate, bulk_rate) if bulk_rate > 0 else None
+        self.clients: dict[str, ClientState] = {}
+        self.last_sweep = time.monotonic()
+
+    def is_enabled(self):
+        return self.rate > 0 or self.max_transfers > 0 or self.bulk_bucket is not None
+
+    def get_client_id(self, scope: starlette.types.Scope):
+        headers: list[tuple[bytes, bytes]] = scope.get("headers", [])
+        addresses: list[str] = []
+        for name, value in headers:
+            if name == b"dlapi-shared-key":
+                # Everyone using the right key is the same client. Any other key would give a fresh bucket each time.
+                if config.is_shared_key(value.decode("latin-1")):
+                    return "key:"
+            elif name == self.client_header:
+                # e.g. X-Forwarded-For, where each proxy appends the address it got the request from.
+                addresses.extend(a.strip() for a in value.decode("latin-1").split(","))
+        if addresses:
+            # Entries left of the ones our own proxies appended are up to the client, so they can't tell clients apart.
+            return addresses[max(len(addresses) - self.trusted_proxies, 0)]
+        client = scope.get("client")
+        return "" if client is None else client[0]
+
+    def forget_idle_clients(self):
+        # Clients that have nothing running and used up nothing of their burst are the same as new ones.
+        for key in [
+            k for k, v in self.clients.items() if v.transfers == 0 and (v.bucket is None or v.bucket.is_full())
+        ]:
+            del self.clients[key]
+        self.last_sweep = time.monotonic()
+
+    def get_client(self, client_id: str):
+        client = self.clients.get(client_id)
+        if client is None:
+            if len(self.clients) >= self.MAX_IDLE_CLIENTS or time.monotonic() - self.last_sweep >= self.SWEEP_INTERVAL:
+                self.forget_idle_clients()
+            client = ClientState(self.rate, self.burst)
+            self.clients[client_id] = client
+        return client
+
+    async def __call__(
+        self, scope: starlette.types.Scope, receive: starlette.types.Receive, send: starlette.types.Send
+    ):
+        if scope["type"] != "http" or not self.is_enabled():
+            return await self.app(scope, receive, send)
+
+        client = self.get_client(self.get_client_id(scope))
+        bulk = False
+
+        async def shaped_send(message: starlette.types.Message):
+            nonlocal bulk
+
+            if message["type"] == "http.response.start":
+                headers: list[tuple[bytes, bytes]] = message.get("headers", [])
+                size = next((int(v) for k, v in headers if k.lower() == b"content-length"), None)
+                if size is None or size > self.small_file_size:
+                    if self.max_transfers > 0 and client.transfers >= self.max_transfers:
+                        raise _TooManyTransfers()
+                    client.transfers = client.transfers + 1
+                    bulk = True
+            elif message["type"] == "http.response.body" and bulk:
+                amount = len(message.get("body", b""))
+                if client.bucket is not None:
+                    await client.bucket.consume(amount)
+                if self.bulk_bucket is not None:
+                    await self.bulk_bucket.consume(amount)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, shaped_send)
+        except _TooManyTransfers:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 429,
+                    "headers": [(b"content-length", b"0"), (b"retry-after", b"1")],
+                }
+            )
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            if bulk:
+                client.transfers = client.transfers - 1
+
+
+def wrap(app: starlette.types.ASGIApp):
+    shaper = TrafficShaper(app, config.get_archive_root_shaping())
+    return shaper if shaper.is_enabled() else app
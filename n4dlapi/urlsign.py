@@ -0,0 +1,110 @@
+# Copyright (c) 2023 Dark Energy Processor
+#
+# This software is provided 'as-is', without any express or implied
+# warranty. In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+
+import base64
+import hashlib
+import hmac
+import os
+import time
+import urllib.parse
+
+import fastapi.staticfiles
+import starlette.exceptions
+import starlette.types
+
+from . import config
+
+
+def normalize_path(path: str):
+    # Same normalization StaticFiles does before looking up the file.
+    return os.path.normpath(os.path.join(*path.split("/")))
+
+
+def get_expiry(now: int | None = None):
+    """
+    Expiry time for links handed out now, or 0 if links don't expire.
+
+    Rounded up to a tenth of the time limit, so links stay the same for a while and responses containing them can
+    still be cached.
+    """
+    time_limit = config.get_serve_time_limit()
+    if time_limit == 0:
+        return 0
+    bucket = max(time_limit // 10, 1)
+    now = int(time.time()) if now is None else now
+    return (now // bucket + 1) * bucket + time_limit
+
+
+class UrlSigner:
+    """
+    Signs many paths with the same expiry time. The HMAC state after the expiry prefix is computed once and copied for
+    each path.
+    """
+
+    def __init__(self, secret: bytes, expires: int):
+        self.expires = expires
+        self.prefix = hmac.new(secret, f"{expires}:".encode("UTF-8"), hashlib.sha256)
+
+    def signature(self, path: str):
+        mac = self.prefix.copy()
+        mac.update(normalize_path(path).encode("UTF-8"))
+        return base64.urlsafe_b64encode(mac.digest()[:16]).rstrip(b"=").decode("UTF-8")
+
+    def sign(self, path: str):
+        """
+        Returns query string to append to URL of `path`.
+        """
+        return f"expires={self.expires}&signature={self.signature(path)}"
+
+
+def make_signer():
+    expires = get_expiry()
+    secret = config.get_signing_secret()
+    if expires == 0 or secret is None:
+        return None
+    return UrlSigner(secret, expires)
+
+
+def verify(path: str, query_string: bytes):
+    secret = config.get_signing_secret()
+    if config.get_serve_time_limit() == 0 or secret is None:
+        return True
+
+    query = urllib.parse.parse_qs(query_string.decode("latin-1"))
+    try:
+        expires = int(query["expires"][0])
+        signature = query["signature"][0]
+    except (KeyError, ValueError):
+        return False
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(UrlSigner(secret, expires).signature(path), signature)
+
+
+class SignedStaticFiles(fastapi.staticfiles.StaticFiles):
+    """
+    StaticFiles that rejects requests without valid signature before touching the filesystem.
+    """
+
+    async def get_response(self, path: str, scope: starlette.types.Scope):
+        if not verify(path, scope.get("query_string", b"")):
+            raise starlette.exceptions.HTTPException(status_code=403)
+        return await self.get_verified_response(path, scope)
+
+    async def get_verified_response(self, path: str, scope: starlette.types.Scope):
+        return await super().get_response(path, scope)
@@ -0,0 +1,118 @@
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+
+# n4dlapi loads its config on import, so this has to be imported before it.
+
+SHARED_KEY = "test-key"
+PLATFORMS = ["iOS", "Android"]
+VERSION = "59.2"
+
+
+def write_json(path: str, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="UTF-8", newline="") as f:
+        json.dump(data, f)
+
+
+def write_zip(path: str, files: dict[str, bytes]):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with zipfile.ZipFile(path, "w") as z:
+        for name, data in files.items():
+            z.writestr(name, data)
+    return get_infov2(path)
+
+
+def get_infov2(path: str):
+    with open(path, "rb") as f:
+        data = f.read()
+    return {
+        "name": os.path.basename(path),
+        "size": len(data),
+        "md5": hashlib.md5(data).hexdigest(),
+        "sha256": hashlib.sha256(data).hexdigest(),
+    }
+
+
+def write_package(root: str, platform: str, package_type: int, package_id: int, files: list[dict[str, bytes]]):
+    path = f"{root}/{platform}/package/{VERSION}/{package_type}/{package_id}"
+    infov2 = [write_zip(f"{path}/{i}.zip", archive) for i, archive in enumerate(files, 1)]
+    write_json(f"{path}/info.json", {info["name"]: info["size"] for info in infov2})
+    write_json(f"{path}/infov2.json", infov2)
+
+
+def touch(path: str):
+    # A second ahead, so it counts as modified however coarse file system timestamps are.
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def make_archive_root(root: str):
+    """
+    Small archive-root with two update versions, packages 1-5 of every package type except 0 and a few microdl files.
+    """
+    for platform in PLATFORMS:
+        update_path = f"{root}/{platform}/update"
+        write_json(f"{update_path}/info.json", ["59.1", VERSION])
+        write_json(f"{update_path}/infov2.json", ["59.1", VERSION])
+        for version in ("59.1", VERSION):
+            infov2 = [write_zip(f"{update_path}/{version}/1.zip", {"update.txt": version.encode("UTF-8")})]
+            write_json(f"{update_path}/{version}/info.json", {"1.zip": infov2[0]["size"]})
+            write_json(f"{update_path}/{version}/infov2.json", infov2)
+
+        package_path = f"{root}/{platform}/package"
+        write_json(f"{package_path}/info.json", [VERSION])
+        for package_type in range(7):
+            package_ids = [0] if package_type == 0 else list(range(1, 6))
+            for package_id in package_ids:
+                write_package(
+                    root,
+                    platform,
+                    package_type,
+                    package_id,
+                    [{f"assets/t{package_type}/p{package_id}.txt": b"x" * (package_id + 1)}, {"second.txt": b"y"}],
+                )
+            write_json(f"{package_path}/{VERSION}/{package_type}/info.json", package_ids)
+
+        microdl: dict[str, dict] = {}
+        for name in ("assets/image/a.png", "assets/image/b.png", "assets/sound/c.mp3"):
+            path = f"{package_path}/{VERSION}/microdl/{name}"
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(name.encode("UTF-8"))
+            info = get_infov2(path)
+            del info["name"]
+            microdl[name] = info
+        write_json(f"{package_path}/{VERSION}/microdl/info.json", microdl)
+
+    write_json(f"{root}/release_info.json", {"1": "key"})
+    write_json(f"{root}/generation.json", {"major": 1, "minor": 1})
+
+
+def setup():
+    temp_dir = tempfile.mkdtemp(prefix="n4dlapi-test-")
+    atexit.register(shutil.rmtree, temp_dir, True)
+    root = f"{temp_dir}/archive-root"
+    make_archive_root(root)
+    config_file = f"{temp_dir}/config.toml"
+    with open(config_file, "w", encoding="UTF-8") as f:
+        f.write(f"""[main]
+public = false
+shared_key = "{SHARED_KEY}"
+archive_root = "{root}"
+archive_root_check_interval = 0
+
+[compression]
+encodings = ["gzip"]
+min_size = 0
+""")
+    os.environ["N4DLAPI_CONFIG_FILE"] = config_file
+    os.environ.pop("N4DLAPI_ARCHIVE_ROOT", None)
+    return root
+
+
+ARCHIVE_ROOT = setup()
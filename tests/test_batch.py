@@ -0,0 +1,79 @@
+import base64
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixture
+
+import fastapi.testclient
+
+from n4dlapi import main
+
+
+def make_bitmap(package_ids: list[int]):
+    bitmap = bytearray(max(package_ids) // 8 + 1)
+    for package_id in package_ids:
+        bitmap[package_id // 8] |= 1 << (package_id % 8)
+    return base64.b64encode(bitmap).decode("UTF-8")
+
+
+class ExcludeTest(unittest.TestCase):
+    def setUp(self):
+        self.client = fastapi.testclient.TestClient(main.app, headers={"DLAPI-Shared-Key": fixture.SHARED_KEY})
+
+    def get_package_ids(self, **exclude):
+        response = self.client.post("/api/v1/batch", json={"package_type": 1, "platform": 1, **exclude})
+        self.assertEqual(response.status_code, 200)
+        package_ids = [download["packageId"] for download in response.json()]
+        # Two archives per package.
+        self.assertEqual(package_ids[::2], package_ids[1::2])
+        return package_ids[::2]
+
+    def test_ids(self):
+        self.assertEqual(self.get_package_ids(), [1, 2, 3, 4, 5])
+        self.assertEqual(self.get_package_ids(exclude=[2, 4, 100]), [1, 3, 5])
+
+    def test_ranges(self):
+        self.assertEqual(self.get_package_ids(exclude_ranges=[[1, 2], [4, 4]]), [3, 5])
+        # Overlapping and adjacent ranges are merged, reversed ones match nothing.
+        self.assertEqual(self.get_package_ids(exclude_ranges=[[2, 3], [1, 2], [4, 4]]), [5])
+        self.assertEqual(self.get_package_ids(exclude_ranges=[[5, 1]]), [1, 2, 3, 4, 5])
+        response = self.client.post(
+            "/api/v1/batch", json={"package_type": 1, "platform": 1, "exclude_ranges": [[-1, 2]]}
+        )
+        self.assertEqual(response.status_code, 422)
+
+    def test_bitmap(self):
+        self.assertEqual(self.get_package_ids(exclude_bitmap=make_bitmap([1, 3])), [2, 4, 5])
+        self.assertEqual(self.get_package_ids(exclude_bitmap=""), [1, 2, 3, 4, 5])
+        for bitmap in ("not base64", 5):
+            response = self.client.post(
+                "/api/v1/batch", json={"package_type": 1, "platform": 1, "exclude_bitmap": bitmap}
+            )
+            self.assertEqual(response.status_code, 422)
+
+    def test_combined(self):
+        exclude = {"exclude": [5], "exclude_ranges": [[1, 1]], "exclude_bitmap": make_bitmap([3])}
+        self.assertEqual(self.get_package_ids(**exclude), [2, 4])
+
+        response = self.client.post("/api/app/batch/stream", json={"package_type": 1, "platform": 1, **exclude})
+        self.assertEqual([json.loads(line)["packageId"] for line in response.text.splitlines()], [2, 2, 4, 4])
+
+        response = self.client.post(
+            "/api/app/batch/page", json={"package_type": 1, "platform": 1, "limit": 1, **exclude}
+        )
+        page = response.json()
+        self.assertEqual([download["packageId"] for download in page["items"]], [2, 2])
+        response = self.client.post(
+            "/api/app/batch/page",
+            json={"package_type": 1, "platform": 1, "limit": 1, "cursor": page["nextCursor"], **exclude},
+        )
+        self.assertEqual([download["packageId"] for download in response.json()["items"]], [4, 4])
+        self.assertIsNone(response.json()["nextCursor"])
+
+
+if __name__ == "__main__":
+    unittest.main()
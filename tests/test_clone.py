@@ -0,0 +1,168 @@
+import hashlib
+import http.server
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clone
+
+
+class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves files of `server.files` with Range support, counting concurrent requests.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server: ArchiveServer = self.server  # type: ignore
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        range_header = self.headers.get("Range")
+        with server.lock:
+            server.requests.append((self.path, range_header))
+            server.inflight = server.inflight + 1
+            server.max_inflight = max(server.max_inflight, server.inflight)
+            interrupt = self.path in server.interrupt
+            server.interrupt.discard(self.path)
+        try:
+            # Later archives finish first, so completion order differs from the listed order.
+            time.sleep(server.delays.get(self.path, 0.0))
+            start = 0
+            match = re.fullmatch(r"bytes=(\d+)-", range_header or "")
+            if match:
+                start = int(match.group(1))
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(len(data) - start))
+            self.end_headers()
+            if interrupt:
+                # Connection drops halfway through the body.
+                self.wfile.write(data[start : start + (len(data) - start) // 2])
+                self.wfile.flush()
+                self.close_connection = True
+                self.connection.shutdown(2)
+                return
+            self.wfile.write(data[start:])
+        finally:
+            with server.lock:
+                server.inflight = server.inflight - 1
+
+
+class ArchiveServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), ArchiveHandler)
+        self.files: dict[str, bytes] = {}
+        self.delays: dict[str, float] = {}
+        self.interrupt: set[str] = set()
+        self.requests: list[tuple[str, str | None]] = []
+        self.inflight = 0
+        self.max_inflight = 0
+        self.lock = threading.Lock()
+
+    def add_file(self, path: str, data: bytes, delay: float = 0.0):
+        self.files[path] = data
+        self.delays[path] = delay
+        return {
+            "url": f"http://127.0.0.1:{self.server_address[1]}{path}",
+            "size": len(data),
+            "checksums": {
+                "md5": hashlib.md5(data).hexdigest(),
+                "sha256": hashlib.sha256(data).hexdigest(),
+            },
+        }
+
+
+class DownloadEngineTest(unittest.TestCase):
+    JOBS = 4
+
+    def setUp(self):
+        self.server = ArchiveServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = self.temp_dir.name.replace("\\", "/")
+        self.journal = clone.DownloadJournal(f"{self.root}/journal.sqlite3")
+        self.engine = clone.DownloadEngine(self.JOBS, "off")
+        # Start from a fresh congestion window for every test.
+        clone._host_controllers.clear()
+
+    def tearDown(self):
+        self.engine.close()
+        self.journal.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.temp_dir.cleanup()
+
+    def add_package(self, package_id: int, count: int, size: int = 65536):
+        data: list[dict] = []
+        for i in range(1, count + 1):
+            content = os.urandom(size)
+            info = self.server.add_file(f"/archive-root/{package_id}/{i}.zip", content, 0.05 * (count - i + 1))
+            info["packageId"] = package_id
+            data.append(info)
+        return data
+
+    def run_batch_download(self, data: list[dict]):
+        path = f"{self.root}/iOS/package"
+        clone.prepare_batch_download(self.journal, path, "59.2", 0, data, int(time.time()) + 3600)
+        clone.continue_batch_download(path, 0, self.engine, self.journal)
+        return f"{path}/59.2/0"
+
+    def test_concurrent_download(self):
+        data = self.add_package(1, 12)
+        package_path = self.run_batch_download(data)
+
+        self.assertGreater(self.server.max_inflight, 1)
+        self.assertLessEqual(self.server.max_inflight, self.JOBS)
+        for i, info in enumerate(data, 1):
+            with open(f"{package_path}/1/{i}.zip", "rb") as f:
+                self.assertEqual(hashlib.sha256(f.read()).hexdigest(), info["checksums"]["sha256"])
+
+    def test_info_json_order(self):
+        data = self.add_package(3, 5) + self.add_package(1, 4) + self.add_package(2, 3)
+        package_path = self.run_batch_download(data)
+
+        for package_id, count in ((1, 4), (2, 3), (3, 5)):
+            with open(f"{package_path}/{package_id}/info.json", "r", encoding="UTF-8") as f:
+                info = json.load(f)
+            # Listed in archive order no matter which download finished first.
+            self.assertEqual(list(info.keys()), [f"{i}.zip" for i in range(1, count + 1)])
+            self.assertEqual(list(info.values()), [65536] * count)
+        with open(f"{package_path}/info.json", "r", encoding="UTF-8") as f:
+            self.assertEqual(json.load(f), [1, 2, 3])
+
+    def test_resume_interrupted_download(self):
+        data = self.add_package(1, 1, 4 * 1024 * 1024)
+        self.server.interrupt.add("/archive-root/1/1.zip")
+        package_path = self.run_batch_download(data)
+
+        requests = [range_header for path, range_header in self.server.requests if path == "/archive-root/1/1.zip"]
+        self.assertEqual(requests[0], None)
+        self.assertEqual(len(requests), 2)
+        self.assertRegex(requests[1], r"^bytes=[1-9]\d*-$")
+        with open(f"{package_path}/1/1.zip", "rb") as f:
+            self.assertEqual(hashlib.sha256(f.read()).hexdigest(), data[0]["checksums"]["sha256"])
+        self.assertFalse(os.path.exists(f"{package_path}/1/1.zip.part"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixture
+
+import fastapi.testclient
+
+from n4dlapi import main
+
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.client = fastapi.testclient.TestClient(main.app, headers={"DLAPI-Shared-Key": fixture.SHARED_KEY})
+
+    def get_delta(self, token: str | None):
+        response = self.client.post("/api/app/delta", json={"token": token})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_in_place_change(self):
+        first = self.get_delta(None)
+        self.assertFalse(first["complete"])
+        self.assertEqual(first["items"], [])
+        self.assertEqual(first["gameVersion"], fixture.VERSION)
+
+        # Same generation, nothing changed.
+        same = self.get_delta(first["token"])
+        self.assertTrue(same["complete"])
+        self.assertEqual(same["token"], first["token"])
+        self.assertEqual(same["items"], [])
+
+        # Package 3 is replaced and package 6 added in place, without the archive-root watcher running.
+        type_path = f"{fixture.ARCHIVE_ROOT}/iOS/package/{fixture.VERSION}/2"
+        fixture.write_package(fixture.ARCHIVE_ROOT, "iOS", 2, 3, [{"changed.txt": b"changed"}])
+        fixture.write_package(fixture.ARCHIVE_ROOT, "iOS", 2, 6, [{"new.txt": b"new"}, {"second.txt": b"y"}])
+        fixture.write_json(f"{type_path}/info.json", [1, 2, 3, 4, 5, 6])
+        for path in (f"{type_path}/3/infov2.json", f"{type_path}/info.json"):
+            fixture.touch(path)
+
+        second = self.get_delta(first["token"])
+        self.assertTrue(second["complete"])
+        self.assertNotEqual(second["token"], first["token"])
+        self.assertEqual(
+            [(item["platform"], item["packageType"], item["packageId"]) for item in second["items"]],
+            [(1, 2, 3), (1, 2, 6), (1, 2, 6)],
+        )
+        self.assertEqual(
+            [item["url"] for item in second["items"]],
+            [
+                f"http://testserver/archive-root/iOS/package/{fixture.VERSION}/2/{i}"
+                for i in ("3/1.zip", "6/1.zip", "6/2.zip")
+            ],
+        )
+        self.assertEqual(second["items"][0]["size"], fixture.get_infov2(f"{type_path}/3/1.zip")["size"])
+
+        # Tokens of both generations stay valid.
+        self.assertEqual(self.get_delta(second["token"])["items"], [])
+        self.assertEqual(len(self.get_delta(first["token"])["items"]), 3)
+
+    def test_unknown_token(self):
+        delta = self.get_delta("0" * 40)
+        self.assertFalse(delta["complete"])
+        self.assertEqual(delta["items"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import gzip
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixture
+
+import fastapi.testclient
+
+from n4dlapi import main
+
+BATCH = {"package_type": 1, "platform": 1}
+
+
+class ConditionalRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.client = fastapi.testclient.TestClient(main.app, headers={"DLAPI-Shared-Key": fixture.SHARED_KEY})
+
+    def post_batch(self, **headers: str):
+        return self.client.post("/api/v1/batch", json=BATCH, headers=headers)
+
+    def test_not_modified(self):
+        response = self.post_batch(**{"Accept-Encoding": "identity"})
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers["ETag"]
+
+        response = self.post_batch(**{"Accept-Encoding": "identity", "If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["ETag"], etag)
+        self.assertEqual(response.content, b"")
+
+        # Other parameters are a different resource.
+        response = self.client.post(
+            "/api/v1/batch",
+            json={**BATCH, "exclude": [1]},
+            headers={"Accept-Encoding": "identity", "If-None-Match": etag},
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_archive_root_change(self):
+        etag = self.post_batch().headers["ETag"]
+        fixture.touch(f"{fixture.ARCHIVE_ROOT}/generation.json")
+        response = self.post_batch(**{"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_encoding_variants(self):
+        identity = self.post_batch(**{"Accept-Encoding": "identity"})
+        self.assertNotIn("Content-Encoding", identity.headers)
+        self.assertEqual(identity.headers["Vary"], "Accept-Encoding")
+        etag = identity.headers["ETag"]
+
+        compressed = self.post_batch(**{"Accept-Encoding": "gzip"})
+        self.assertEqual(compressed.headers["Content-Encoding"], "gzip")
+        self.assertEqual(compressed.headers["ETag"], etag[:-1] + '-gzip"')
+        self.assertEqual(compressed.json(), identity.json())
+
+        # Served from the compressed body cache the second time.
+        cached = self.post_batch(**{"Accept-Encoding": "gzip"})
+        self.assertEqual(cached.headers["ETag"], compressed.headers["ETag"])
+        self.assertEqual(cached.json(), identity.json())
+
+        # Either variant validates the other, only the encoding differs.
+        for if_none_match, accept_encoding in ((compressed.headers["ETag"], "identity"), (etag, "gzip")):
+            response = self.post_batch(**{"Accept-Encoding": accept_encoding, "If-None-Match": if_none_match})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers["ETag"], if_none_match)
+
+    def test_gzip_body(self):
+        identity = self.post_batch(**{"Accept-Encoding": "identity"})
+        with self.client.stream("POST", "/api/v1/batch", json=BATCH, headers={"Accept-Encoding": "gzip"}) as response:
+            body = b"".join(response.iter_raw())
+        self.assertEqual(gzip.decompress(body), identity.content)
+        self.assertLess(len(body), len(identity.content))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixture
+
+from n4dlapi import shaping
+
+
+def make_scope(headers: list[tuple[bytes, bytes]], client: str = "10.0.0.1"):
+    return {"type": "http", "headers": headers, "client": (client, 12345)}
+
+
+class ClientIdTest(unittest.TestCase):
+    def make_shaper(self, trusted_proxies: int = 1):
+        return shaping.TrafficShaper(
+            None,
+            {
+                "rate": 1000,
+                "burst": 1000,
+                "max_transfers": 1,
+                "bulk_rate": 0,
+                "small_file_size": 0,
+                "client_header": "X-Forwarded-For",
+                "trusted_proxies": trusted_proxies,
+            },
+        )
+
+    def test_spoofed_forwarded_for(self):
+        shaper = self.make_shaper()
+        first = shaper.get_client(shaper.get_client_id(make_scope([(b"x-forwarded-for", b"1.1.1.1, 203.0.113.5")])))
+        first.transfers = 1
+        # Whatever the client puts in front, the address appended by the proxy is the same.
+        for spoofed in (b"2.2.2.2, 203.0.113.5", b"3.3.3.3, 4.4.4.4, 203.0.113.5", b"203.0.113.5"):
+            client_id = shaper.get_client_id(make_scope([(b"x-forwarded-for", spoofed)]))
+            self.assertEqual(client_id, "203.0.113.5")
+            self.assertIs(shaper.get_client(client_id), first)
+
+    def test_trusted_proxies(self):
+        shaper = self.make_shaper(2)
+        headers = [(b"x-forwarded-for", b"1.1.1.1, 203.0.113.5"), (b"x-forwarded-for", b"192.168.0.2")]
+        self.assertEqual(shaper.get_client_id(make_scope(headers)), "203.0.113.5")
+        # Fewer entries than proxies, so the request didn't go through all of them.
+        self.assertEqual(shaper.get_client_id(make_scope([(b"x-forwarded-for", b"192.168.0.2")])), "192.168.0.2")
+
+    def test_shared_key(self):
+        shaper = self.make_shaper()
+        self.assertEqual(
+            shaper.get_client_id(make_scope([(b"dlapi-shared-key", fixture.SHARED_KEY.encode("latin-1"))])), "key:"
+        )
+        # A wrong key doesn't make a new client either.
+        self.assertEqual(shaper.get_client_id(make_scope([(b"dlapi-shared-key", b"wrong")])), "10.0.0.1")
+        self.assertEqual(shaper.get_client_id(make_scope([])), "10.0.0.1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import unittest
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixture
+
+import fastapi.testclient
+
+from n4dlapi import config
+from n4dlapi import main
+from n4dlapi import urlsign
+
+SECRET = "signing-secret"
+PATH = "/iOS/package/59.2/1/1/1.zip"
+
+
+class SignedUrlTest(unittest.TestCase):
+    def setUp(self):
+        config.load_signing_toml({"time_limit": 600, "secret": SECRET})
+        self.client = fastapi.testclient.TestClient(main.app, headers={"DLAPI-Shared-Key": fixture.SHARED_KEY})
+
+    def tearDown(self):
+        config.load_signing_toml({})
+
+    def get_file(self, path: str, expires: int, signature: str):
+        return self.client.get(f"/archive-root{path}?expires={expires}&signature={signature}")
+
+    def test_valid(self):
+        response = self.client.post("/api/v1/batch", json={"package_type": 1, "platform": 1})
+        url = urllib.parse.urlsplit(response.json()[0]["url"])
+        self.assertEqual(url.path, "/archive-root" + PATH)
+        query = urllib.parse.parse_qs(url.query)
+        self.assertGreater(int(query["expires"][0]), time.time())
+
+        response = self.client.get(f"{url.path}?{url.query}")
+        self.assertEqual(response.status_code, 200)
+        with open(fixture.ARCHIVE_ROOT + PATH, "rb") as f:
+            self.assertEqual(response.content, f.read())
+
+    def test_tampered(self):
+        expires = urlsign.get_expiry()
+        signer = urlsign.UrlSigner(SECRET.encode("UTF-8"), expires)
+        signature = signer.signature(PATH)
+        self.assertEqual(self.get_file(PATH, expires, signature).status_code, 200)
+
+        self.assertEqual(self.get_file(PATH, expires + 1, signature).status_code, 403)
+        tampered = signature[:-1] + ("B" if signature[-1] == "A" else "A")
+        self.assertEqual(self.get_file(PATH, expires, tampered).status_code, 403)
+        # Signature of another file.
+        self.assertEqual(self.get_file("/iOS/package/59.2/1/1/2.zip", expires, signature).status_code, 403)
+        # Signed with another secret.
+        other = urlsign.UrlSigner(b"other-secret", expires).signature(PATH)
+        self.assertEqual(self.get_file(PATH, expires, other).status_code, 403)
+        self.assertEqual(self.client.get("/archive-root" + PATH).status_code, 403)
+        # Small files served from memory are checked all the same.
+        self.assertEqual(self.client.get("/archive-root/generation.json").status_code, 403)
+
+    def test_expired(self):
+        expires = int(time.time()) - 1
+        signature = urlsign.UrlSigner(SECRET.encode("UTF-8"), expires).signature(PATH)
+        self.assertEqual(self.get_file(PATH, expires, signature).status_code, 403)
+
+    def test_unsigned(self):
+        config.load_signing_toml({})
+        response = self.client.post("/api/v1/batch", json={"package_type": 1, "platform": 1})
+        url = urllib.parse.urlsplit(response.json()[0]["url"])
+        self.assertEqual(url.query, "")
+        self.assertEqual(self.client.get(url.path).status_code, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
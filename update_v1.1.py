@@ -22,20 +22,23 @@
 # DEALINGS IN THE SOFTWARE.
 
 import argparse
+import concurrent.futures
 import functools
 import hashlib
-import io
 import json
 import os
+import time
 import zipfile
 
 import natsort
 import honkypy
 
-from typing import Any, Literal
+from typing import IO, Any, Callable, Literal
 
 PLATFORMS = ["iOS", "Android"]
 GENERATION_VERSION = (1, 1)
+# Archives are hashed and copied in chunks, so memory use doesn't grow with --jobs times the largest archive.
+CHUNK_SIZE = 8 * 1024 * 1024
 
 
 @functools.cache
@@ -86,143 +89,257 @@ def build_new_update_info(root: str, platform: str):
     write_json(f"{path}/infov2.json", list(map(version_str, versions)))
 
 
-def prehash_update(root: str, platform: str):
-    path = f"{root}/{platform}/update"
-
-    # Hash them
-    for version in get_versions(path + "/infov2.json"):
-        verstr = version_str(version)
-        print("Making new metadata for update ", verstr)
-        infov2: list[dict[str, Any]] = []
-        verpath = f"{path}/{verstr}/"
-        verinfo: dict[str, int] = read_json(verpath + "info.json")
-        verdata: list[tuple[str, int]] = natsort.natsorted(verinfo.items(), key=lambda x: x[0])
-        for data in verdata:
-            archive = verpath + data[0]
-            with open(archive, "rb") as f:
-                archive_data = f.read()
-            md5: str = hashlib.md5(archive_data, usedforsecurity=False).digest().hex()
-            sha256: str = hashlib.sha256(archive_data, usedforsecurity=False).digest().hex()
-            infov2.append({"name": data[0], "size": data[1], "md5": md5, "sha256": sha256})
-        write_json(verpath + "infov2.json", infov2)
-
-
-def get_db_from_update(root: str, platform: str, uptover: tuple[int, int]):
-    path = f"{root}/{platform}/update"
-    dbfiles: dict[str, bytes] = {}
-
-    # Load them
-    for version in filter(lambda x: x <= uptover, get_versions(path + "/infov2.json")):
-        verstr = version_str(version)
-        print("Making new metadata for update ", verstr)
-        verpath = f"{path}/{verstr}/"
-        verinfo: list[dict[str, Any]] = read_json(verpath + "infov2.json")
-        for archive in verinfo:
-            archive_path = verpath + archive["name"]
-            with open(archive_path, "rb") as f:
-                archive_data = f.read()
-            with zipfile.ZipFile(io.BytesIO(archive_data), "r") as z:
-                for info in z.infolist():
-                    if info.filename.startswith("db/") and info.filename.endswith(".db_"):
-                        with z.open(info, "r") as f:
-                            dbname = os.path.basename(info.filename)
-                            print("Adding db file", dbname)
-                            dbfiles[dbname] = f.read()
-
-    return dbfiles
-
-
-def prehash_package_type(
-    root: str,
-    platform: str,
-    version: tuple[int, int],
-    pkgtype: int,
-    *,
-    dbfiles: dict[str, bytes] | None = None,
-    extract_to: str | None = None,
-):
+def get_archive_sizes(path: str):
+    verinfo: dict[str, int] = read_json(f"{path}/info.json")
+    return sum(verinfo.values())
+
+
+def hash_stream(f: IO[bytes], dest: IO[bytes] | None = None):
+    md5 = hashlib.md5(usedforsecurity=False)
+    sha256 = hashlib.sha256(usedforsecurity=False)
+    size = 0
+    while True:
+        data = f.read(CHUNK_SIZE)
+        if not data:
+            break
+        md5.update(data)
+        sha256.update(data)
+        size = size + len(data)
+        if dest is not None:
+            dest.write(data)
+    return size, md5.hexdigest(), sha256.hexdigest()
+
+
+def prehash_archives(path: str):
+    infov2: list[dict[str, Any]] = []
+    verinfo: dict[str, int] = read_json(f"{path}/info.json")
+    verdata: list[tuple[str, int]] = natsort.natsorted(verinfo.items(), key=lambda x: x[0])
+    for data in verdata:
+        archive = f"{path}/{data[0]}"
+        with open(archive, "rb") as f:
+            _, md5, sha256 = hash_stream(f)
+        infov2.append({"name": data[0], "size": data[1], "md5": md5, "sha256": sha256})
+    write_json(f"{path}/infov2.json", infov2)
+
+
+def prehash_update(root: str, platform: str, version: tuple[int, int]):
+    verstr = version_str(version)
+    print("Making new metadata for update ", verstr)
+    prehash_archives(f"{root}/{platform}/update/{verstr}")
+
+
+def load_db_files(archive_dir: str, dbfiles: dict[str, tuple[str, str]]):
+    # Newer files replace the ones already in dbfiles. Only where to find them is kept, they're read one at a time
+    # when written.
+    verinfo: list[dict[str, Any]] = read_json(f"{archive_dir}/infov2.json")
+    for archive in verinfo:
+        archive_path = f"{archive_dir}/{archive['name']}"
+        with zipfile.ZipFile(archive_path, "r") as z:
+            for info in z.infolist():
+                if info.filename.startswith("db/") and info.filename.endswith(".db_"):
+                    dbname = os.path.basename(info.filename)
+                    print("Adding db file", dbname)
+                    dbfiles[dbname] = (archive_path, info.filename)
+
+
+def write_decrypted_db(root: str, platform: str, version: tuple[int, int]):
+    # Updates up to this version first, then bootstrap package, newest copy wins.
+    verstr = version_str(version)
+    dbfiles: dict[str, tuple[str, str]] = {}
+    for update in filter(lambda x: x <= version, get_versions(f"{root}/{platform}/update/infov2.json")):
+        load_db_files(f"{root}/{platform}/update/{version_str(update)}", dbfiles)
+    path = f"{root}/{platform}/package/{verstr}"
+    for id in read_json(f"{path}/0/info.json"):
+        load_db_files(f"{path}/0/{id}", dbfiles)
+
+    dbpath = f"{path}/db"
+    os.makedirs(dbpath, exist_ok=True)
+    for name, (archive_path, member) in dbfiles.items():
+        print("Writing decrypted db", name)
+        with zipfile.ZipFile(archive_path, "r") as z:
+            db = z.read(member)
+        dctx, _ = honkypy.decrypt_setup_probe(name, db[:16])
+        with open(f"{dbpath}/{name}", "wb") as f:
+            f.write(dctx.decrypt_block(db[dctx.HEADER_SIZE :]))
+
+
+def prehash_package_type(root: str, platform: str, version: tuple[int, int], pkgtype: int):
     path = f"{root}/{platform}/package/{version_str(version)}/{pkgtype}"
     pkg_ids: list[int] = read_json(f"{path}/info.json")
     # Create new hash
     for id in pkg_ids:
         print("Making new metadata for package", pkgtype, id)
-        path_id = f"{path}/{id}"
-        infov2: list[dict[str, Any]] = []
-        verinfo: dict[str, int] = read_json(f"{path_id}/info.json")
-        verdata: list[tuple[str, int]] = natsort.natsorted(verinfo.items(), key=lambda x: x[0])
-        for data in verdata:
-            archive = f"{path_id}/{data[0]}"
-            with open(archive, "rb") as f:
-                archive_data = f.read()
-            if dbfiles is not None:
-                with zipfile.ZipFile(io.BytesIO(archive_data), "r") as z:
-                    for info in z.infolist():
-                        if info.filename.startswith("db/") and info.filename.endswith(".db_"):
-                            with z.open(info, "r") as f:
-                                dbname = os.path.basename(info.filename)
-                                print("Adding db file", dbname)
-                                dbfiles[dbname] = f.read()
-            md5: str = hashlib.md5(archive_data, usedforsecurity=False).digest().hex()
-            sha256: str = hashlib.sha256(archive_data, usedforsecurity=False).digest().hex()
-            infov2.append({"name": data[0], "size": data[1], "md5": md5, "sha256": sha256})
-        # Write new hash
-        write_json(f"{path_id}/infov2.json", infov2)
+        prehash_archives(f"{path}/{id}")
 
+
+def extract_microdl(root: str, platform: str, version: tuple[int, int], pkgtype: int, extract_to: str):
+    path = f"{root}/{platform}/package/{version_str(version)}/{pkgtype}"
+    pkg_ids: list[int] = read_json(f"{path}/info.json")
     # Extract microdl
-    if extract_to is not None:
-        extract_data: dict[str, dict[str, Any]] = {}
-        for id in reversed(pkg_ids):
-            path_id = f"{path}/{id}/"
-            verinfo2: list[dict[str, Any]] = read_json(f"{path_id}/infov2.json")
-            print("Extracting", pkgtype, id, "for microdl")
-            name: str
-            for name in map(lambda x: x["name"], reversed(verinfo2)):
-                # Open archive for microdl extract
-                with zipfile.ZipFile(f"{path_id}/{name}", "r") as z:
-                    for info in z.infolist():
-                        if info.filename not in extract_data:
-                            print("Extracting", info.filename)
-                            with z.open(info, "r") as f:
-                                filedata = f.read()
-                            # Hash
-                            md5: str = hashlib.md5(filedata, usedforsecurity=False).digest().hex()
-                            sha256: str = hashlib.sha256(filedata, usedforsecurity=False).digest().hex()
-                            extract_data[info.filename] = {"size": len(filedata), "md5": md5, "sha256": sha256}
-                            # Write file
-                            filepath = f"{extract_to}/{info.filename}"
-                            os.makedirs(os.path.dirname(filepath), exist_ok=True)
-                            with open(filepath, "wb") as f:
-                                f.write(filedata)
-        print("Writing microdl hashes")
-        write_json(f"{extract_to}/info.json", extract_data)
-
-
-def prehash_packages(root: str, platform: str):
+    extract_data: dict[str, dict[str, Any]] = {}
+    for id in reversed(pkg_ids):
+        path_id = f"{path}/{id}/"
+        verinfo2: list[dict[str, Any]] = read_json(f"{path_id}/infov2.json")
+        print("Extracting", pkgtype, id, "for microdl")
+        name: str
+        for name in map(lambda x: x["name"], reversed(verinfo2)):
+            # Open archive for microdl extract
+            with zipfile.ZipFile(f"{path_id}/{name}", "r") as z:
+                for info in z.infolist():
+                    if info.filename not in extract_data:
+                        print("Extracting", info.filename)
+                        filepath = f"{extract_to}/{info.filename}"
+                        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                        # Write and hash file
+                        with z.open(info, "r") as f, open(filepath, "wb") as dest:
+                            size, md5, sha256 = hash_stream(f, dest)
+                        extract_data[info.filename] = {"size": size, "md5": md5, "sha256": sha256}
+    print("Writing microdl hashes")
+    write_json(f"{extract_to}/info.json", extract_data)
+
+
+def format_size(size: float):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            break
+        size = size / 1024
+    return f"{size:.1f} {unit}"
+
+
+def format_duration(seconds: float):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+class Task:
+    def __init__(self, name: str, func: Callable[[], Any], weight: int, deps: list[str]):
+        self.name = name
+        self.func = func
+        # Bytes of archives this task reads, for progress report.
+        self.weight = weight
+        self.deps = deps
+
+
+class Pipeline:
+    """
+    Runs tasks concurrently once all their dependencies are done.
+
+    Names of finished tasks are recorded in a checkpoint file, so a rerun after a crash skips them. Tasks must only
+    depend on files written by other tasks, not on their return value.
+    """
+
+    def __init__(self, checkpoint_file: str, jobs: int):
+        self.checkpoint_file = checkpoint_file
+        self.jobs = jobs
+        self.tasks: dict[str, Task] = {}
+        self.done: set[str] = set()
+        if os.path.isfile(checkpoint_file):
+            with open(checkpoint_file, "r", encoding="UTF-8", newline="") as f:
+                self.done.update(json.load(f))
+
+    def add(self, name: str, func: Callable[[], Any], weight: int = 0, deps: list[str] | None = None):
+        deps = deps or []
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError(f"Task {name} depends on unknown task {dep}")
+        self.tasks[name] = Task(name, func, weight, deps)
+        return name
+
+    def save_checkpoint(self):
+        temp_file = self.checkpoint_file + ".tmp"
+        write_json(temp_file, sorted(self.done))
+        os.replace(temp_file, self.checkpoint_file)
+
+    def run(self):
+        skipped = [name for name in self.tasks if name in self.done]
+        if skipped:
+            print("Skipping", len(skipped), "tasks finished in previous run")
+        pending = {name: task for name, task in self.tasks.items() if name not in self.done}
+        total_weight = sum(task.weight for task in pending.values())
+        done_weight = 0
+        start = time.monotonic()
+        failed: BaseException | None = None
+
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            running: dict[concurrent.futures.Future[Any], Task] = {}
+            while pending or running:
+                if failed is None:
+                    for name, task in list(pending.items()):
+                        if all(dep in self.done for dep in task.deps):
+                            del pending[name]
+                            running[executor.submit(task.func)] = task
+                if not running:
+                    break
+
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    if future.exception() is not None:
+                        print("Task", task.name, "failed")
+                        failed = failed or future.exception()
+                        continue
+
+                    self.done.add(task.name)
+                    self.save_checkpoint()
+                    done_weight = done_weight + task.weight
+                    elapsed = time.monotonic() - start
+                    rate = done_weight / elapsed if elapsed > 0 else 0
+                    eta = (total_weight - done_weight) / rate if rate > 0 else 0
+                    print(
+                        f"[{len(self.done)}/{len(self.tasks)}] {task.name} done,",
+                        f"{format_size(done_weight)} of {format_size(total_weight)},",
+                        f"{format_size(rate)}/s, ETA {format_duration(eta)}",
+                    )
+
+        if failed is not None:
+            raise failed
+        elif pending:
+            raise RuntimeError("Unfinished tasks: " + ", ".join(pending))
+
+
+def add_platform_tasks(pipeline: Pipeline, root: str, platform: str):
+    # Cheap, so it's done every run instead of being a task.
+    print("Writing new update metadata for", platform)
+    build_new_update_info(root, platform)
+    updates = get_versions(f"{root}/{platform}/update/infov2.json")
+    update_tasks: dict[tuple[int, int], str] = {}
+    update_weights: dict[tuple[int, int], int] = {}
+    for version in updates:
+        verstr = version_str(version)
+        update_weights[version] = get_archive_sizes(f"{root}/{platform}/update/{verstr}")
+        update_tasks[version] = pipeline.add(
+            f"{platform}/update/{verstr}",
+            functools.partial(prehash_update, root, platform, version),
+            update_weights[version],
+        )
+
     path = f"{root}/{platform}/package"
-    info = get_versions(f"{path}/info.json")
-    for version in info:
-        dbfiles = get_db_from_update(root, platform, version)
-        # Prehash
-        print("Prehasing package for version", *version)
+    for version in get_versions(f"{path}/info.json"):
         verstr = version_str(version)
-        microdl_dest = f"{path}/{verstr}/microdl"
+        package_weights: list[int] = []
         for pkgtype in range(7):
-            prehash_package_type(
-                root,
-                platform,
-                version,
-                pkgtype,
-                dbfiles=dbfiles if pkgtype == 0 else None,
-                extract_to=microdl_dest if pkgtype == 4 else None,
+            pkg_ids: list[int] = read_json(f"{path}/{verstr}/{pkgtype}/info.json")
+            package_weights.append(sum(get_archive_sizes(f"{path}/{verstr}/{pkgtype}/{id}") for id in pkg_ids))
+            pipeline.add(
+                f"{platform}/package/{verstr}/{pkgtype}",
+                functools.partial(prehash_package_type, root, platform, version, pkgtype),
+                package_weights[pkgtype],
             )
-        # Write decrypted db
-        dbpath = f"{path}/{verstr}/db"
-        os.makedirs(dbpath, exist_ok=True)
-        for name, db in dbfiles.items():
-            print("Writing decrypted db", name)
-            dctx, _ = honkypy.decrypt_setup_probe(name, db[:16])
-            with open(f"{dbpath}/{name}", "wb") as f:
-                f.write(dctx.decrypt_block(db[dctx.HEADER_SIZE :]))
+
+        pipeline.add(
+            f"{platform}/package/{verstr}/microdl",
+            functools.partial(extract_microdl, root, platform, version, 4, f"{path}/{verstr}/microdl"),
+            package_weights[4],
+            [f"{platform}/package/{verstr}/4"],
+        )
+        db_updates = [v for v in updates if v <= version]
+        pipeline.add(
+            f"{platform}/package/{verstr}/db",
+            functools.partial(write_decrypted_db, root, platform, version),
+            sum(update_weights[v] for v in db_updates) + package_weights[0],
+            [update_tasks[v] for v in db_updates] + [f"{platform}/package/{verstr}/0"],
+        )
 
 
 def path_validate(path: str):
@@ -234,6 +351,9 @@ def path_validate(path: str):
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("archive_root", type=path_validate)
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count() or 1, help="Number of tasks to run at once (default: CPU count)"
+    )
     args = parser.parse_args()
 
     root: str = args.archive_root
@@ -254,17 +374,18 @@ def main():
             f"Generation version is newer ({version_str(gentuple)}) than this script generation version ({version_str(GENERATION_VERSION)})"
         )
 
-    # Update
+    # Update. Progress is kept in checkpoint file until generation file is written.
+    checkpoint_file = f"{root}/generation.checkpoint.json"
+    pipeline = Pipeline(checkpoint_file, max(args.jobs, 1))
     for platform in PLATFORMS:
         if os.path.isdir(os.path.join(root, platform)):
-            print("===== OS:", platform, "=====")
-            print("Writing new update metadata")
-            build_new_update_info(root, platform)
-            prehash_update(root, platform)
-            prehash_packages(root, platform)
+            add_platform_tasks(pipeline, root, platform)
+    pipeline.run()
 
     # Write generation file
     write_json(genfile, {"major": GENERATION_VERSION[0], "minor": GENERATION_VERSION[1]})
+    if os.path.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
 
 
 if __name__ == "__main__":
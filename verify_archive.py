@@ -0,0 +1,270 @@
+# Script to verify archive-root files against their recorded hashes.
+#
+# Copyright (c) 2023 Dark Energy Processor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import argparse
+import concurrent.futures
+import dataclasses
+import hashlib
+import json
+import mmap
+import os
+import time
+
+from typing import IO, Any, Iterator
+
+PLATFORMS = ["iOS", "Android"]
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+@dataclasses.dataclass
+class VerifyEntry:
+    path: str
+    size: int
+    md5: str
+    sha256: str
+
+
+def read_json(file: str):
+    with open(file, "r", encoding="UTF-8", newline="") as f:
+        return json.load(f)
+
+
+def write_json_atomic(file: str, data: list | dict):
+    temp_file = file + ".tmp"
+    with open(temp_file, "w", encoding="UTF-8", newline="") as f:
+        json.dump(data, f, indent="\t")
+    os.replace(temp_file, file)
+
+
+def parse_version(ver: str):
+    versions = ver.split(".", 1)
+    return int(versions[0]), int(versions[1])
+
+
+def get_versions(file: str):
+    new_ver: list[tuple[int, int]] = []
+    for ver in read_json(file):
+        try:
+            new_ver.append(parse_version(ver))
+        except ValueError:
+            pass
+    new_ver.sort()
+    return ["%d.%d" % ver for ver in new_ver]
+
+
+def iter_infov2(root: str, path: str) -> Iterator[VerifyEntry]:
+    infov2: list[dict[str, Any]] = read_json(f"{root}/{path}/infov2.json")
+    for info in infov2:
+        yield VerifyEntry(f"{path}/{info['name']}", info["size"], info["md5"], info["sha256"])
+
+
+def iter_manifest(root: str) -> Iterator[VerifyEntry]:
+    """
+    Yield every file listed by update, package and microdl manifests, relative to `root`.
+    """
+    for platform in PLATFORMS:
+        update_path = f"{platform}/update"
+        if os.path.isfile(f"{root}/{update_path}/infov2.json"):
+            for version in get_versions(f"{root}/{update_path}/infov2.json"):
+                yield from iter_infov2(root, f"{update_path}/{version}")
+
+        package_path = f"{platform}/package"
+        if os.path.isfile(f"{root}/{package_path}/info.json"):
+            for version in get_versions(f"{root}/{package_path}/info.json"):
+                for pkgtype in range(7):
+                    type_path = f"{package_path}/{version}/{pkgtype}"
+                    if os.path.isfile(f"{root}/{type_path}/info.json"):
+                        for pkgid in read_json(f"{root}/{type_path}/info.json"):
+                            yield from iter_infov2(root, f"{type_path}/{pkgid}")
+
+                microdl_path = f"{package_path}/{version}/microdl"
+                if os.path.isfile(f"{root}/{microdl_path}/info.json"):
+                    microdl: dict[str, dict[str, Any]] = read_json(f"{root}/{microdl_path}/info.json")
+                    for name, info in microdl.items():
+                        yield VerifyEntry(f"{microdl_path}/{name}", info["size"], info["md5"], info["sha256"])
+
+
+class Throttle:
+    """
+    Token bucket limiting reads of a worker process across all the files it checks. Reads may go into debt, which is
+    slept off right away, and up to one second worth of unused rate is kept for the next reads.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = 0.0
+        self.last = time.monotonic()
+
+    def consume(self, amount: int):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.last) * self.rate, self.rate) - amount
+        self.last = now
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
+# Per worker process.
+_throttle: Throttle | None = None
+
+
+def get_throttle(rate: float):
+    global _throttle
+
+    if _throttle is None or _throttle.rate != rate:
+        _throttle = Throttle(rate)
+    return _throttle
+
+
+def verify_file(root: str, entry: VerifyEntry, rate: float):
+    """
+    Check a single file. Returns (status, detail) where status is "ok", "missing", "truncated" or "corrupted".
+
+    `rate` is the maximum number of bytes per second this worker may read, 0 means unlimited.
+    """
+    try:
+        f = open(f"{root}/{entry.path}", "rb")
+    except FileNotFoundError:
+        return "missing", ""
+
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size < entry.size:
+            return "truncated", f"expected {entry.size} bytes, got {size}"
+        elif size > entry.size:
+            return "corrupted", f"expected {entry.size} bytes, got {size}"
+
+        md5 = hashlib.md5(usedforsecurity=False)
+        sha256 = hashlib.sha256(usedforsecurity=False)
+        if size > 0:
+            throttle = get_throttle(rate) if rate > 0 else None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if hasattr(m, "madvise"):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(m) as view:
+                    for offset in range(0, size, HASH_CHUNK_SIZE):
+                        chunk = view[offset : offset + HASH_CHUNK_SIZE]
+                        md5.update(chunk)
+                        sha256.update(chunk)
+                        if throttle is not None:
+                            # Charge what was actually read, so small files don't cost a whole chunk.
+                            throttle.consume(len(chunk))
+                        chunk.release()
+
+    if md5.hexdigest() != entry.md5 or sha256.hexdigest() != entry.sha256:
+        return "corrupted", "hash mismatch"
+    return "ok", ""
+
+
+def load_state(state_file: str):
+    results: dict[str, dict[str, Any]] = {}
+    if os.path.isfile(state_file):
+        with open(state_file, "r", encoding="UTF-8", newline="") as f:
+            for line in f:
+                try:
+                    result: dict[str, Any] = json.loads(line)
+                except ValueError:
+                    # Partially written line from an interrupted run.
+                    continue
+                results[result["path"]] = result
+    return results
+
+
+def make_report(root: str, results: dict[str, dict[str, Any]]):
+    report: dict[str, Any] = {
+        "archive_root": root,
+        "checked": len(results),
+        "bytes": 0,
+        "missing": [],
+        "truncated": [],
+        "corrupted": [],
+    }
+    for path, result in sorted(results.items()):
+        report["bytes"] = report["bytes"] + result["size"]
+        if result["status"] != "ok":
+            report[result["status"]].append({"path": path, "detail": result["detail"]})
+    return report
+
+
+def record_result(state: IO[str], results: dict[str, dict[str, Any]], entry: VerifyEntry, status: tuple[str, str]):
+    result = {"path": entry.path, "size": entry.size, "status": status[0], "detail": status[1]}
+    results[entry.path] = result
+    state.write(json.dumps(result) + "\n")
+    state.flush()
+    if status[0] != "ok":
+        print(status[0].capitalize() + ":", entry.path, status[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify archive-root files against infov2.json hashes.")
+    parser.add_argument("archive_root")
+    parser.add_argument("--jobs", "-j", help="Number of hashing processes (default CPU count).", type=int, default=0)
+    parser.add_argument(
+        "--rate", help="Maximum read rate in MiB/s, 0 for unlimited (default 0).", type=float, default=0
+    )
+    parser.add_argument("--report", help="Where to write JSON report.", default="verify_report.json")
+    parser.add_argument("--state", help="Progress file to resume interrupted run.", default="verify_state.jsonl")
+    parser.add_argument("--restart", help="Ignore progress of previous run.", action="store_true")
+    args = parser.parse_args()
+
+    root: str = os.path.normpath(args.archive_root)
+    jobs: int = args.jobs or os.cpu_count() or 1
+    report_file: str = args.report
+    state_file: str = args.state
+    rate = args.rate * 1024 * 1024 / jobs
+
+    if args.restart and os.path.isfile(state_file):
+        os.remove(state_file)
+    results = load_state(state_file)
+    if results:
+        print("Resuming,", len(results), "files already checked")
+
+    entries = (entry for entry in iter_manifest(root) if entry.path not in results)
+    checked = 0
+    with open(state_file, "a", encoding="UTF-8", newline="") as state:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            pending: dict[concurrent.futures.Future[tuple[str, str]], VerifyEntry] = {}
+            for entry in entries:
+                pending[executor.submit(verify_file, root, entry, rate)] = entry
+                # Keep the queue bounded so the manifest doesn't have to be loaded whole.
+                if len(pending) >= jobs * 4:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        record_result(state, results, pending.pop(future), future.result())
+                        checked = checked + 1
+            for future in concurrent.futures.as_completed(pending):
+                record_result(state, results, pending[future], future.result())
+                checked = checked + 1
+
+    report = make_report(root, results)
+    write_json_atomic(report_file, report)
+    # Run is complete. Next run starts from scratch.
+    os.remove(state_file)
+    print("Checked", checked, "files in this run,", report["checked"], "in total")
+    print("Missing:", len(report["missing"]))
+    print("Truncated:", len(report["truncated"]))
+    print("Corrupted:", len(report["corrupted"]))
+    print("Report written to", report_file)
+    return 0 if not (report["missing"] or report["truncated"] or report["corrupted"]) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())